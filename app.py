@@ -14,37 +14,66 @@
 
 from utils.config import Config
 from utils.utils import get_all_child_accounts, get_account_labels, get_accounts_by_labels
-from server import run, classify_keywords
-from io import StringIO
+from utils.ingest import CsvIngestor, KeywordSpool
+from server import run, classify_keywords, RunStats
 import streamlit as st
+import logging
+import weakref
 import yaml
-import csv
+import os
 
 OAUTH_HELP = """Refer to
         [Create OAuth2 Credentials](https://developers.google.com/google-ads/api/docs/client-libs/python/oauth-web#create_oauth2_credentials)
         for more information"""
 CLASSIFICATION_FAILED_TEXT = "Categorization failed. Press the 'Retry Classification' button to try agin. You can still access generated keywords in spreadsheet."
 RUN_TYPE_TOOLTIP = """Choose 'Full Run' to pull new keywords and categorize them. Choose 'Filter' to upload a CSV file with keywords to filter and categorize"""
+BUDGET_USED_TEXT = "No keywords to categorize. Either no new keywords were found or the monthly categorization budget is used up."
 FILE_UPLOAD_HELP = """Upload a CSV file with keywords you want to filter and categorize. Use a single column with one KW each line"""
+KW_COLUMN_HELP = """Number of the CSV column that holds the keywords, starting from 1"""
+NEGATIVES_HELP = """Keywords blocked by negative keywords of the accounts' campaigns, ad groups or negative keyword lists can be kept, flagged in the output or, if blocked in every ad group they could go to, dropped before categorization"""
+_NEGATIVES_OPTIONS = {"Keep": None, "Flag": 'flag', "Drop": 'drop'}
+SOURCES_HELP = """Keyword recommendations of the accounts, Keyword Planner ideas seeded with each account's top keywords or landing pages, and/or the accounts' search terms with clicks that aren't keywords yet"""
+OVERLAP_HELP = """Keep keywords that only some of the accounts already run, with the number of accounts running each one, and list the account pairs sharing the most keywords in a separate tab"""
+_SOURCE_OPTIONS = {"Recommendations": 'recommendations', "Keyword Planner ideas": 'keyword_ideas',
+                   "Search terms": 'search_terms'}
+# Local dir or gs:// prefix to spool uploaded keywords to, defaults to a temp dir
+_UPLOAD_SPOOL_DIR = os.getenv('upload_spool_dir')
 
 def run_tool():
     st.session_state.categorization_finished = False
     st.session_state.generation_finished = False
+    stats = RunStats()
     row_num = run(st.session_state.config, st.session_state.accounts_selected,
-                  st.session_state.run_type, st.session_state.uploaded_kws)
+                  st.session_state.run_type, st.session_state.uploaded_kws, stats=stats,
+                  negatives=_NEGATIVES_OPTIONS[st.session_state.negatives],
+                  sources=[_SOURCE_OPTIONS[s] for s in st.session_state.get("sources", [])],
+                  overlap=st.session_state.overlap)
+    logging.info(f"Run stats: {stats.to_dict()}")
+    # Every run writes to its own tab, so concurrent sessions don't collide
+    st.session_state.run_sheet = stats.sheet
     results_url = config.spreadsheet_url
 
     st.session_state.generation_finished = True
     return row_num
 
 
+def _delete_spool(path):
+    KeywordSpool(path).delete()
+
+
+def clear_uploaded_kws():
+    if st.session_state.uploaded_kws:
+        st.session_state.uploaded_kws.delete()
+    st.session_state.uploaded_kws = []
+
+
 def toggle_show_cat(bol):
     st.session_state.show_categorization_retry = bol
 
 
 def run_categorization(row_num):
     try:
-        classify_keywords(row_num)
+        classify_keywords(row_num, st.session_state.run_sheet)
         toggle_show_cat(False)
         st.session_state.categorization_finished = True
     except Exception as e:
@@ -87,6 +116,8 @@ def initialize_session_state():
         st.session_state.categorization_finished = False
     if "row_num" not in st.session_state:
         st.session_state.row_num = ''
+    if "run_sheet" not in st.session_state:
+        st.session_state.run_sheet = ''
     if "uploaded_kws" not in st.session_state:
         st.session_state.uploaded_kws = []
 
@@ -128,6 +159,8 @@ def is_run_not_ready():
         return True
     if st.session_state.run_type == "Filter" and not st.session_state.uploaded_kws:
         return True
+    if st.session_state.run_type == "Full Run" and not st.session_state.get("sources"):
+        return True
 
     return False
 
@@ -214,15 +247,31 @@ with st.expander("**Run Settings**", expanded=st.session_state.valid_config and
     # If run type is filter, let them upload a file
     if st.session_state.run_type == "Filter":
         uploaded_file = st.file_uploader("Choose a CSV file", type=[
-                                         'csv'], help=FILE_UPLOAD_HELP)
-        # Read file content to a list
+                                         'csv'], help=FILE_UPLOAD_HELP, on_change=clear_uploaded_kws)
+        has_header = st.checkbox("File has a header row", on_change=clear_uploaded_kws)
+        kw_column = st.number_input("Keywords column", min_value=1, value=1, step=1,
+                                    help=KW_COLUMN_HELP, on_change=clear_uploaded_kws)
+        # Stream file content to a deduplicated spool file
         if uploaded_file and not st.session_state.uploaded_kws:
-            stringio = StringIO(uploaded_file.getvalue().decode("utf-8"))
-            for row in csv.reader(stringio):
-                if row:
-                    st.session_state.uploaded_kws.append(row[0])
+            ingestor = CsvIngestor(column=int(kw_column) - 1, has_header=has_header,
+                                   spool_dir=_UPLOAD_SPOOL_DIR)
+            spool = ingestor.ingest(uploaded_file)
+            # Sessions end without a callback, so the spool file goes once the
+            # session's state is collected. /tmp is memory on Cloud Run
+            weakref.finalize(spool, _delete_spool, spool.path)
+            st.session_state.uploaded_kws = spool
+        if st.session_state.uploaded_kws:
+            stats = st.session_state.uploaded_kws.stats
+            st.caption(f"{stats['keywords']} unique keywords loaded "
+                       f"({stats['keywords_per_second']:.0f} keywords/s)")
     else:
-        st.session_state.uploaded_kws = []
+        clear_uploaded_kws()
+        st.multiselect("Keyword sources", list(_SOURCE_OPTIONS), default=["Recommendations"],
+                       key="sources", help=SOURCES_HELP)
+
+    st.radio("Keywords blocked by negative keywords", list(_NEGATIVES_OPTIONS), index=0,
+             key="negatives", horizontal=True, help=NEGATIVES_HELP)
+    st.checkbox("Keyword overlap across accounts", key="overlap", help=OVERLAP_HELP)
 
 st.session_state.run_btn_clicked = st.button(
     "**Run**", type='primary', disabled=is_run_not_ready(), on_click=update_btn_state)
@@ -241,9 +290,11 @@ if st.session_state.run_btn_clicked:
         st.session_state.row_num = run_tool()
 
 if st.session_state.generation_finished:
-    st.success(f'Keyword generation completed successfully. [Open in Google Sheets]({config.spreadsheet_url})', icon="✅")
+    st.success(f'Keyword generation completed successfully. [Open in Google Sheets]({config.spreadsheet_url}) (tab "{st.session_state.run_sheet}")', icon="✅")
     
-    if not st.session_state.show_categorization_retry and not st.session_state.categorization_finished:
+    if st.session_state.row_num == 0:
+        st.warning(BUDGET_USED_TEXT)
+    elif not st.session_state.show_categorization_retry and not st.session_state.categorization_finished:
         with st.spinner(text='Running categorization engine... This may take a few minutes'):
             run_categorization(st.session_state.row_num)
 
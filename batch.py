@@ -0,0 +1,258 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs several MCCs as one batch on a shared, bounded worker pool.
+
+Every MCC is expanded into per-account work items (recommendations and
+existing keywords). Items from all MCCs are interleaved on one pool, with
+a per-MCC limit on in-flight API calls, so a batch takes about as long as
+its slowest account instead of the sum of all MCCs.
+
+The MCC file is a yaml file in the following format, where everything but
+login_customer_id is optional. spreadsheet_url is required for MCCs written
+to a sheet, scheduled runs update the same spreadsheet every time:
+
+  mccs:
+    - login_customer_id: 1234567890
+      spreadsheet_url: https://docs.google.com/spreadsheets/d/<id>/edit
+    - login_customer_id: 9876543210
+      account_ids: ['111', '222']
+    - login_customer_id: 5555555555
+      labels: ['brand']
+"""
+
+from utils.config import Config
+from utils.ads_searcher import MccBuilder, RecBuilder, KeywordRemover
+from utils.sheets import SheetsInteractor
+from utils.ingest import normalize_keyword
+from server import RunStats, write_to_csv
+from concurrent import futures
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+from yaml.loader import SafeLoader
+import logging
+import time
+import yaml
+import smart_open as smart_open
+
+_DEFAULT_MAX_WORKERS = 32
+_DEFAULT_PER_MCC_LIMIT = 8
+
+
+class MccJob:
+    """A single MCC in a batch run and the results collected for it.
+    Args:
+      config: Config of the MCC, see Config.for_mcc.
+      account_ids: Accounts to run on. All child accounts if empty.
+      labels: Run on the child accounts with any of these labels instead.
+      output: 'sheet' to write to the MCC's spreadsheet, or a local or gs://
+        CSV path. '{mcc}' in the path is replaced with the MCC ID.
+    """
+
+    def __init__(self, config: Config, account_ids: Optional[List[str]] = None,
+                 labels: Optional[List[str]] = None, output: str = 'sheet'):
+        self.config = config
+        self.mcc = str(config.login_customer_id)
+        self.account_ids = [str(a) for a in account_ids or []]
+        self.labels = labels or []
+        self.output = output.format(mcc=self.mcc)
+        self.stats = RunStats()
+        self.recommendations = []
+        self.existing = set()
+        self.remaining = 0
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.config.get_ads_client()
+        return self._client
+
+
+def load_mcc_jobs(path: str, base_config: Config, output: str = 'sheet') -> List[MccJob]:
+    """Reads an MCC file and returns a job per MCC, sharing base_config's credentials.
+    Raises ValueError if an MCC written to a sheet has no spreadsheet_url."""
+    with smart_open.open(path, 'rb') as f:
+        content = yaml.load(f.read(), Loader=SafeLoader) or {}
+    jobs = []
+    for entry in content.get('mccs', []):
+        # A new spreadsheet every run would pile up, and never have a previous
+        # sheet to diff against
+        if entry.get('output', output) == 'sheet' and not entry.get('spreadsheet_url'):
+            raise ValueError(f"MCC {entry['login_customer_id']} is written to a sheet "
+                             f"but has no spreadsheet_url in {path}")
+        config = base_config.for_mcc(entry['login_customer_id'],
+                                     entry.get('spreadsheet_url', ''))
+        jobs.append(MccJob(config,
+                           account_ids=entry.get('account_ids'),
+                           labels=entry.get('labels'),
+                           output=entry.get('output', output)))
+    return jobs
+
+
+class BatchOrchestrator:
+    """Schedules the work items of several MCCs on one global worker pool.
+
+    Scheduling happens on the calling thread: items are taken round robin
+    from per-MCC queues and only submitted while the pool has a free worker
+    and the MCC is below its in-flight limit, so no worker ever blocks
+    waiting for quota. Results are merged on the calling thread as well.
+
+    Args:
+      jobs: The MCCs to run.
+      run_type: Either "Full Run" or "Filter".
+      uploaded_kws: Keywords to filter on "Filter" runs. Iterated once per
+        MCC, so must be re-iterable, e.g. a list or a KeywordSpool.
+      max_workers: Size of the shared worker pool.
+      per_mcc_limit: Max number of in-flight API calls per MCC.
+    """
+
+    def __init__(self, jobs: List[MccJob], run_type: str = "Full Run",
+                 uploaded_kws: Iterable[str] = (),
+                 max_workers: int = _DEFAULT_MAX_WORKERS,
+                 per_mcc_limit: int = _DEFAULT_PER_MCC_LIMIT):
+        # The scheduling loop would never submit any work
+        if max_workers < 1:
+            raise ValueError(f"max_workers must be at least 1, got {max_workers}")
+        if per_mcc_limit < 1:
+            raise ValueError(f"per_mcc_limit must be at least 1, got {per_mcc_limit}")
+        self.jobs = jobs
+        self.run_type = run_type
+        self.uploaded_kws = uploaded_kws
+        self.max_workers = max_workers
+        self.per_mcc_limit = per_mcc_limit
+        self._queues = {job.mcc: deque() for job in jobs}
+        self._in_flight = {job.mcc: 0 for job in jobs}
+
+    def run(self) -> Dict[str, RunStats]:
+        """Runs all MCCs and returns their stats by MCC ID."""
+        for job in self.jobs:
+            self._queues[job.mcc].append(('accounts', None))
+
+        self._start = time.perf_counter()
+        running = {}
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while running or any(self._queues.values()):
+                self._dispatch(executor, running)
+                done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    job, stage, account = running.pop(future)
+                    self._in_flight[job.mcc] -= 1
+                    self._complete(job, stage, account, future)
+
+        return {job.mcc: job.stats for job in self.jobs}
+
+    def _dispatch(self, executor, running):
+        progress = True
+        while progress and len(running) < self.max_workers:
+            progress = False
+            for job in self.jobs:
+                queue = self._queues[job.mcc]
+                if not queue or self._in_flight[job.mcc] >= self.per_mcc_limit:
+                    continue
+                if len(running) >= self.max_workers:
+                    break
+                stage, account = queue.popleft()
+                future = executor.submit(self._work, job, stage, account)
+                running[future] = (job, stage, account)
+                self._in_flight[job.mcc] += 1
+                progress = True
+
+    def _work(self, job: MccJob, stage: str, account: Optional[str]):
+        """Runs a single work item on a pool thread."""
+        if stage == 'accounts':
+            return self._get_accounts(job)
+        if stage == 'recommendations':
+            return RecBuilder(job.client, account).build()
+        if stage == 'dedup':
+            return KeywordRemover(job.client, account).existing_keywords()
+        if stage == 'write':
+            return self._write(job)
+
+    def _complete(self, job: MccJob, stage: str, account: Optional[str], future):
+        """Merges a finished work item into its job and enqueues follow ups."""
+        queue = self._queues[job.mcc]
+        if stage != 'write':
+            job.stats.api_calls += 1
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.exception(e)
+            if account is None:
+                job.stats.errors.append(f"{stage}: {e}")
+            else:
+                job.stats.account_failed(account, stage, e)
+            result = None
+
+        if stage == 'write':
+            job.stats.timings['total'] = time.perf_counter() - self._start
+            return
+
+        if stage == 'accounts':
+            accounts = result or []
+            job.stats.accounts = len(accounts)
+            stages = ['dedup']
+            if self.run_type == "Full Run":
+                stages.insert(0, 'recommendations')
+            for account in accounts:
+                for account_stage in stages:
+                    queue.append((account_stage, account))
+            job.remaining = len(accounts) * len(stages)
+            if result is not None and not job.remaining:
+                queue.append(('write', None))
+            return
+
+        if stage == 'recommendations' and result:
+            job.recommendations += result
+        elif stage == 'dedup' and result:
+            # Compared like server.remove_keywords does
+            job.existing.update(normalize_keyword(kw) for kw in result)
+
+        if stage in ('recommendations', 'dedup'):
+            job.remaining -= 1
+            if not job.remaining:
+                queue.append(('write', None))
+
+    def _get_accounts(self, job: MccJob) -> List[str]:
+        if job.account_ids:
+            return job.account_ids
+        builder = MccBuilder(job.client)
+        if job.labels:
+            return builder.get_accounts_by_label(job.labels)
+        return builder.get_accounts()
+
+    def _write(self, job: MccJob) -> int:
+        """Dedups the MCC's keywords and writes them to its own output."""
+        if self.run_type == "Full Run":
+            kws = list(dict.fromkeys(job.recommendations))
+            job.stats.recommendations = len(kws)
+        else:
+            kws = self.uploaded_kws
+        kws = [kw for kw in kws if kw and normalize_keyword(kw) not in job.existing]
+        # Free memory early, other MCCs may still be running
+        job.recommendations = []
+        job.existing = set()
+
+        if job.output == 'sheet':
+            sheets_service = job.config.get_sheets_service()
+            # Scheduled runs mostly rewrite the same keywords, only apply what changed
+            SheetsInteractor(sheets_service, job.config.spreadsheet_url).write_to_sheet(
+                values=[[kw] for kw in kws], diff=True)
+            job.stats.output = job.config.spreadsheet_url
+        else:
+            write_to_csv(job.output, kws)
+            job.stats.output = job.output
+        job.stats.keywords = len(kws)
+        logging.info(f"MCC {job.mcc}: wrote {len(kws)} keywords to {job.stats.output}")
+        return len(kws)
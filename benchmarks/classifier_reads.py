@@ -0,0 +1,91 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the classifier function's single read of its input with ranged reads.
+
+The stand-in spreadsheet takes longer to answer larger reads, and every
+keyword takes a fixed time to "classify", so the harness reports the time
+to the first keyword and the total time of reading and classifying, for
+one values().get of the whole column and for parallel batchGet ranges
+consumed as they arrive. Run from the repo root:
+
+  python benchmarks/classifier_reads.py --keywords 100000 --workers 4
+"""
+
+from pathlib import Path
+import argparse
+import json
+import sys
+import time
+
+_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(_ROOT))
+sys.path.insert(0, str(_ROOT / 'classifier'))
+
+from benchmarks.standins import FakeSheetsService, _SPREADSHEET_URL  # noqa: E402
+from entities import SheetsInteractor  # noqa: E402
+
+
+def consume(chunks, classify_latency: float):
+    """Returns seconds to the first keyword and the number of keywords.
+    chunks is called for an iterable of chunks, the time it takes counts."""
+    start = time.perf_counter()
+    first = None
+    chunks = chunks()
+    count = 0
+    for chunk in chunks:
+        if first is None:
+            first = time.perf_counter() - start
+        time.sleep(classify_latency * len(chunk))
+        count += len(chunk)
+    return first, count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keywords', type=int, default=100000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help="Seconds every stand-in Sheets call takes.")
+    parser.add_argument('--row-latency', type=float, default=0.00002,
+                        help="Additional seconds per row a read returns.")
+    parser.add_argument('--classify-latency', type=float, default=0.00001,
+                        help="Seconds classifying a keyword takes.")
+    args = parser.parse_args(argv)
+
+    service = FakeSheetsService(latency=args.latency, row_latency=args.row_latency)
+    service.spreadsheet.tabs['Output'] = [['Keyword']] + [[f'kw {i}'] for i in range(args.keywords)]
+    interactor = SheetsInteractor(service, _SPREADSHEET_URL)
+
+    report = {'keywords': args.keywords}
+    start = time.perf_counter()
+    first, count = consume(
+        lambda: [[row[0] for row in interactor.read_from_spreadsheet('A2:A', 'Output')]],
+        args.classify_latency)
+    report['single_get'] = {'first_keyword_s': round(first, 3), 'keywords': count,
+                            'total_s': round(time.perf_counter() - start, 3)}
+
+    start = time.perf_counter()
+    first, count = consume(
+        lambda: interactor.iter_column('Output', new_service=lambda: service,
+                                       max_workers=args.workers),
+        args.classify_latency)
+    report['ranged_batch_get'] = {'first_keyword_s': round(first, 3), 'keywords': count,
+                                  'total_s': round(time.perf_counter() - start, 3)}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the cross-account keyword overlap on a large generated portfolio.
+
+Every account runs keywords drawn from a shared vocabulary with skewed
+popularity, so a few keywords are run by most accounts and most by a few.
+The harness reports the time of adding the accounts, of building the
+incidence matrix, of the overlap product and of the summary, and the peak
+memory of the process. The overlap of a small portfolio is checked against
+the intersections of its keyword sets. Run from the repo root:
+
+  python benchmarks/keyword_overlap.py --accounts 2000 --keywords-per-account 5000
+"""
+
+from pathlib import Path
+import argparse
+import json
+import resource
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.overlap import KeywordOverlap  # noqa: E402
+
+
+def account_keywords(rng, size: int, vocabulary: int):
+    ids = (vocabulary * rng.random(size) ** 3).astype(np.int64)
+    return [f'kw {i}' for i in ids.tolist()]
+
+
+def check(accounts: int, keywords_per_account: int, vocabulary: int) -> int:
+    """Returns the number of overlap cells differing from set intersections."""
+    rng = np.random.default_rng(1)
+    overlap = KeywordOverlap()
+    sets = []
+    for account in range(accounts):
+        kws = account_keywords(rng, int(rng.integers(0, 2 * keywords_per_account)), vocabulary)
+        sets.append(set(kws))
+        overlap.add(str(account), kws)
+    expected = np.array([[len(a & b) for b in sets] for a in sets])
+    return int(np.count_nonzero(overlap.overlap() != expected))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--accounts', type=int, default=2000)
+    parser.add_argument('--keywords-per-account', type=int, default=5000)
+    parser.add_argument('--vocabulary', type=int, default=5000000,
+                        help="Number of distinct keywords.")
+    args = parser.parse_args(argv)
+    rng = np.random.default_rng(0)
+
+    overlap = KeywordOverlap()
+    start = time.perf_counter()
+    for account in range(args.accounts):
+        overlap.add(str(1000 + account),
+                    account_keywords(rng, args.keywords_per_account, args.vocabulary))
+    add_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    criteria = overlap.criteria
+    build_s = time.perf_counter() - start
+    start = time.perf_counter()
+    matrix = overlap.overlap()
+    overlap_s = time.perf_counter() - start
+    start = time.perf_counter()
+    summary = overlap.summary(matrix)
+    summary_s = time.perf_counter() - start
+
+    print(json.dumps({
+        'accounts': args.accounts,
+        'criteria': criteria,
+        'keywords': overlap.keywords,
+        'shared_keywords': overlap.shared_keywords,
+        'add_s': round(add_s, 3),
+        'build_s': round(build_s, 3),
+        'overlap_s': round(overlap_s, 3),
+        'summary_s': round(summary_s, 3),
+        # Linux reports kilobytes
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+        'top_pair': summary[0] if summary else None,
+        'check_mismatches': check(60, 200, 2000),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
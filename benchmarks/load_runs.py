@@ -0,0 +1,102 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Drives N simultaneous sessions through server.run against local stand-ins.
+
+Every Streamlit session runs server.run on its own script thread of the
+same process, so the harness does the same with one thread per session,
+all sharing one stand-in spreadsheet. It reports throughput and latency,
+and checks that every run's output tab holds exactly its own keywords.
+Run from the repo root:
+
+  python benchmarks/load_runs.py --sessions 16 --latency 0.05
+"""
+
+from pathlib import Path
+from concurrent import futures
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.standins import FakeAdsClient, FakeConfig, FakeSheetsService  # noqa: E402
+import server  # noqa: E402
+
+
+def build_fixture(accounts: int, kws_per_account: int):
+    recommendations = {
+        str(1000 + a): [f'kw {a} {i}' for i in range(kws_per_account)]
+        for a in range(accounts)}
+    # Every account already runs a tenth of its recommendations
+    keywords = {account: kws[::10] for account, kws in recommendations.items()}
+    return recommendations, keywords
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=8)
+    parser.add_argument('--accounts', type=int, default=20)
+    parser.add_argument('--kws-per-account', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="Seconds every stand-in API call takes.")
+    args = parser.parse_args(argv)
+
+    # Leases fall back to local files when there's no GCS, keep them out of the repo
+    os.chdir(tempfile.mkdtemp())
+    recommendations, keywords = build_fixture(args.accounts, args.kws_per_account)
+    ads_client = FakeAdsClient(recommendations, keywords, latency=args.latency)
+    sheets_service = FakeSheetsService(latency=args.latency)
+    all_accounts = list(recommendations)
+
+    def session(i):
+        # Every session runs on a different slice of accounts
+        accounts = all_accounts[i % len(all_accounts):][:max(1, len(all_accounts) // 2)]
+        stats = server.RunStats()
+        start = time.perf_counter()
+        rows = server.run(FakeConfig(ads_client, sheets_service), accounts, "Full Run", stats=stats)
+        elapsed = time.perf_counter() - start
+        expected = [kw for account in accounts for kw in recommendations[account]
+                    if kw not in set(keywords[account])]
+        written = [row[0] for row in sheets_service.spreadsheet.tabs.get(stats.sheet, [])[1:]]
+        return {'seconds': elapsed, 'queued': stats.timings.get('queued', 0),
+                'rows': rows, 'isolated': sorted(written) == sorted(expected)}
+
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        results = list(executor.map(session, range(args.sessions)))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(r['seconds'] for r in results)
+    print(json.dumps({
+        'sessions': args.sessions,
+        'max_concurrent_runs': server._MAX_CONCURRENT_RUNS,
+        'wall_s': round(wall, 3),
+        'runs_per_s': round(args.sessions / wall, 3),
+        'p50_s': round(statistics.median(latencies), 3),
+        'p95_s': round(latencies[int(0.95 * (len(latencies) - 1))], 3),
+        'avg_queued_s': round(statistics.mean(r['queued'] for r in results), 3),
+        'isolated_runs': sum(r['isolated'] for r in results),
+        'ads_calls': ads_client.calls,
+        'sheets_calls': sheets_service.spreadsheet.calls,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures compiling negative keywords and matching keywords against them.
+
+Negatives of every match type and keywords are generated from a shared
+vocabulary, in accounts of a few campaigns and ad groups whose campaigns
+use some shared negative lists. A sample of the matches, and of whether
+keywords are blocked in every ad group, is checked against a brute force
+scan of all negatives. Run from the repo root:
+
+  python benchmarks/negative_conflicts.py --negatives 200000 --keywords 1000000
+"""
+
+from pathlib import Path
+import argparse
+import bisect
+import itertools
+import json
+import random
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.negatives import BROAD, EXACT, PHRASE, NegativeMatcher  # noqa: E402
+
+_VOCABULARY = [f'word{i}' for i in range(100000)]
+# Zipf word frequencies, so some words are in many negatives and keywords
+_CUM_WEIGHTS = list(itertools.accumulate(1 / (i + 1) for i in range(len(_VOCABULARY))))
+_SCOPES = ('campaign', 'ad group', 'shared set')
+_CAMPAIGNS = 5
+_AD_GROUPS = 20
+_SHARED_SETS = 3
+
+
+def _phrase(rng, words, skip=0):
+    # Common words below skip are drawn again
+    chosen = []
+    while len(chosen) < words:
+        word = bisect.bisect(_CUM_WEIGHTS, rng.random() * _CUM_WEIGHTS[-1])
+        if word >= skip:
+            chosen.append(_VOCABULARY[word])
+    return ' '.join(chosen)
+
+
+def _blocks(text, match_type, tokens):
+    negative = text.split()
+    if match_type == EXACT:
+        return negative == tokens
+    if match_type == PHRASE:
+        return any(tokens[i:i + len(negative)] == negative for i in range(len(tokens)))
+    return set(negative) <= set(tokens)
+
+
+def _blocked_everywhere(blocking, ad_groups, campaign_shared_sets):
+    # blocking: (account, scope, scope ID) of the negatives blocking a keyword
+    for account in ad_groups:
+        for campaign_id, ad_group_id in ad_groups[account]:
+            places = {('campaign', campaign_id), ('ad group', ad_group_id)}
+            places.update(('shared set', shared_set_id)
+                          for set_campaign_id, shared_set_id in campaign_shared_sets[account]
+                          if set_campaign_id == campaign_id)
+            if not any((account, *place) in blocking for place in places):
+                return False
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--negatives', type=int, default=200000)
+    parser.add_argument('--keywords', type=int, default=1000000)
+    parser.add_argument('--accounts', type=int, default=100)
+    parser.add_argument('--check', type=int, default=500,
+                        help="Keywords checked against a brute force scan.")
+    args = parser.parse_args(argv)
+    rng = random.Random(0)
+
+    accounts = [str(account) for account in range(args.accounts)]
+    ad_groups = {account: [(str(i % _CAMPAIGNS), str(i)) for i in range(_AD_GROUPS)]
+                 for account in accounts}
+    # The last shared list is used by no campaign
+    campaign_shared_sets = {account: [(str(campaign), str(rng.randrange(_SHARED_SETS - 1)))
+                                      for campaign in range(_CAMPAIGNS)]
+                            for account in accounts}
+    scope_ids = {'campaign': _CAMPAIGNS, 'ad group': _AD_GROUPS, 'shared set': _SHARED_SETS}
+    negatives = {}
+    for i in range(args.negatives):
+        scope = rng.choice(_SCOPES)
+        # Negatives skip the most common words, which nobody excludes
+        negative = (scope, str(rng.randrange(scope_ids[scope])),
+                    _phrase(rng, rng.randint(1, 3), skip=1000), (EXACT, PHRASE, BROAD)[i % 3])
+        negatives.setdefault(accounts[i % args.accounts], []).append(negative)
+    kws = [_phrase(rng, rng.randint(2, 5)) for _ in range(args.keywords)]
+
+    start = time.perf_counter()
+    matcher = NegativeMatcher()
+    for account, account_negatives in negatives.items():
+        matcher.add(account, account_negatives, ad_groups[account],
+                    campaign_shared_sets[account])
+    matcher.matches('')
+    add_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    conflicts = matcher.conflicts(kws)
+    match_s = time.perf_counter() - start
+
+    flat = [(account, *negative) for account, account_negatives in negatives.items()
+            for negative in account_negatives]
+    used_sets = {(account, shared_set_id) for account in accounts
+                 for _, shared_set_id in campaign_shared_sets[account]}
+    mismatches = 0
+    for kw, conflict in zip(kws[:args.check], conflicts):
+        tokens = kw.split()
+        blocking = {(account, scope, scope_id)
+                    for account, scope, scope_id, text, match_type in flat
+                    if (scope != 'shared set' or (account, scope_id) in used_sets)
+                    and _blocks(text, match_type, tokens)}
+        expected = (_blocked_everywhere(blocking, ad_groups, campaign_shared_sets)
+                    if blocking else None)
+        mismatches += expected != (conflict and conflict[1])
+    print(json.dumps({
+        'negatives': len(matcher),
+        'keywords': args.keywords,
+        'add_s': round(add_s, 3),
+        'match_s': round(match_s, 3),
+        'keywords_per_s': round(args.keywords / match_s),
+        'blocked_share': round(sum(c is not None for c in conflicts) / args.keywords, 4),
+        'blocked_everywhere_share': round(sum(bool(c and c[1]) for c in conflicts)
+                                          / args.keywords, 4),
+        'checked': min(args.check, args.keywords),
+        'mismatches': mismatches,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures building the ad group index and routing keywords with it.
+
+Existing keywords are generated per ad group from a topic word and a shared
+vocabulary, new keywords reuse a topic word, so the expected ad group of
+every new keyword is known. Run from the repo root:
+
+  python benchmarks/route_keywords.py --criteria 1000000 --keywords 1000000
+"""
+
+from pathlib import Path
+import argparse
+import json
+import random
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.routing import AdGroupIndex  # noqa: E402
+
+_VOCABULARY = [f'word{i}' for i in range(5000)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--criteria', type=int, default=1000000)
+    parser.add_argument('--keywords', type=int, default=1000000)
+    parser.add_argument('--ad-groups', type=int, default=50000)
+    parser.add_argument('--accounts', type=int, default=100)
+    args = parser.parse_args(argv)
+    rng = random.Random(0)
+
+    def topic(ad_group):
+        return f'topic{ad_group}'
+
+    criteria = {}
+    for i in range(args.criteria):
+        ad_group = i % args.ad_groups
+        text = f'{topic(ad_group)} {rng.choice(_VOCABULARY)} {rng.choice(_VOCABULARY)}'
+        criteria.setdefault(ad_group % args.accounts, []).append((str(ad_group), text))
+    expected = [rng.randrange(args.ad_groups) for _ in range(args.keywords)]
+    kws = [f'{rng.choice(_VOCABULARY)} {topic(ad_group)} new' for ad_group in expected]
+
+    start = time.perf_counter()
+    index = AdGroupIndex()
+    for account, account_criteria in criteria.items():
+        index.add(str(account), account_criteria)
+    add_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    routes = index.route(kws)
+    route_s = time.perf_counter() - start
+
+    correct = sum(route is not None and route[1] == str(ad_group)
+                  for route, ad_group in zip(routes, expected))
+    print(json.dumps({
+        'criteria': args.criteria,
+        'ad_groups': len(index),
+        'keywords': args.keywords,
+        'add_s': round(add_s, 3),
+        'route_s': round(route_s, 3),
+        'keywords_per_s': round(args.keywords / route_s),
+        'correct_share': round(correct / args.keywords, 4),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streams generated search_term_view rows through the search terms source.
+
+Every account streams skewed search terms from a large vocabulary, so most
+terms are rare and a few get most clicks. Throughput is measured on a plain
+run, peak memory on a second run traced with tracemalloc, next to keeping
+all rows in a list. The candidates are checked against exact sums. Run from
+the repo root:
+
+  python benchmarks/search_terms.py --accounts 10 --rows-per-account 200000
+"""
+
+from collections import defaultdict
+from pathlib import Path
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.standins import FakeAdsClient  # noqa: E402
+import server  # noqa: E402
+
+
+def account_rows(account: int, rows: int, vocabulary: int):
+    """Returns a generator function of an account's rows, the same on every call."""
+    def generate():
+        rng = random.Random(account)
+        for _ in range(rows):
+            term = int(vocabulary * rng.random() ** 3)
+            clicks = rng.randint(1, 3)
+            yield f'term {term}', clicks, 1.0 if rng.random() < 0.05 else 0.0
+    return generate
+
+
+def traced_peak_mb(fn) -> float:
+    tracemalloc.start()
+    try:
+        fn()
+        return round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+    finally:
+        tracemalloc.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--accounts', type=int, default=10)
+    parser.add_argument('--rows-per-account', type=int, default=200000)
+    parser.add_argument('--vocabulary', type=int, default=2000000,
+                        help="Number of distinct search terms.")
+    parser.add_argument('--capacity', type=int, default=server._SEARCH_TERMS_CAPACITY)
+    args = parser.parse_args(argv)
+    server._SEARCH_TERMS_CAPACITY = args.capacity
+
+    search_terms = {str(1000 + a): account_rows(a, args.rows_per_account, args.vocabulary)
+                    for a in range(args.accounts)}
+    client = FakeAdsClient({}, search_terms=search_terms)
+    accounts = list(search_terms)
+
+    stats = server.RunStats()
+    start = time.perf_counter()
+    kws = server.get_search_terms(client, accounts, stats=stats)
+    elapsed = time.perf_counter() - start
+    peak_mb = traced_peak_mb(lambda: server.get_search_terms(client, accounts))
+    list_peak_mb = traced_peak_mb(
+        lambda: [row for rows in search_terms.values() for row in rows()])
+
+    exact = defaultdict(lambda: [0, 0.0])
+    for rows in search_terms.values():
+        for term, clicks, conversions in rows():
+            exact[term][0] += clicks
+            exact[term][1] += conversions
+    expected = {term for term, (clicks, conversions) in exact.items()
+                if clicks >= server._SEARCH_TERMS_MIN_CLICKS
+                and conversions >= server._SEARCH_TERMS_MIN_CONVERSIONS}
+    # Sums are short by at most the error, so these pass whatever the compactions dropped
+    error = stats.sources['search_terms']['clicks_error']
+    certain = {term for term in expected
+               if exact[term][0] > error
+               and exact[term][0] - error >= server._SEARCH_TERMS_MIN_CLICKS}
+    print(json.dumps({
+        'rows': args.accounts * args.rows_per_account,
+        'seconds': round(elapsed, 3),
+        'source': stats.sources['search_terms'],
+        'traced_peak_mb': peak_mb,
+        'list_of_rows_peak_mb': list_peak_mb,
+        'distinct_terms': len(exact),
+        'candidates': len(kws),
+        'expected_candidates': len(expected),
+        'recall': round(len(expected & set(kws)) / max(1, len(expected)), 4),
+        'recall_above_error_bound': round(len(certain & set(kws)) / max(1, len(certain)), 4),
+        'precision': round(len(expected & set(kws)) / max(1, len(kws)), 4),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,587 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand-ins for the Google Ads client, Sheets service and Config.
+
+They implement just the calls the app makes, keep everything in memory and
+can add a fixed latency per call, so pipelines can be driven and measured
+without credentials or network access.
+
+Keyword creates, through batch jobs or validate_only mutates, fail with the
+API's errors for text that is too long, has too many words or invalid
+characters, or targets an unknown ad group.
+"""
+
+from types import SimpleNamespace
+import re
+import threading
+import time
+
+_SPREADSHEET_URL = 'https://docs.google.com/spreadsheets/d/standin/edit'
+
+
+class _Row(SimpleNamespace):
+    """A search_stream row, exposing the same fields with and without _pb."""
+
+    @property
+    def _pb(self):
+        return self
+
+
+def _keyword_row(text, ad_group_id):
+    return _Row(ad_group=SimpleNamespace(id=ad_group_id),
+                ad_group_criterion=SimpleNamespace(keyword=SimpleNamespace(text=text)))
+
+
+def _negative_row(scope, scope_id, text, match_type):
+    resource, criterion = {'campaign': ('campaign', 'campaign_criterion'),
+                           'ad group': ('ad_group', 'ad_group_criterion'),
+                           'shared set': ('shared_set', 'shared_criterion')}[scope]
+    keyword = SimpleNamespace(text=text, match_type=SimpleNamespace(name=match_type))
+    return _Row(**{resource: SimpleNamespace(id=scope_id),
+                   criterion: SimpleNamespace(keyword=keyword)})
+
+
+def _seed_keyword_row(text):
+    return _Row(ad_group_criterion=SimpleNamespace(keyword=SimpleNamespace(text=text)))
+
+
+def _landing_page_row(url):
+    return _Row(landing_page_view=SimpleNamespace(unexpanded_final_url=url))
+
+
+def _search_term_row(term, clicks, conversions):
+    return _Row(search_term_view=SimpleNamespace(search_term=term),
+                metrics=SimpleNamespace(clicks=clicks, conversions=conversions))
+
+
+def _search_term_batches(rows, batch_size):
+    """Builds batches as they're read, so streams of any size fit in memory."""
+    batch = []
+    for row in rows:
+        batch.append(_search_term_row(*row))
+        if len(batch) == batch_size:
+            yield SimpleNamespace(results=batch)
+            batch = []
+    if batch:
+        yield SimpleNamespace(results=batch)
+
+
+def _recommendation_row(text):
+    return _Row(recommendation=SimpleNamespace(
+        keyword_recommendation=SimpleNamespace(keyword=SimpleNamespace(text=text))))
+
+
+def _account_row(account):
+    return _Row(customer_client=SimpleNamespace(id=int(account), descriptive_name=f'Account {account}'))
+
+
+class _Message:
+    """A proto message stand-in, nested messages are created on first access."""
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = _Message()
+        setattr(self, name, value)
+        return value
+
+    @staticmethod
+    def deserialize(value):
+        # Stand-in failures are stored as they are instead of serialized
+        return value
+
+
+class _Enum:
+    def __init__(self, names=None):
+        self._names = names
+
+    def __getattr__(self, name):
+        return self[name]
+
+    def __getitem__(self, name):
+        if self._names is not None and name not in self._names:
+            raise KeyError(name)
+        return name
+
+
+_ENUMS = {'KeywordMatchTypeEnum': _Enum(('EXACT', 'PHRASE', 'BROAD'))}
+_MAX_KEYWORD_LENGTH = 80
+_MAX_KEYWORD_WORDS = 10
+_INVALID_KEYWORD_CHARS = set('!@%^*()={};~`<>?\\|,')
+
+
+def _criterion_error(client, criterion):
+    """Returns the error creating an ad group keyword would fail with, if any."""
+    text = criterion.keyword.text
+    if len(text) > _MAX_KEYWORD_LENGTH:
+        return 'The keyword text is too long.'
+    if len(text.split()) > _MAX_KEYWORD_WORDS:
+        return 'The keyword text has too many words.'
+    if _INVALID_KEYWORD_CHARS & set(text):
+        return 'The keyword text has invalid characters or symbols.'
+    ad_group_id = criterion.ad_group.rsplit('/', 1)[-1]
+    if client.ad_groups is not None and ad_group_id not in client.ad_groups:
+        return 'The resource was not found.'
+    return None
+
+
+class FakeAdGroupService:
+    @staticmethod
+    def ad_group_path(customer_id, ad_group_id):
+        return f'customers/{customer_id}/adGroups/{ad_group_id}'
+
+
+class _FakeOperation:
+    """A long-running operation that completes after a fixed time."""
+
+    def __init__(self, seconds):
+        self._done_at = time.monotonic() + seconds
+
+    def done(self):
+        return time.monotonic() >= self._done_at
+
+
+class FakeBatchJobService:
+    def __init__(self, client):
+        self._client = client
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _call(self):
+        time.sleep(self._client.latency)
+        with self._lock:
+            self._client.calls += 1
+
+    def mutate_batch_job(self, customer_id, operation):
+        self._call()
+        with self._lock:
+            resource_name = f'customers/{customer_id}/batchJobs/{len(self._jobs) + 1}'
+            self._jobs[resource_name] = {'operations': [], 'running': False}
+        return SimpleNamespace(result=SimpleNamespace(resource_name=resource_name))
+
+    def add_batch_job_operations(self, resource_name, sequence_token, mutate_operations):
+        self._call()
+        job = self._jobs[resource_name]
+        if job['running']:
+            raise ValueError(f'{resource_name} is already running')
+        expected = str(len(job['operations'])) if job['operations'] else None
+        if (sequence_token or None) != expected:
+            raise ValueError(f'Invalid sequence token {sequence_token}')
+        job['operations'].extend(mutate_operations)
+        return SimpleNamespace(next_sequence_token=str(len(job['operations'])),
+                               total_operations=len(job['operations']))
+
+    def run_batch_job(self, resource_name):
+        self._call()
+        job = self._jobs[resource_name]
+        job['running'] = True
+        return _FakeOperation(self._client.batch_job_seconds)
+
+    def list_batch_job_results(self, resource_name, page_size=1000):
+        job = self._jobs[resource_name]
+        for start in range(0, len(job['operations']), page_size):
+            self._call()
+            for index, operation in enumerate(job['operations'][start:start + page_size],
+                                              start=start):
+                error = _criterion_error(
+                    self._client, operation.ad_group_criterion_operation.create)
+                yield SimpleNamespace(operation_index=index, status=SimpleNamespace(
+                    code=3 if error else 0, message=error or ''))
+
+
+class _FakeIdeasPager:
+    """Pager of GenerateKeywordIdeas responses, iterating ideas or pages."""
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def __iter__(self):
+        return (idea for page in self.pages for idea in page.results)
+
+
+class FakeKeywordPlanIdeaService:
+    """Generates ideas_per_seed ideas per seed keyword or URL, in pages."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def generate_keyword_ideas(self, request):
+        return _FakeIdeasPager(self._pages(request))
+
+    def _pages(self, request):
+        client = self._client
+        seeds = list(request.keyword_seed.keywords) or [request.url_seed.url]
+        ideas = [SimpleNamespace(text=f'{seed} idea {i}')
+                 for seed in seeds for i in range(client.ideas_per_seed)]
+        with client.lock:
+            client.idea_requests += 1
+            client.ideas_in_flight += 1
+            client.max_ideas_in_flight = max(client.max_ideas_in_flight, client.ideas_in_flight)
+        try:
+            for start in range(0, max(len(ideas), 1), client.ideas_page_size):
+                time.sleep(client.latency)
+                with client.lock:
+                    client.calls += 1
+                yield SimpleNamespace(results=ideas[start:start + client.ideas_page_size])
+        finally:
+            with client.lock:
+                client.ideas_in_flight -= 1
+
+
+class FakeGoogleAdsService:
+    def __init__(self, client):
+        self._client = client
+
+    def mutate(self, customer_id, mutate_operations, partial_failure=False, validate_only=False):
+        time.sleep(self._client.latency)
+        self._client.calls += 1
+        errors = []
+        for index, operation in enumerate(mutate_operations):
+            error = _criterion_error(self._client, operation.ad_group_criterion_operation.create)
+            if error:
+                errors.append(SimpleNamespace(message=error, location=SimpleNamespace(
+                    field_path_elements=[SimpleNamespace(index=index)])))
+        if errors and not partial_failure:
+            raise ValueError(errors[0].message)
+        if not validate_only:
+            raise NotImplementedError('Only validate_only mutates are supported')
+        details = [SimpleNamespace(value=SimpleNamespace(errors=errors))] if errors else []
+        return SimpleNamespace(partial_failure_error=SimpleNamespace(details=details))
+
+    def search_stream(self, request):
+        client = self._client
+        time.sleep(client.latency)
+        customer_id = str(request.customer_id)
+        client.calls += 1
+        if 'FROM customer_client' in request.query:
+            rows = [_account_row(a) for a in client.recommendations]
+        elif 'FROM search_term_view' in request.query:
+            rows = client.search_terms.get(customer_id, ())
+            return _search_term_batches(rows() if callable(rows) else rows, client.batch_size)
+        elif 'FROM keyword_view' in request.query:
+            limit = int(re.search(r'LIMIT (\d+)', request.query).group(1))
+            # Existing keywords are listed from the most clicked one
+            rows = [_seed_keyword_row(kw) for kw in client.keywords.get(customer_id, [])[:limit]]
+        elif 'FROM landing_page_view' in request.query:
+            limit = int(re.search(r'LIMIT (\d+)', request.query).group(1))
+            rows = [_landing_page_row(url)
+                    for url in client.landing_pages.get(customer_id, [])[:limit]]
+        elif 'FROM recommendation' in request.query:
+            rows = [_recommendation_row(kw) for kw in client.recommendations.get(customer_id, [])]
+        elif 'negative = TRUE' in request.query or 'FROM shared_criterion' in request.query:
+            scope = ('campaign' if 'FROM campaign_criterion' in request.query
+                     else 'ad group' if 'FROM ad_group_criterion' in request.query
+                     else 'shared set')
+            rows = [_negative_row(*negative) for negative in client.negatives.get(customer_id, [])
+                    if negative[0] == scope]
+        elif re.search(r'FROM ad_group\s', request.query):
+            rows = [_Row(campaign=SimpleNamespace(id=campaign_id),
+                         ad_group=SimpleNamespace(id=ad_group_id))
+                    for campaign_id, ad_group_id in client.account_ad_groups(customer_id)]
+        elif 'FROM campaign_shared_set' in request.query:
+            rows = [_Row(campaign=SimpleNamespace(id=campaign_id),
+                         shared_set=SimpleNamespace(id=shared_set_id))
+                    for campaign_id, shared_set_id in client.account_shared_sets(customer_id)]
+        elif 'FROM ad_group_criterion' in request.query:
+            rows = [_keyword_row(kw, i % client.ad_groups_per_account)
+                    for i, kw in enumerate(client.keywords.get(customer_id, []))]
+            # Like the API, ad group negatives are criteria too unless filtered out
+            if 'negative = FALSE' not in request.query:
+                rows += [_keyword_row(text, scope_id) for scope, scope_id, text, _
+                         in client.negatives.get(customer_id, []) if scope == 'ad group']
+        else:
+            rows = []
+        batch_size = client.batch_size
+        return [SimpleNamespace(results=rows[i:i + batch_size])
+                for i in range(0, len(rows), batch_size)]
+
+
+class FakeAdsClient:
+    """Serves fixed recommendations and existing keywords per account.
+    Args:
+      recommendations: Recommended keywords by account ID.
+      keywords: Existing keywords by account ID.
+      latency: Seconds every API call takes.
+      ad_groups: IDs of the ad groups keywords can be created in, any if None.
+      ad_groups_per_account: Existing keywords are spread round robin over
+        this many ad groups, with IDs from 0.
+      negatives: Negative keywords by account ID, as (scope, scope ID, text,
+        match type) with scope one of 'campaign', 'ad group', 'shared set'.
+      campaigns_per_account: Ad group i is in campaign i % this.
+      campaign_shared_sets: (campaign ID, shared set ID) by account ID. By
+        default every campaign uses every shared set of the account's
+        negatives.
+      batch_job_seconds: Seconds a batch job takes to run once started.
+      landing_pages: Landing page URLs by account ID, from the most clicked.
+      ideas_per_seed: Keyword ideas generated per seed keyword or URL.
+      ideas_page_size: Keyword ideas per page of a response, every page
+        takes latency seconds.
+      search_terms: search_term_view rows by account ID, as (term, clicks,
+        conversions). A callable value is called for a fresh iterable of
+        rows on every query, e.g. a generator function for large streams.
+    """
+
+    def __init__(self, recommendations, keywords=None, latency=0.0,
+                 login_customer_id='1', batch_size=10000, ad_groups=None,
+                 batch_job_seconds=0.0, ad_groups_per_account=10, negatives=None,
+                 landing_pages=None, ideas_per_seed=10, ideas_page_size=1000,
+                 search_terms=None, campaigns_per_account=2, campaign_shared_sets=None):
+        self.recommendations = {str(k): v for k, v in recommendations.items()}
+        self.keywords = {str(k): v for k, v in (keywords or {}).items()}
+        self.latency = latency
+        self.login_customer_id = login_customer_id
+        self.batch_size = batch_size
+        self.ad_groups = None if ad_groups is None else {str(a) for a in ad_groups}
+        self.batch_job_seconds = batch_job_seconds
+        self.ad_groups_per_account = ad_groups_per_account
+        self.negatives = {str(k): v for k, v in (negatives or {}).items()}
+        self.campaigns_per_account = campaigns_per_account
+        self.campaign_shared_sets = (None if campaign_shared_sets is None else
+                                     {str(k): v for k, v in campaign_shared_sets.items()})
+        self.landing_pages = {str(k): v for k, v in (landing_pages or {}).items()}
+        self.ideas_per_seed = ideas_per_seed
+        self.search_terms = {str(k): v for k, v in (search_terms or {}).items()}
+        self.ideas_page_size = ideas_page_size
+        self.idea_requests = 0
+        self.ideas_in_flight = 0
+        self.max_ideas_in_flight = 0
+        self.lock = threading.Lock()
+        self.enums = SimpleNamespace(**{name: _ENUMS.get(name, _Enum()) for name in (
+            'KeywordMatchTypeEnum', 'AdGroupCriterionStatusEnum', 'KeywordPlanNetworkEnum')})
+        self.calls = 0
+        self._batch_job_service = FakeBatchJobService(self)
+
+    def account_ad_groups(self, customer_id):
+        """Returns the account's (campaign ID, ad group ID) pairs."""
+        return [(i % self.campaigns_per_account, i) for i in range(self.ad_groups_per_account)]
+
+    def account_shared_sets(self, customer_id):
+        """Returns the account's (campaign ID, shared set ID) pairs."""
+        if self.campaign_shared_sets is not None:
+            return self.campaign_shared_sets.get(customer_id, [])
+        shared_sets = dict.fromkeys(negative[1] for negative in self.negatives.get(customer_id, [])
+                                    if negative[0] == 'shared set')
+        return [(campaign_id, shared_set_id) for campaign_id in range(self.campaigns_per_account)
+                for shared_set_id in shared_sets]
+
+    def get_type(self, name):
+        if name == 'GenerateKeywordIdeasRequest':
+            # Repeated fields are lists
+            return SimpleNamespace(geo_target_constants=[], url_seed=SimpleNamespace(url=''),
+                                   keyword_seed=SimpleNamespace(keywords=[]))
+        return _Message()
+
+    def get_service(self, name):
+        if name == 'BatchJobService':
+            return self._batch_job_service
+        if name == 'AdGroupService':
+            return FakeAdGroupService()
+        if name == 'KeywordPlanIdeaService':
+            return FakeKeywordPlanIdeaService(self)
+        return FakeGoogleAdsService(self)
+
+
+class _Request:
+    def __init__(self, fn, latency):
+        self._fn = fn
+        self._latency = latency
+
+    def execute(self):
+        time.sleep(self._latency)
+        return self._fn()
+
+
+def _column_index(letters):
+    index = 0
+    for char in letters:
+        index = index * 26 + ord(char) - 64
+    return index - 1
+
+
+class FakeSpreadsheet:
+    """Tabs of a single spreadsheet, each one a list of rows."""
+
+    def __init__(self, latency=0.0, row_latency=0.0):
+        self.latency = latency
+        self.row_latency = row_latency
+        self.tabs = {'Output': []}
+        self.calls = 0
+        self._next_sheet_id = 1
+        self._sheet_ids = {'Output': 0}
+        self._lock = threading.Lock()
+
+    def _request(self, fn):
+        with self._lock:
+            self.calls += 1
+        return _Request(fn, self.latency)
+
+    def _parse_range(self, range):
+        tab, _, cells = range.partition('!')
+        match = re.match(r'([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?$', cells or 'A1')
+        start_col, start_row, end_col, end_row = match.groups()
+        start_row = int(start_row or 1) - 1
+        end_row = int(end_row) if end_row else None
+        return (tab.strip("'"), start_row, end_row,
+                _column_index(start_col), _column_index(end_col or start_col))
+
+    # spreadsheets() API
+    def values(self):
+        return self
+
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        def fn():
+            tab, start_row, _, start_col, _ = self._parse_range(range)
+            with self._lock:
+                rows = self.tabs.setdefault(tab, [])
+                for i, row in enumerate(body['values']):
+                    while len(rows) <= start_row + i:
+                        rows.append([])
+                    # Only the range's cells change, like the API
+                    cells = rows[start_row + i]
+                    cells += [''] * (start_col + len(row) - len(cells))
+                    cells[start_col:start_col + len(row)] = row
+            return {}
+        return self._request(fn)
+
+    def get(self, spreadsheetId, range=None, fields=None, valueRenderOption=None):
+        if range is None:
+            def sheets():
+                with self._lock:
+                    # New tabs have 1000 rows, writes past the end add rows
+                    return {'sheets': [{'properties': {
+                        'title': t, 'sheetId': self._sheet_ids[t],
+                        'gridProperties': {'rowCount': max(len(rows), 1000)}}}
+                        for t, rows in self.tabs.items()]}
+            return self._request(sheets)
+
+        return self._request(lambda: self._read(range))
+
+    def batchGet(self, spreadsheetId, ranges):
+        return self._request(lambda: {'valueRanges': [self._read(r) for r in ranges]})
+
+    def _read(self, range):
+        tab, start_row, end_row, start_col, end_col = self._parse_range(range)
+        with self._lock:
+            rows = self.tabs.get(tab, [])[start_row:end_row]
+            values = [row[start_col:end_col + 1] for row in rows]
+        while values and not values[-1]:
+            values.pop()
+        # Large responses take longer to transfer
+        time.sleep(self.row_latency * len(values))
+        return {'range': range, 'values': values}
+
+    def clear(self, spreadsheetId, range, body):
+        def fn():
+            tab = self._parse_range(range)[0]
+            with self._lock:
+                self.tabs[tab] = []
+            return {}
+        return self._request(fn)
+
+    def batchUpdate(self, spreadsheetId, body):
+        def fn():
+            with self._lock:
+                replies = []
+                for request in body['requests']:
+                    if 'addSheet' in request:
+                        title = request['addSheet']['properties']['title']
+                        if title in self.tabs:
+                            raise ValueError(f'Tab {title} already exists')
+                        self.tabs[title] = []
+                        self._sheet_ids[title] = self._next_sheet_id
+                        self._next_sheet_id += 1
+                        replies.append({'addSheet': {'properties': {
+                            'title': title, 'sheetId': self._sheet_ids[title]}}})
+                    elif 'deleteSheet' in request:
+                        sheet_id = request['deleteSheet']['sheetId']
+                        title = next(t for t, i in self._sheet_ids.items() if i == sheet_id)
+                        del self.tabs[title]
+                        del self._sheet_ids[title]
+                        replies.append({})
+                    else:
+                        self._apply(request)
+                        replies.append({})
+                return {'replies': replies}
+        return self._request(fn)
+
+
+    def _apply(self, request):
+        """Applies a cell or row request, holding the lock."""
+        def values(row_data):
+            row = [cell.get('userEnteredValue', {}) for cell in row_data['values']]
+            row = [next(iter(value.values()), '') for value in row]
+            while row and row[-1] == '':
+                row.pop()
+            return row
+
+        kind, params = next(iter(request.items()))
+        if kind == 'updateCells':
+            start = params['start']
+            rows = self._tab(start['sheetId'])
+            for i, row_data in enumerate(params['rows'], start=start['rowIndex']):
+                while len(rows) <= i:
+                    rows.append([])
+                rows[i] = values(row_data)
+        elif kind == 'deleteDimension':
+            range = params['range']
+            del self._tab(range['sheetId'])[range['startIndex']:range['endIndex']]
+        elif kind == 'appendCells':
+            rows = self._tab(params['sheetId'])
+            while rows and not rows[-1]:
+                rows.pop()
+            rows.extend(values(row_data) for row_data in params['rows'])
+        else:
+            raise NotImplementedError(kind)
+
+    def _tab(self, sheet_id):
+        return self.tabs[next(t for t, i in self._sheet_ids.items() if i == sheet_id)]
+
+
+class FakeSheetsService:
+    """Serves a single in-memory spreadsheet.
+    Args:
+      latency: Seconds every API call takes.
+      row_latency: Additional seconds per row a read returns.
+    """
+
+    def __init__(self, latency=0.0, row_latency=0.0):
+        self.spreadsheet = FakeSpreadsheet(latency, row_latency)
+
+    def spreadsheets(self):
+        return self.spreadsheet
+
+
+class FakeConfig:
+    """Config stand-in handing out the given clients."""
+
+    def __init__(self, ads_client, sheets_service):
+        self._ads_client = ads_client
+        self._sheets_service = sheets_service
+        self.spreadsheet_url = _SPREADSHEET_URL
+        self.login_customer_id = ads_client.login_customer_id
+        self.file_path = 'config.yaml'
+        self.valid_config = True
+
+    def get_ads_client(self):
+        return self._ads_client
+
+    def get_sheets_service(self):
+        return self._sheets_service
+
+    def load_config_from_file(self, ok_if_not_exists=False):
+        return {'spreadsheet_url': self.spreadsheet_url}
+
+    def save_to_file(self):
+        pass
@@ -0,0 +1,84 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures cold start of the web app backend and the classifier function.
+
+Every target runs in a fresh interpreter, so nothing is cached between
+measurements. For each target it reports the import time of the entry
+module and the latency of the first request's setup work, e.g. loading
+the config or creating the language client. Run from the repo root:
+
+  python benchmarks/startup.py --repeat 5
+"""
+
+from pathlib import Path
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+_ROOT = Path(__file__).resolve().parent.parent
+
+# Every target is (working dir, import statement, first request statement)
+_TARGETS = {
+    'server': (_ROOT, 'import server',
+               'from utils.config import Config; Config(ok_if_not_exists=True)'),
+    'cli': (_ROOT, 'import cli', 'cli.parse_args(["--no-classify", "--output", "out.csv"])'),
+    'classifier': (_ROOT / 'classifier', 'import main', 'main.get_classifier()'),
+}
+
+_PROBE = '''
+import json, time
+start = time.perf_counter()
+{import_stmt}
+imported = time.perf_counter()
+error = None
+try:
+    {first_request_stmt}
+except Exception as e:
+    error = repr(e)
+done = time.perf_counter()
+print(json.dumps({{"import": imported - start, "first_request": done - imported, "error": error}}))
+'''
+
+
+def measure(target: str):
+    cwd, import_stmt, first_request_stmt = _TARGETS[target]
+    probe = _PROBE.format(import_stmt=import_stmt, first_request_stmt=first_request_stmt)
+    output = subprocess.run([sys.executable, '-c', probe], cwd=cwd,
+                            capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--targets', nargs='+', choices=list(_TARGETS), default=list(_TARGETS))
+    args = parser.parse_args(argv)
+
+    report = {}
+    for target in args.targets:
+        runs = [measure(target) for _ in range(args.repeat)]
+        report[target] = {
+            'import_s': round(statistics.median(r['import'] for r in runs), 4),
+            'first_request_s': round(statistics.median(r['first_request'] for r in runs), 4),
+            'errors': sorted({r['error'] for r in runs if r['error']}),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
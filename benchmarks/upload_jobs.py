@@ -0,0 +1,83 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Drives KeywordUploader against the stand-in batch job service.
+
+Uploads generated keywords for several accounts, a share of them invalid,
+and checks that exactly the invalid ones are reported as failed, both for
+a real and a dry run. Run from the repo root:
+
+  python benchmarks/upload_jobs.py --accounts 10 --kws-per-account 20000
+"""
+
+from pathlib import Path
+import argparse
+import json
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.standins import FakeAdsClient  # noqa: E402
+from upload import KeywordUploader  # noqa: E402
+
+
+def build_rows(accounts: int, kws_per_account: int, invalid_every: int):
+    rows = []
+    for a in range(accounts):
+        for i in range(kws_per_account):
+            invalid = invalid_every and i % invalid_every == 0
+            rows.append({'customer_id': str(1000 + a), 'ad_group_id': str(i % 50),
+                         'keyword': f'kw {a} {i}' + ('!' if invalid else ''),
+                         'match_type': ('EXACT', 'PHRASE', 'BROAD')[i % 3]})
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--accounts', type=int, default=10)
+    parser.add_argument('--kws-per-account', type=int, default=20000)
+    parser.add_argument('--invalid-every', type=int, default=100,
+                        help="Every n-th keyword has invalid characters.")
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="Seconds every stand-in API call takes.")
+    parser.add_argument('--job-seconds', type=float, default=0.5,
+                        help="Seconds every stand-in batch job takes to run.")
+    args = parser.parse_args(argv)
+
+    rows = build_rows(args.accounts, args.kws_per_account, args.invalid_every)
+    expected_failures = sum(row['keyword'].endswith('!') for row in rows)
+    report = {}
+    for dry_run in (False, True):
+        client = FakeAdsClient({}, latency=args.latency, batch_job_seconds=args.job_seconds)
+        uploader = KeywordUploader(client, dry_run=dry_run, poll_interval=0.1)
+        start = time.perf_counter()
+        stats = uploader.upload(rows)
+        elapsed = time.perf_counter() - start
+        report['dry_run' if dry_run else 'upload'] = {
+            'operations': stats.operations,
+            'ops_per_s': round(stats.operations / elapsed),
+            'seconds': round(elapsed, 3),
+            'jobs': stats.jobs,
+            'api_calls': client.calls,
+            'failures_match': len(stats.failures) == expected_failures
+                              and stats.succeeded == len(rows) - expected_failures,
+            'timings': stats.to_dict()['timings'],
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
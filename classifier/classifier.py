@@ -14,39 +14,100 @@
 
 from google.cloud import language_v1
 from google.api_core.exceptions import ResourceExhausted
+from prefilter import prefilter
+from singleflight import SingleFlight
 from time import sleep
 import logging 
 
 # Given 600 max words per minute, 60 minutes timeout, 30K should take ~50 minutes with some spare.
 _MAX_KW_CAT = 30000
+# classify_text calls of the instance's concurrent requests, keyed by (keyword, language, model)
+_nlp_flight = SingleFlight('nlp')
 
 class Classifier():
-    def __init__(self):
-        self.client = language_v1.LanguageServiceClient()
+    def __init__(self, client=None):
+        # Creating a client is slow, so callers should pass a shared one
+        self.client = client or language_v1.LanguageServiceClient()
         self.type_ = language_v1.Document.Type.PLAIN_TEXT
         self.content_categories_version = (
         language_v1.ClassificationModelOptions.V2Model.ContentCategoriesVersion.V2
     )
-        
-    def classify_list(self, kw_list, language='en'):
+        self.api_calls = 0
+        self.calls_avoided = 0
+        # Calls joined with an identical one of a concurrent request
+        self.calls_shared = 0
+
+    def classify_keywords(self, kw_list):
+        """Classifies keywords, skipping the ones the API can't classify.
+        Keywords that pass the local pre-filter are sent grouped by their
+        script's language, the rest get empty categories without an API call.
+        Results keep the order of kw_list.
+        """
+        kw_list = kw_list[:_MAX_KW_CAT]
+        groups, skipped = prefilter(kw_list)
+        results = {kw: {"full category": '', "confidence": None} for kw in skipped}
+        for language, kws in groups.items():
+            results.update(self.classify_list(kws, language))
+        self.calls_avoided += len(skipped)
+        logging.info(f"Pre-filter skipped {len(skipped)} of {len(kw_list)} keywords, "
+                     f"avoiding as many API calls. Languages: "
+                     f"{ {language: len(kws) for language, kws in groups.items()} }")
+
+        return {kw: results[kw] for kw in kw_list if kw in results}
+
+    def classify_chunks(self, chunks):
+        """Classifies keywords chunk by chunk as they arrive, e.g. from
+        SheetsInteractor.iter_column while later chunks still download.
+        Stops after _MAX_KW_CAT keywords in total, closing chunks if it's a
+        generator so it stops reading.
+        """
+        results = {}
+        remaining = _MAX_KW_CAT
+        for chunk in chunks:
+            chunk = chunk[:remaining]
+            results.update(self.classify_keywords(chunk))
+            remaining -= len(chunk)
+            if remaining <= 0:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+                break
+        return results
+
+    def _classify_text(self, kw, language):
+        document = {
+            "content": kw,
+            "type_": self.type_,
+        }
+        # Left unset, the API detects the language
+        if language:
+            document["language"] = language
+        return self.client.classify_text(
+            request={
+                "document": document,
+                "classification_model_options": {
+                    "v2_model": {"content_categories_version": self.content_categories_version}
+                }
+            }
+        )
+
+    def classify_list(self, kw_list, language=None):
         results = {}
         counter = 0
         while counter < min(_MAX_KW_CAT, len(kw_list)):
             kw = kw_list[counter]
-            document = {
-                "content": kw,
-                "type_": self.type_,
-                "language": language
-            }
+            executed = []
+
+            def classify_text(kw=kw):
+                executed.append(True)
+                return self._classify_text(kw, language)
+
             try:
-                response = self.client.classify_text(
-                    request={
-                        "document": document,
-                        "classification_model_options": {
-                            "v2_model": {"content_categories_version": self.content_categories_version}
-                        }
-                    }
-                )
+                response = _nlp_flight.do(
+                    (kw, language, self.content_categories_version), classify_text)
+                if executed:
+                    self.api_calls += 1
+                else:
+                    self.calls_shared += 1
                 if not response.categories:
                     results[kw] = {
                         "full category": '',
@@ -65,7 +126,8 @@ class Classifier():
 
             except Exception as e:
                 logging.exception(e)
-                results[kw + str(counter)] = {
+                # Keyed by the keyword, so its row is updated with empty categories
+                results[kw] = {
                     "full category": '',
                     "confidence": None
                 }
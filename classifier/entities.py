@@ -2,22 +2,33 @@
 # by the GCF
 
 import yaml
+import hashlib
 import logging
+import os
 import re
+import threading
+import time
 from yaml.loader import SafeLoader
-from google.cloud import storage
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from typing import List, Any, Dict
+from typing import Callable, Iterator, List, Any, Dict, Optional
+from concurrent import futures
 from datetime import datetime
-from googleapiclient.errors import HttpError
+from ledger import QuotaLedger, ledger_path
 import smart_open as smart_open
 
 _HEADER = ['Keyword', 'Full Category Path', 'Top Level', 'Bottom Level', 'Confidence']
 _RUN_DATETIME = datetime.now()
 _RUN_METADATA = f'Last run was completed on {_RUN_DATETIME}'
 _OUTPUT_SHEET = 'Output'
+# Rows per updateCells/appendCells request and requests per batchUpdate call
+_DIFF_ROWS_PER_REQUEST = 5000
+_DIFF_REQUESTS_PER_BATCH = 200
+# Rows per range of a ranged read, ranges per batchGet call and batchGet calls in flight
+_READ_ROWS_PER_RANGE = 5000
+_READ_RANGES_PER_BATCH = 4
+_READ_WORKERS = int(os.getenv('sheet_read_workers') or 4)
+# Seconds a cached config is trusted before checking the file's generation again
+_CONFIG_CACHE_TTL = float(os.getenv('config_cache_ttl') or 30)
+_storage_client = None
 _SHEETS_SERVICE_SCOPES = ['https://www.googleapis.com/auth/spreadsheets',
           'https://www.googleapis.com/auth/drive.file', 'https://www.googleapis.com/auth/drive']
 
@@ -43,7 +54,13 @@ class SheetsInteractor:
         return spreadsheet_id
 
 
-    def write_to_sheet(self, values, sheet=_OUTPUT_SHEET):
+    def write_to_sheet(self, values, sheet=_OUTPUT_SHEET, diff=False, remove_missing=True):
+        """Writes rows (header first), replacing the sheet's content.
+        With diff, only rows that were inserted, removed or changed since
+        the last write are touched, see write_diff.
+        """
+        if diff:
+            return self.write_diff(values, sheet, remove_missing)
         self._clear_sheet(sheet)
         range = sheet + '!A1:' + chr(len(values[0]) + 65) + str(len(values))
         body = {
@@ -56,13 +73,141 @@ class SheetsInteractor:
             body=body             
         ).execute()
 
+    def write_rows(self, values, sheet=_OUTPUT_SHEET, first_row=2):
+        """Writes rows in place from first_row on, in one call. Other rows, and
+        the columns past the rows' own, are left as they are."""
+        if not values:
+            return
+        range = (f"{sheet}!A{first_row}:{chr(len(values[0]) + 64)}"
+                 f"{first_row + len(values) - 1}")
+        self.service.values().update(
+            spreadsheetId=self.spreadsheet_id,
+            range=range,
+            valueInputOption='RAW',
+            body={'values': values}
+        ).execute()
+
     def read_from_spreadsheet(self, range, sheet=_OUTPUT_SHEET) -> List[List[Any]]:
-        range = _OUTPUT_SHEET + "!" + range
+        range = sheet + "!" + range
         results = self.service.values().get(
             spreadsheetId=self.spreadsheet_id, range=range).execute()
         values = results.get('values', [])
         return values
 
+    def iter_column(self, sheet=_OUTPUT_SHEET, first_row=2, last_row=None,
+                    new_service: Optional[Callable[[], Any]] = None,
+                    max_workers=_READ_WORKERS) -> Iterator[List[str]]:
+        """Yields the non-empty values of column A, one chunk per range, in order.
+        The sheet's grid row count bounds the read, so it's split into ranges
+        of _READ_ROWS_PER_RANGE rows up front. The grid can be far larger than
+        the data, e.g. rows left by earlier longer writes, so reading stops at
+        the first batch without any value: values are contiguous in the tabs
+        this reads, and a gap of a whole batch would end the read early. Up to
+        max_workers batchGet calls of _READ_RANGES_PER_BATCH ranges each are in
+        flight ahead of the chunk being consumed, so callers can work on the
+        first chunk while later ones download. Close the generator when
+        stopping early, so the calls ahead are cancelled.
+        Args:
+          sheet: Name of the tab to read.
+          first_row: First row to read, 1-based.
+          last_row: Last row to read, up to the sheet's last row if None.
+          new_service: Builds a Sheets service for a worker thread, the
+            client library's HTTP transport isn't thread safe. The ranges are
+            read one call at a time with this interactor's service if None.
+        """
+        row_count = self._get_row_count(sheet)
+        if row_count is None:
+            raise Exception(f"Sheet {sheet} not found")
+        last_row = min(int(last_row), row_count) if last_row else row_count
+        rows_per_batch = _READ_ROWS_PER_RANGE * _READ_RANGES_PER_BATCH
+        batches = [
+            [f"{sheet}!A{start}:A{min(start + _READ_ROWS_PER_RANGE - 1, last_row)}"
+             for start in range(batch_start, min(batch_start + rows_per_batch, last_row + 1),
+                                _READ_ROWS_PER_RANGE)]
+            for batch_start in range(first_row, last_row + 1, rows_per_batch)]
+        logging.info(f"Reading rows {first_row}-{last_row} of {sheet} "
+                     f"in {len(batches)} batchGet calls")
+        if not new_service:
+            max_workers = 1
+        local = threading.local()
+
+        def read(ranges):
+            service = self.service
+            if new_service:
+                if not hasattr(local, 'service'):
+                    local.service = new_service().spreadsheets()
+                service = local.service
+            response = service.values().batchGet(
+                spreadsheetId=self.spreadsheet_id, ranges=ranges).execute()
+            return [[row[0] for row in value_range.get('values', []) if row and row[0]]
+                    for value_range in response.get('valueRanges', [])]
+
+        executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            # Keep a call in flight per worker ahead of the consumer, memory
+            # holds at most that many batches
+            pending = [executor.submit(read, ranges) for ranges in batches[:max_workers + 1]]
+            submitted = len(pending)
+            while pending:
+                chunks = pending.pop(0).result()
+                # Past the data, the calls already in flight are wasted at most
+                if not any(chunks):
+                    break
+                if submitted < len(batches):
+                    pending.append(executor.submit(read, batches[submitted]))
+                    submitted += 1
+                yield from (chunk for chunk in chunks if chunk)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _get_row_count(self, sheet_name) -> Optional[int]:
+        spreadsheet = self.service.get(
+            spreadsheetId=self.spreadsheet_id,
+            fields='sheets.properties(title,gridProperties.rowCount)').execute()
+        for properties in (sheet['properties'] for sheet in spreadsheet.get('sheets', [])):
+            if properties['title'] == sheet_name:
+                return properties['gridProperties']['rowCount']
+        return None
+
+    def write_diff(self, values, sheet=_OUTPUT_SHEET, remove_missing=True) -> Dict[str, int]:
+        """Makes the sheet hold `values` (header first), keyed by the first column.
+        Reads the sheet once and applies only the inserted, removed and
+        changed rows in as few batchUpdate calls as possible. Rows that
+        didn't change are left in place, new rows are appended at the end.
+        Args:
+          values: The rows to write, header first.
+          sheet: Name of the tab to write to.
+          remove_missing: Whether to delete rows whose key isn't in values.
+        Returns:
+          The number of rows per kind of change.
+        """
+        current = self.service.values().get(
+            spreadsheetId=self.spreadsheet_id, range=sheet + '!A:Z',
+            valueRenderOption='UNFORMATTED_VALUE').execute().get('values', [])
+        changed, removed, inserted = diff_rows(current, values)
+        if not remove_missing:
+            removed = []
+        sheet_id = self._get_sheet_id(sheet)
+        if sheet_id is None:
+            raise Exception(f"Sheet {sheet} not found")
+        requests = _diff_requests(sheet_id, changed, removed, inserted)
+        for i in range(0, len(requests), _DIFF_REQUESTS_PER_BATCH):
+            self.service.batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={'requests': requests[i:i + _DIFF_REQUESTS_PER_BATCH]}).execute()
+        stats = {'changed': len(changed), 'removed': len(removed),
+                 'inserted': len(inserted), 'unchanged': len(values) - len(changed) - len(inserted)}
+        logging.info(f"Diff write to {sheet}: {stats}, {len(requests)} requests")
+        return stats
+
+    def _get_sheet_id(self, sheet_name) -> Optional[int]:
+        spreadsheet = self.service.get(spreadsheetId=self.spreadsheet_id,
+                                       fields='sheets.properties').execute()
+        for properties in (sheet['properties'] for sheet in spreadsheet.get('sheets', [])):
+            if properties['title'] == sheet_name:
+                return properties['sheetId']
+        return None
+
     def _clear_sheet(self, sheet_name):
         """Helper function to clear output sheet before writing to it."""
         range_name = sheet_name + '!A:Z'
@@ -70,6 +215,104 @@ class SheetsInteractor:
             spreadsheetId=self.spreadsheet_id, range=range_name, body={}).execute()
 
 
+def _normalize_row(row) -> List[str]:
+    """Sheets drops trailing empty cells and returns numbers as numbers."""
+    row = ['' if value is None else str(value) for value in row]
+    while row and row[-1] == '':
+        row.pop()
+    return row
+
+
+def _row_hash(row) -> bytes:
+    return hashlib.blake2b('\x1f'.join(_normalize_row(row)).encode('utf-8'),
+                           digest_size=8).digest()
+
+
+def diff_rows(current, desired):
+    """Compares a sheet's rows to the desired rows, keyed by the first column.
+    Both lists start with a header row, which is compared by position. A row
+    is compared only over the desired row's cells, so writing just keywords
+    keeps the categories of keywords that are already in the sheet.
+    Returns:
+      changed: (row index, desired row) of existing keys whose row changed.
+      removed: Sorted row indices of keys no longer wanted, or duplicates.
+      inserted: Desired rows with keys not in the sheet, in order.
+    """
+    index = {}
+    removed = []
+    for i, row in enumerate(current[1:], start=1):
+        key = str(row[0]) if row else ''
+        if key in index:
+            removed.append(i)
+        else:
+            index[key] = i
+
+    changed = []
+    inserted = []
+    if desired and (not current or _row_hash(current[0]) != _row_hash(desired[0])):
+        changed.append((0, desired[0]))
+    seen = set()
+    for row in desired[1:]:
+        key = '' if row[0] is None else str(row[0])
+        if key in index and key not in seen:
+            i = index[key]
+            if _row_hash(current[i][:len(row)]) != _row_hash(row):
+                changed.append((i, row))
+        else:
+            inserted.append(row)
+        seen.add(key)
+    removed += [i for key, i in index.items() if key not in seen]
+    return changed, sorted(removed), inserted
+
+
+def _cell(value):
+    if value is None or value == '':
+        return {}
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+
+def _row_data(row):
+    # Pad to the header's width, so cells emptied since the last write get cleared
+    row = list(row) + [''] * (len(_HEADER) - len(row))
+    return {'values': [_cell(value) for value in row]}
+
+
+def _runs(indices):
+    """Groups sorted indices into (start, end) runs of consecutive indices."""
+    runs = []
+    for i in indices:
+        if runs and runs[-1][1] == i:
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1])
+    return runs
+
+
+def _diff_requests(sheet_id, changed, removed, inserted) -> List[Dict[str, Any]]:
+    """Builds batchUpdate requests for a diff. Requests apply in order, so
+    updates use the current indices, deletes go bottom up and appends last."""
+    requests = []
+    rows_by_index = dict(changed)
+    for start, end in _runs(sorted(rows_by_index)):
+        for chunk in range(start, end, _DIFF_ROWS_PER_REQUEST):
+            chunk_end = min(chunk + _DIFF_ROWS_PER_REQUEST, end)
+            requests.append({'updateCells': {
+                'start': {'sheetId': sheet_id, 'rowIndex': chunk, 'columnIndex': 0},
+                'rows': [_row_data(rows_by_index[i]) for i in range(chunk, chunk_end)],
+                'fields': 'userEnteredValue'}})
+    for start, end in reversed(_runs(removed)):
+        requests.append({'deleteDimension': {'range': {
+            'sheetId': sheet_id, 'dimension': 'ROWS', 'startIndex': start, 'endIndex': end}}})
+    for chunk in range(0, len(inserted), _DIFF_ROWS_PER_REQUEST):
+        requests.append({'appendCells': {
+            'sheetId': sheet_id,
+            'rows': [_row_data(row) for row in inserted[chunk:chunk + _DIFF_ROWS_PER_REQUEST]],
+            'fields': 'userEnteredValue'}})
+    return requests
+
+
 def format_data_for_sheet(data: Dict[str, Dict[str, Any]]) -> List[List[Any]]:
     """ Gets a dict with recommendations and categorizations and formats 
     it to be writable to spreadsheet"""
@@ -90,6 +333,97 @@ def format_data_for_sheet(data: Dict[str, Dict[str, Any]]) -> List[List[Any]]:
     return values
 
 
+def _get_storage_client():
+    global _storage_client
+    if _storage_client is None:
+        from google.cloud import storage
+        _storage_client = storage.Client()
+    return _storage_client
+
+
+def _get_file_version(path: str):
+    """Returns the GCS generation or local mtime of a file"""
+    if path.startswith('gs://'):
+        bucket_name, blob_name = path[len('gs://'):].split('/', 1)
+        blob = _get_storage_client().bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            raise FileNotFoundError(path)
+        return blob.generation
+    return os.stat(path).st_mtime_ns
+
+
+class ConfigCache:
+    """Process wide cache of config files' content.
+
+    Within the TTL the cached content is returned as is. After it, only the
+    file's generation (mtime for local files) is fetched, and the content is
+    read again only if it changed.
+
+    A copy of utils/config.py's ConfigCache, the function is deployed on its
+    own. Keep the two in sync.
+    """
+
+    def __init__(self, ttl: float = _CONFIG_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'revalidations': 0, 'misses': 0, 'hit_seconds': 0.0}
+
+    def read(self, path: str) -> bytes:
+        start = time.perf_counter()
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry and time.monotonic() - entry['checked_at'] < self.ttl:
+            return self._hit(entry, start)
+
+        version = _get_file_version(path)
+        if entry and entry['version'] == version:
+            with self._lock:
+                entry['checked_at'] = time.monotonic()
+                self.stats['revalidations'] += 1
+            return self._hit(entry, start)
+
+        with smart_open.open(path, "rb") as f:
+            content = f.read()
+        with self._lock:
+            self._entries[path] = {'content': content, 'version': version,
+                                   'checked_at': time.monotonic()}
+            self.stats['misses'] += 1
+        logging.info(f"Config cache miss for {path}, "
+                     f"read in {time.perf_counter() - start:.3f}s")
+        return content
+
+    def _hit(self, entry, start) -> bytes:
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.stats['hits'] += 1
+            self.stats['hit_seconds'] += elapsed
+        logging.debug(f"Config cache hit in {elapsed * 1000:.2f}ms")
+        return entry['content']
+
+    def invalidate(self, path: str = None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self.stats)
+        stats['avg_hit_ms'] = (stats['hit_seconds'] / stats['hits'] * 1000
+                               if stats['hits'] else 0.0)
+        return stats
+
+
+config_cache = ConfigCache()
+
+
+def record_usage(config_file_path: str, service: str, units: int):
+    """Adds used units to the quota ledger kept next to the config file."""
+    QuotaLedger(ledger_path(config_file_path), _get_storage_client).record(service, units)
+
+
 class Config():
     """Represents and holds a config file"""
     def __init__(self, config_file_path: str):
@@ -101,8 +435,7 @@ class Config():
 
     def _read_config_file(self, config_file_path: str):
         try:
-            with smart_open.open(config_file_path, "rb") as f:
-                content = f.read()
+            content = config_cache.read(config_file_path)
         except BaseException as e:
             logging.error(f"Config file {config_file_path} was not found: {str(e)}")
             raise FileNotFoundError(config_file_path)
@@ -115,6 +448,10 @@ class Config():
 
     
     def get_sheets_service(self):
+        from google.oauth2.credentials import Credentials
+        from google.auth.transport.requests import Request
+        from googleapiclient.discovery import build
+
         creds = None
         user_info = {
             "client_id": self.client_id,
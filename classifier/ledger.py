@@ -0,0 +1,138 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Quota ledger for paid APIs, shared by the app and the classifier function.
+
+The ledger is a small JSON file next to config.yaml holding usage units
+per service, per day and per month:
+
+  {"nlp": {"2023-06": 1200, "2023-06-14": 300}, "ads": {...}}
+
+On GCS updates use the object's generation as a precondition and retry,
+so concurrent runs and the classifier function never lose increments.
+
+This module is deployed with the function's source and imported by the
+app as classifier.ledger, so it must not import anything else of either.
+"""
+
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+import json
+import logging
+import os
+import threading
+
+_LEDGER_FILE = 'ledger.json'
+_MAX_UPDATE_ATTEMPTS = 10
+_storage_client = None
+
+
+def _get_storage_client():
+    global _storage_client
+    if _storage_client is None:
+        from google.cloud import storage
+        _storage_client = storage.Client()
+    return _storage_client
+
+
+def _periods(when: datetime) -> List[str]:
+    return [when.strftime('%Y-%m'), when.strftime('%Y-%m-%d')]
+
+
+def ledger_path(config_file_path: str) -> str:
+    """Returns the path of the ledger next to a config file."""
+    base = os.path.dirname(config_file_path)
+    return (base + '/' if base else '') + _LEDGER_FILE
+
+
+class QuotaLedger:
+    """Persisted usage counters per service, per day and per month.
+    Args:
+      path: Local or gs:// path of the ledger file.
+      storage_client: Optional function returning the GCS client to use.
+    """
+
+    def __init__(self, path: str, storage_client: Optional[Callable] = None):
+        self.path = path
+        self._storage_client = storage_client or _get_storage_client
+        self._lock = threading.Lock()
+
+    def _blob(self):
+        bucket_name, blob_name = self.path[len('gs://'):].split('/', 1)
+        return self._storage_client().bucket(bucket_name).blob(blob_name)
+
+    def _read(self):
+        """Returns the ledger content and its generation (None for local
+        files), or None if the object changed while it was read."""
+        if self.path.startswith('gs://'):
+            from google.api_core.exceptions import NotFound, PreconditionFailed
+            blob = self._blob()
+            try:
+                blob.reload()
+                generation = blob.generation
+                return json.loads(blob.download_as_bytes(if_generation_match=generation)), generation
+            except NotFound:
+                return {}, 0
+            except PreconditionFailed:
+                return None
+        if not os.path.exists(self.path):
+            return {}, None
+        with open(self.path) as f:
+            return json.load(f), None
+
+    def _write(self, content, generation) -> bool:
+        if self.path.startswith('gs://'):
+            from google.api_core.exceptions import PreconditionFailed
+            try:
+                self._blob().upload_from_string(json.dumps(content),
+                                                content_type='application/json',
+                                                if_generation_match=generation)
+                return True
+            except PreconditionFailed:
+                return False
+        with open(self.path, 'w') as f:
+            json.dump(content, f)
+        return True
+
+    def record(self, service: str, units: int, when: Optional[datetime] = None):
+        """Adds used units of a service to the day's and month's totals."""
+        if not units:
+            return
+        periods = _periods(when or datetime.now())
+        with self._lock:
+            for _ in range(_MAX_UPDATE_ATTEMPTS):
+                read = self._read()
+                # A concurrent writer won, same as a failed write
+                if read is None:
+                    continue
+                content, generation = read
+                counters = content.setdefault(service, {})
+                for period in periods:
+                    counters[period] = counters.get(period, 0) + units
+                if self._write(content, generation):
+                    return
+        logging.error(f"Could not record {units} {service} units in {self.path}")
+
+    def usage(self, when: Optional[datetime] = None) -> Dict[str, Dict[str, int]]:
+        """Returns the day's and month's usage of every service."""
+        month, day = _periods(when or datetime.now())
+        for _ in range(_MAX_UPDATE_ATTEMPTS):
+            read = self._read()
+            if read is not None:
+                break
+        else:
+            raise RuntimeError(f"{self.path} kept changing while it was read")
+        content, _ = read
+        return {service: {'month': counters.get(month, 0), 'day': counters.get(day, 0)}
+                for service, counters in content.items()}
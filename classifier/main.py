@@ -1,34 +1,70 @@
 import functions_framework
-import itertools
 import logging
+from contextlib import closing
 import os
-from classifier import Classifier
-from entities import format_data_for_sheet, SheetsInteractor, Config
+from entities import (format_data_for_sheet, SheetsInteractor, Config, _OUTPUT_SHEET, record_usage,
+                      config_cache)
 
 logging.basicConfig(level=logging.INFO)
 
+# Reused across requests served by the same instance, created on first use
+_language_client = None
+
+
+def get_classifier():
+    """Returns a Classifier sharing the instance's LanguageServiceClient."""
+    global _language_client
+    from classifier import Classifier
+    from google.cloud import language_v1
+
+    if _language_client is None:
+        _language_client = language_v1.LanguageServiceClient()
+    return Classifier(_language_client)
+
+
 @functions_framework.http
 def classify(request):
     """HTTP Cloud Function.
     Args:
         request (flask.Request): The request object.
-        The request object should be a dict that holds one parameter: row_num
-        row_num should be either empty string or a string number.
+        The request object should be a dict that holds the parameters:
+        row_num should be either empty string or a string number, the
+        number of keywords to classify from row 2 on, below the header.
         If empty - it will read all rows up until last row with data.
+        sheet (optional) is the run's output tab, 'Output' by default.
     """
     request_json = request.get_json()
     config_path = os.getenv('config_path') or 'config.yaml'
     row_num = request_json['row_num']
+    sheet = request_json.get('sheet') or _OUTPUT_SHEET
 
     try:
         config = Config(config_path)
+        # Instance wide, including this request's read
+        logging.info(f"Config cache: {config_cache.get_stats()}")
         sheet_service = config.get_sheets_service()
         sheets_interactor = SheetsInteractor(sheet_service, config.spreadsheet_url)
         
-        read_range = "A2:A" + str(row_num)
-        kws = sheets_interactor.read_from_spreadsheet(read_range) 
-        results = Classifier().classify_list(list(itertools.chain.from_iterable(kws)))
-        sheets_interactor.write_to_sheet(format_data_for_sheet(results))
+        # Ranged reads in parallel, classification starts with the first chunk
+        # Keywords start below the header, so the last one is at row_num + 1
+        last_row = int(row_num) + 1 if row_num else None
+        chunks = sheets_interactor.iter_column(sheet, first_row=2, last_row=last_row,
+                                               new_service=config.get_sheets_service)
+        classifier = get_classifier()
+        # Closed on errors too, cancelling the reads still ahead
+        with closing(chunks):
+            results = classifier.classify_chunks(chunks)
+        # The run's tab is fresh and results keep the order keywords were read
+        # in, so their rows are written in place without reading the tab back.
+        # Keywords past row_num, and the run's extra columns, stay as they are
+        sheets_interactor.write_rows(format_data_for_sheet(results)[1:], sheet, first_row=2)
+        logging.info(f"Classified {len(results)} keywords with {classifier.api_calls} API calls, "
+                     f"{classifier.calls_avoided} calls avoided by the pre-filter, "
+                     f"{classifier.calls_shared} shared with concurrent requests")
+        try:
+            record_usage(config_path, 'nlp', classifier.api_calls)
+        except Exception as e:
+            logging.warning(f"Could not record NLP usage: {str(e)}")
         
         return '200'
 
@@ -0,0 +1,122 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local pre-filter for keywords the NLP API can't usefully classify.
+
+Keywords are turned into a padded matrix of unicode code points, so all
+checks are numpy operations over the whole batch instead of per keyword
+Python loops. A keyword is skipped when:
+  * it has no word - no run of _MIN_LETTERS letters (_MIN_CJK_CHARS for
+    CJK), e.g. "12345" or "b07xj8c8f5", while "2024 tax return" and
+    "iphone15" are kept
+  * unsupported language - the dominant script has no supported language
+
+Supported keywords are grouped by the language of their script. Latin
+keywords are sent without a language, a single letter like the ï of
+"naïve bayes" can't tell French from English, so the API detects it.
+"""
+
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+_MIN_LETTERS = 3
+# A single CJK character carries much more meaning than a Latin letter
+_MIN_CJK_CHARS = 2
+_CHUNK_SIZE = 50000
+
+# Inclusive code point ranges of the scripts we can map to a language
+_SCRIPTS = {
+    'latin': [(0x41, 0x5A), (0x61, 0x7A), (0xC0, 0x24F)],
+    'cyrillic': [(0x400, 0x4FF)],
+    'kana': [(0x3040, 0x30FF)],
+    'hangul': [(0xAC00, 0xD7AF), (0x1100, 0x11FF)],
+    'han': [(0x4E00, 0x9FFF), (0x3400, 0x4DBF)],
+}
+_SCRIPT_LANGUAGES = {'cyrillic': 'ru', 'kana': 'ja', 'hangul': 'ko', 'han': 'zh'}
+
+
+def _code_points(kws: List[str]) -> np.ndarray:
+    """Returns an (n, max_len) uint32 matrix of code points, padded with zeros."""
+    width = max(1, max(len(kw) for kw in kws))
+    return np.array(kws, dtype=f'<U{width}').view(np.uint32).reshape(len(kws), width)
+
+
+def _in_ranges(points: np.ndarray, ranges) -> np.ndarray:
+    mask = np.zeros(points.shape, dtype=bool)
+    for start, end in ranges:
+        mask |= (points >= start) & (points <= end)
+    return mask
+
+
+def _longest_run(mask: np.ndarray) -> np.ndarray:
+    """Returns the length of the longest run of True in every row."""
+    run = np.zeros(mask.shape[0], dtype=np.int64)
+    longest = np.zeros(mask.shape[0], dtype=np.int64)
+    # One step per column, keywords are short
+    for column in mask.T:
+        run = (run + 1) * column
+        np.maximum(longest, run, out=longest)
+    return longest
+
+
+def _analyze(kws: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns a supported mask and a language per keyword, None for Latin."""
+    points = _code_points(kws)
+
+    script_masks = [_in_ranges(points, ranges) for ranges in _SCRIPTS.values()]
+    script_counts = np.stack([mask.sum(axis=1) for mask in script_masks], axis=1)
+    letters = script_counts.sum(axis=1)
+    # Non ASCII characters outside the known scripts, e.g. Arabic or Thai
+    known = np.logical_or.reduce(script_masks)
+    unknown = ((points >= 0x80) & ~known).sum(axis=1)
+
+    cjk_mask = np.logical_or.reduce(
+        [script_masks[list(_SCRIPTS).index(s)] for s in ('kana', 'hangul', 'han')])
+    has_word = ((_longest_run(known) >= _MIN_LETTERS)
+                | (_longest_run(cjk_mask) >= _MIN_CJK_CHARS))
+    unsupported_script = unknown > letters
+    supported = has_word & ~unsupported_script
+
+    script_names = np.array(list(_SCRIPTS))
+    dominant = script_names[script_counts.argmax(axis=1)]
+    languages = np.full(len(kws), None, dtype=object)
+    for script, language in _SCRIPT_LANGUAGES.items():
+        languages[dominant == script] = language
+    # Japanese mixes kana and han, any kana at all means Japanese
+    languages[script_counts[:, list(_SCRIPTS).index('kana')] > 0] = 'ja'
+    return supported, languages
+
+
+def prefilter(kws: List[str]) -> Tuple[Dict[Optional[str], List[str]], List[str]]:
+    """Splits keywords into ones worth sending to the API and ones that aren't.
+    Args:
+      kws: The keywords to classify.
+    Returns:
+      A dict of supported keywords by detected language, None for the ones
+      the API should detect the language of, and a list of the skipped
+      keywords.
+    """
+    groups = {}
+    skipped = []
+    for start in range(0, len(kws), _CHUNK_SIZE):
+        chunk = kws[start:start + _CHUNK_SIZE]
+        if not chunk:
+            continue
+        supported, languages = _analyze(chunk)
+        for kw, ok, language in zip(chunk, supported, languages):
+            if ok:
+                groups.setdefault(language, []).append(kw)
+            else:
+                skipped.append(kw)
+    return groups, skipped
@@ -0,0 +1,239 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Headless entry point for scheduled runs, e.g. from cron or Cloud Run Jobs.
+
+Example:
+  python cli.py --accounts all --run-type full --max-workers 16
+  python cli.py --accounts labels --labels brand --run-type filter \\
+      --input gs://my-bucket/kws.csv --output gs://my-bucket/out.csv --no-classify
+
+  python cli.py --mcc-file gs://my-bucket/mccs.yaml --output gs://my-bucket/{mcc}.csv \\
+      --no-classify --max-workers 64
+
+  python cli.py --upload gs://my-bucket/accepted.csv --dry-run
+
+Prints the run statistics as JSON to stdout and exits with a non-zero code
+if any account or stage failed.
+"""
+
+from utils.config import Config
+from utils.utils import get_all_child_accounts, get_accounts_by_labels
+from utils.ingest import CsvIngestor
+from server import run, classify_keywords, RunStats, _SOURCES
+from batch import BatchOrchestrator, load_mcc_jobs, _DEFAULT_MAX_WORKERS, _DEFAULT_PER_MCC_LIMIT
+from upload import KeywordUploader, UploadStats, read_accepted_rows
+import argparse
+import json
+import logging
+import sys
+import time
+import smart_open as smart_open
+
+_RUN_TYPES = {'full': "Full Run", 'filter': "Filter"}
+_EXIT_OK = 0
+_EXIT_PARTIAL_FAILURE = 1
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run Keyword Factory without the UI.")
+    parser.add_argument('--accounts', choices=['all', 'list', 'labels'], default='all',
+                        help="Which accounts under the MCC to run on.")
+    parser.add_argument('--account-ids', nargs='+', default=[],
+                        help="Account IDs, used with --accounts list.")
+    parser.add_argument('--labels', nargs='+', default=[],
+                        help="Account label names, used with --accounts labels.")
+    parser.add_argument('--run-type', choices=list(_RUN_TYPES), default='full')
+    parser.add_argument('--sources', nargs='+', choices=list(_SOURCES), default=['recommendations'],
+                        help="Where full runs get new keywords from. With more than one, the "
+                             "sources of every keyword are written next to it.")
+    parser.add_argument('--input',
+                        help="Local or gs:// CSV with keywords, used with --run-type filter.")
+    parser.add_argument('--input-column', type=int, default=1,
+                        help="Number of the CSV column that holds the keywords, starting from 1.")
+    parser.add_argument('--input-has-header', action='store_true')
+    parser.add_argument('--output', default='sheet',
+                        help="'sheet' for the configured spreadsheet, or a local or gs:// CSV path. "
+                             "With --mcc-file, '{mcc}' in the path is replaced with the MCC ID.")
+    parser.add_argument('--mcc-file',
+                        help="Local or gs:// yaml file listing several MCCs to run as one batch. "
+                             "See batch.py for the format.")
+    parser.add_argument('--max-workers', type=int, default=None,
+                        help="Number of accounts to query concurrently.")
+    parser.add_argument('--async-engine', action='store_true',
+                        help="Query accounts with the asyncio engine instead of threads. "
+                             "--max-workers then bounds the number of streams in flight.")
+    parser.add_argument('--per-mcc-limit', type=int, default=_DEFAULT_PER_MCC_LIMIT,
+                        help="Max concurrent API calls per MCC, used with --mcc-file.")
+    parser.add_argument('--classify', action=argparse.BooleanOptionalAction, default=True,
+                        help="Categorize the keywords once generated. Requires --output sheet.")
+    parser.add_argument('--route', action='store_true',
+                        help="Also write the best matching existing ad group of every keyword.")
+    parser.add_argument('--negatives', choices=['off', 'flag', 'drop'], default='off',
+                        help="Check keywords against the accounts' negative keywords, and flag "
+                             "the blocked ones or drop those blocked in every ad group (in "
+                             "their routed ad group with --route) before they're categorized.")
+    parser.add_argument('--overlap', action='store_true',
+                        help="Only remove keywords every account runs, write the number of "
+                             "accounts running every keyword and the account pairs sharing the "
+                             "most keywords.")
+    parser.add_argument('--upload',
+                        help="Instead of a run, upload accepted keywords to their ad groups from "
+                             "a local or gs:// CSV. See upload.py for the format.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Validate the --upload operations without committing them.")
+    args = parser.parse_args(argv)
+
+    if args.accounts == 'list' and not args.account_ids:
+        parser.error("--accounts list requires --account-ids")
+    if args.accounts == 'labels' and not args.labels:
+        parser.error("--accounts labels requires --labels")
+    if args.max_workers is not None and args.max_workers < 1:
+        parser.error("--max-workers must be at least 1")
+    if args.per_mcc_limit < 1:
+        parser.error("--per-mcc-limit must be at least 1")
+    if args.dry_run and not args.upload:
+        parser.error("--dry-run requires --upload")
+    if args.upload:
+        return args
+    if args.run_type == 'filter' and not args.input:
+        parser.error("--run-type filter requires --input")
+    if args.classify and args.output != 'sheet':
+        parser.error("--classify requires --output sheet, pass --no-classify")
+    if args.mcc_file and args.classify:
+        parser.error("--mcc-file doesn't support classification yet, pass --no-classify")
+    if args.mcc_file and (args.route or args.negatives != 'off' or args.overlap
+                          or args.sources != ['recommendations']):
+        parser.error("--route, --negatives, --overlap and --sources are not supported with "
+                     "--mcc-file")
+    if args.mcc_file and args.async_engine:
+        parser.error("--async-engine is not supported with --mcc-file")
+    if args.mcc_file and args.output != 'sheet' and '{mcc}' not in args.output:
+        parser.error("--output must contain '{mcc}' when used with --mcc-file")
+    return args
+
+
+def get_accounts(config: Config, args):
+    if args.accounts == 'list':
+        return args.account_ids
+    if args.accounts == 'labels':
+        return get_accounts_by_labels(config, args.labels)
+    return get_all_child_accounts(config, False)
+
+
+def run_batch(config: Config, args, uploaded_kws) -> int:
+    try:
+        jobs = load_mcc_jobs(args.mcc_file, config, args.output)
+    except Exception as e:
+        logging.exception(e)
+        stats = RunStats()
+        stats.errors.append(f"mcc file: {e}")
+        print(json.dumps(stats.to_dict()))
+        return _EXIT_PARTIAL_FAILURE
+    orchestrator = BatchOrchestrator(jobs, _RUN_TYPES[args.run_type], uploaded_kws,
+                                     max_workers=args.max_workers or _DEFAULT_MAX_WORKERS,
+                                     per_mcc_limit=args.per_mcc_limit)
+    results = orchestrator.run()
+    print(json.dumps({mcc: stats.to_dict() for mcc, stats in results.items()}))
+    if any(stats.partial_failure for stats in results.values()):
+        return _EXIT_PARTIAL_FAILURE
+    return _EXIT_OK
+
+
+def run_upload(config: Config, args) -> int:
+    stats = UploadStats()
+    try:
+        start = time.perf_counter()
+        rows = read_accepted_rows(args.upload)
+        stats.timings['read'] = time.perf_counter() - start
+        KeywordUploader(config.get_ads_client(), dry_run=args.dry_run).upload(rows, stats)
+    except Exception as e:
+        logging.exception(e)
+        print(json.dumps({**stats.to_dict(), "errors": [str(e)]}))
+        return _EXIT_PARTIAL_FAILURE
+    print(json.dumps(stats.to_dict()))
+    return _EXIT_PARTIAL_FAILURE if stats.failures else _EXIT_OK
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stderr))
+    stats = RunStats()
+
+    try:
+        config = Config()
+    except Exception as e:
+        logging.exception(e)
+        stats.errors.append(f"config: {e}")
+        print(json.dumps(stats.to_dict()))
+        return _EXIT_PARTIAL_FAILURE
+    if not config.valid_config:
+        stats.errors.append("Invalid config, set credentials through the UI or config.yaml")
+        print(json.dumps(stats.to_dict()))
+        return _EXIT_PARTIAL_FAILURE
+
+    if args.upload:
+        return run_upload(config, args)
+
+    uploaded_kws = ()
+    if args.run_type == 'filter':
+        ingestor = CsvIngestor(column=args.input_column - 1,
+                               has_header=args.input_has_header)
+        with stats.timer("ingest"):
+            with smart_open.open(args.input, 'rb') as f:
+                uploaded_kws = ingestor.ingest(f)
+
+    if args.mcc_file:
+        try:
+            return run_batch(config, args, uploaded_kws)
+        finally:
+            if uploaded_kws:
+                uploaded_kws.delete()
+
+    try:
+        with stats.timer("accounts"):
+            accounts = get_accounts(config, args)
+    except Exception as e:
+        logging.exception(e)
+        stats.errors.append(f"accounts: {e}")
+        print(json.dumps(stats.to_dict()))
+        if uploaded_kws:
+            uploaded_kws.delete()
+        return _EXIT_PARTIAL_FAILURE
+
+    output_path = None if args.output == 'sheet' else args.output
+    try:
+        row_num = run(config, accounts, _RUN_TYPES[args.run_type], uploaded_kws,
+                      max_workers=args.max_workers, stats=stats, output_path=output_path,
+                      use_async=args.async_engine, route=args.route,
+                      negatives=None if args.negatives == 'off' else args.negatives,
+                      sources=list(dict.fromkeys(args.sources)), overlap=args.overlap)
+    finally:
+        if uploaded_kws:
+            uploaded_kws.delete()
+
+    if args.classify and row_num is not None:
+        try:
+            with stats.timer("classify"):
+                classify_keywords(row_num, stats.sheet)
+        except Exception as e:
+            logging.exception(e)
+            stats.errors.append(f"classify: {e}")
+
+    print(json.dumps(stats.to_dict()))
+    return _EXIT_PARTIAL_FAILURE if stats.partial_failure else _EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,65 +13,452 @@
 # limitations under the License.
 
 from utils.config import Config
-from utils.ads_searcher import RecBuilder, KeywordRemover
-from utils.sheets import SheetsInteractor, create_new_spreadsheet, format_data_for_sheet
+from utils.ads_searcher import RecBuilder, KeywordRemover, NegativeKeywordsBuilder, KeywordIdeasBuilder
+from utils.ads_searcher import SearchTermsBuilder
+from utils.singleflight import ads_flight
+from utils.sheets import SheetsInteractor, create_new_spreadsheet, format_data_for_sheet, run_sheet_name
+from utils.sheets import _HEADER, _ROUTING_HEADER, _NEGATIVES_HEADER, _SOURCE_HEADER
+from utils.sheets import _COVERAGE_HEADER, _OVERLAP_HEADER, overlap_sheet_name
+from utils.config import config_cache
+from utils.lease import Lease
+from utils.budget import QuotaLedger, classification_budget, select_top_k, ADS
 from concurrent import futures
-from typing import List, Dict
-from google.ads.googleads.client import GoogleAdsClient
+from typing import Any, Iterable, List, Dict, Optional, Sequence, Tuple, TYPE_CHECKING
+from contextlib import contextmanager
+from collections import Counter
 from pathlib import Path
-import urllib
-from google.auth import default
-from google.cloud import functions_v2
-import google.auth.transport.requests
-import google.oauth2.id_token
+import urllib.request
 import logging
-import requests
+import threading
+import sys
 import os
 import json
+import time
+import csv
+
+# Heavy client libraries are imported on first use to keep cold starts short
+if TYPE_CHECKING:
+    from google.ads.googleads.client import GoogleAdsClient
+    from utils.routing import AdGroupIndex
+    from utils.negatives import NegativeMatcher
+    from utils.overlap import KeywordOverlap
 
 _LOGS_PATH = Path('./server.log')
 _CLASSIFIER_FUNCTION_NAME = os.getenv('cf_classifier_name') or "classifier-keyword-factory"
+# Max runs executing at the same time on a single instance, others wait for a slot
+_MAX_CONCURRENT_RUNS = int(os.getenv('max_concurrent_runs') or 4)
+_run_slots = threading.BoundedSemaphore(_MAX_CONCURRENT_RUNS)
+# KeywordPlanIdeaService quota is per developer token, so requests in flight
+# are bounded per instance, across all runs
+_MAX_IDEA_REQUESTS = int(os.getenv('max_keyword_idea_requests') or 4)
+_idea_slots = threading.BoundedSemaphore(_MAX_IDEA_REQUESTS)
+# Top keywords of every account seeding keyword ideas
+_IDEA_SEED_KEYWORDS = int(os.getenv('keyword_ideas_seeds') or 100)
+_IDEAS_LANGUAGE = os.getenv('keyword_ideas_language') or 'languageConstants/1000'
+_IDEAS_GEO_TARGETS = [t.strip() for t in (os.getenv('keyword_ideas_geo_targets') or '').split(',')
+                      if t.strip()]
+# Terms every search term aggregator keeps, and accounts streamed at the same
+# time, together bounding the memory of the search terms source
+_SEARCH_TERMS_CAPACITY = int(os.getenv('search_terms_capacity') or 50000)
+_MAX_SEARCH_TERM_STREAMS = int(os.getenv('max_search_term_streams') or 4)
+_SEARCH_TERMS_MIN_CLICKS = int(os.getenv('search_terms_min_clicks') or 2)
+_SEARCH_TERMS_MIN_CONVERSIONS = float(os.getenv('search_terms_min_conversions') or 0)
+# Account pairs sharing the most keywords kept in the run statistics
+_OVERLAP_STATS_PAIRS = 10
 
 logging.basicConfig(filename=_LOGS_PATH,
                     level=logging.INFO,
                     format='%(asctime)s:%(levelname)s:%(message)s')
 
 
-def get_recommendations(client: GoogleAdsClient, accounts: List[str]):
-    # Get KW recommendations from all accounts asynchronously
+class RunStats:
+    """Collects machine readable statistics of a single run."""
+
+    def __init__(self):
+        self.accounts = 0
+        self.recommendations = 0
+        self.keywords = 0
+        self.api_calls = 0
+        self.output = ''
+        self.sheet = ''
+        self.classification_budget = 0
+        self.routed = 0
+        self.negative_conflicts = 0
+        self.negatives_dropped = 0
+        self.sources = {}
+        self.overlap = {}
+        self.failed_accounts = {}
+        self.errors = []
+        self.timings = {}
+        # Keyword sources run concurrently and share the counters
+        self._lock = threading.Lock()
+
+    def account_failed(self, account: str, stage: str, error: Exception):
+        self.failed_accounts.setdefault(str(account), []).append(f"{stage}: {error}")
+
+    def add_api_calls(self, calls: int):
+        with self._lock:
+            self.api_calls += calls
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.timings[stage] = self.timings.get(stage, 0) + time.perf_counter() - start
+
+    @property
+    def partial_failure(self) -> bool:
+        return bool(self.failed_accounts or self.errors)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "accounts": self.accounts,
+            "recommendations": self.recommendations,
+            "keywords": self.keywords,
+            "api_calls": self.api_calls,
+            "output": self.output,
+            "sheet": self.sheet,
+            "classification_budget": self.classification_budget,
+            "routed": self.routed,
+            "negative_conflicts": self.negative_conflicts,
+            "negatives_dropped": self.negatives_dropped,
+            "sources": self.sources,
+            "overlap": self.overlap,
+            "failed_accounts": self.failed_accounts,
+            "errors": self.errors,
+            "timings": {k: round(v, 3) for k, v in self.timings.items()},
+            "partial_failure": self.partial_failure,
+            # Process wide, counts calls joined across all sessions and jobs
+            "ads_coalescing": ads_flight.stats(),
+            # Process wide as well, with the average latency of cache hits
+            "config_cache": config_cache.get_stats(),
+        }
+
+
+def get_recommendations(client: 'GoogleAdsClient', accounts: List[str],
+                        max_workers: Optional[int] = None,
+                        stats: Optional[RunStats] = None,
+                        use_async: bool = False,
+                        scores: Optional[Counter] = None):
+    """Get KW recommendations from all accounts concurrently.
+    Args:
+      client: Google Ads API client instance.
+      accounts: A list with all the selected accounts.
+      max_workers: Size of the thread pool, defaults to the executor's default.
+        With use_async, the max number of streams in flight.
+      stats: Optional RunStats to record failed accounts in.
+      use_async: Whether to use the asyncio engine instead of threads.
+      scores: Optional Counter to count the accounts recommending each KW in.
+    """
+    if use_async:
+        from utils import async_ads
+        failed = {}
+        kw_rec = async_ads.get_recommendations(
+            client, accounts, max_workers or async_ads._DEFAULT_MAX_CONCURRENCY, failed, scores)
+        for account, e in failed.items():
+            if stats:
+                stats.account_failed(account, "recommendations", e)
+        return kw_rec
+
+    def build(account):
+        try:
+            return RecBuilder(client, account).build()
+        except Exception as e:
+            logging.exception(e)
+            if stats:
+                stats.account_failed(account, "recommendations", e)
+
     kw_rec = []
-    with futures.ThreadPoolExecutor() as executor:
-        results = executor.map(
-            lambda account: RecBuilder(
-                client, account).build(),
-            accounts)
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(build, accounts)
     for res in results:
         if isinstance(res, list):
             kw_rec += res
+            if scores is not None:
+                scores.update(set(res))
     
     # Remove duplicates and return
     return list(dict.fromkeys(kw_rec))
 
 
-def remove_keywords(client: GoogleAdsClient, recommendations: List[str], accoutns: List[str]):
-    """Get all KWs from an account and remove duplicates from recommendations.
-    Gets a list of the existing keywords in the given account, iterates over them
-    and removes matches in the keyword recommendations dict.
+def get_keyword_ideas(client: 'GoogleAdsClient', accounts: List[str],
+                      max_workers: Optional[int] = None,
+                      stats: Optional[RunStats] = None,
+                      use_async: bool = False,
+                      scores: Optional[Counter] = None):
+    """Get KeywordPlanIdeaService ideas for all accounts concurrently.
+    Every account's seeds are read first, then all GenerateKeywordIdeas
+    requests run on one pool, at most _MAX_IDEA_REQUESTS at a time. Pages of
+    a single response follow each other's page tokens, so they're read in
+    order by the request's worker.
+    Args:
+      client: Google Ads API client instance.
+      accounts: A list with all the selected accounts.
+      max_workers: Size of the thread pools, defaults to the executor's default.
+      stats: Optional RunStats to record failed accounts and API calls in.
+      use_async: Unused, KeywordPlanIdeaService isn't streamed, so ideas
+        are always requested from threads.
+      scores: Optional Counter to count the accounts getting each KW in.
+    """
+    def builder(account):
+        return KeywordIdeasBuilder(client, account, _IDEAS_LANGUAGE, _IDEAS_GEO_TARGETS)
+
+    # Only requests actually sent count, not the ones joined in flight
+    def seeds(account):
+        account_builder = builder(account)
+        try:
+            return account_builder.seeds(_IDEA_SEED_KEYWORDS)
+        except Exception as e:
+            logging.exception(e)
+            if stats:
+                stats.account_failed(account, "keyword ideas", e)
+        finally:
+            if stats:
+                stats.add_api_calls(account_builder.calls)
+
+    def ideas(request):
+        account, seed = request
+        account_builder = builder(account)
+        try:
+            with _idea_slots:
+                return account_builder.ideas(seed)
+        except Exception as e:
+            logging.exception(e)
+            if stats:
+                stats.account_failed(account, "keyword ideas", e)
+        finally:
+            if stats:
+                stats.add_api_calls(account_builder.calls)
+
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        requests = [(account, seed)
+                    for account, account_seeds in zip(accounts, executor.map(seeds, accounts))
+                    for seed in account_seeds or ()]
+        results = list(executor.map(ideas, requests))
+
+    by_account = {}
+    for (account, _), res in zip(requests, results):
+        if res is not None:
+            by_account.setdefault(account, []).extend(res)
+    kw_ideas = list(dict.fromkeys(kw for res in by_account.values() for kw in res))
+    if scores is not None:
+        for res in by_account.values():
+            scores.update(set(res))
+    logging.info(f"Got {len(kw_ideas)} keyword ideas from {len(requests)} requests "
+                 f"for {len(accounts)} accounts")
+    return kw_ideas
+
+
+def get_search_terms(client: 'GoogleAdsClient', accounts: List[str],
+                     max_workers: Optional[int] = None,
+                     stats: Optional[RunStats] = None,
+                     use_async: bool = False,
+                     scores: Optional[Counter] = None):
+    """Get the search terms of all accounts that aren't keywords yet.
+    Every account's search_term_view rows are streamed into its own
+    SearchTermAggregator, merged into the run's one once the account is
+    done. At most _MAX_SEARCH_TERM_STREAMS accounts stream at a time, so
+    memory is bounded by the aggregators' capacity, whatever the number of
+    rows. Terms with at least _SEARCH_TERMS_MIN_CLICKS clicks and
+    _SEARCH_TERMS_MIN_CONVERSIONS conversions are returned, the most
+    clicked first.
+    Args:
+      client: Google Ads API client instance.
+      accounts: A list with all the selected accounts.
+      max_workers: Max number of accounts streamed at a time, up to
+        _MAX_SEARCH_TERM_STREAMS.
+      stats: Optional RunStats to record failed accounts, API calls and
+        rows per second and peak memory of the aggregation in.
+      use_async: Unused, rows are always streamed from threads.
+      scores: Optional Counter to count the accounts with each KW in.
+    """
+    from utils.search_terms import SearchTermAggregator
+
+    total = SearchTermAggregator(_SEARCH_TERMS_CAPACITY)
+    lock = threading.Lock()
+
+    def aggregate(account):
+        terms = SearchTermAggregator(_SEARCH_TERMS_CAPACITY)
+        try:
+            for term, clicks, conversions in SearchTermsBuilder(client, account).stream():
+                terms.add(term, clicks, conversions)
+        except Exception as e:
+            logging.exception(e)
+            if stats:
+                stats.account_failed(account, "search terms", e)
+            return
+        with lock:
+            total.merge(terms)
+
+    start = time.perf_counter()
+    workers = min(max_workers or _MAX_SEARCH_TERM_STREAMS, _MAX_SEARCH_TERM_STREAMS)
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(aggregate, accounts))
+    elapsed = time.perf_counter() - start
+    candidates = total.candidates(_SEARCH_TERMS_MIN_CLICKS, _SEARCH_TERMS_MIN_CONVERSIONS)
+    if scores is not None:
+        scores.update({term: accounts for term, _, _, accounts in candidates})
+    logging.info(f"Aggregated {total.rows} search term rows in {elapsed:.2f}s, "
+                 f"{len(candidates)} of {len(total)} terms pass the thresholds")
+    if stats:
+        stats.add_api_calls(len(accounts))
+        stats.sources.setdefault('search_terms', {}).update({
+            "rows": total.rows,
+            "rows_per_s": round(total.rows / elapsed) if elapsed else 0,
+            "peak_terms": total.peak_terms,
+            "clicks_error": total.error,
+            "max_rss_mb": _max_rss_mb(),
+        })
+    return [term for term, _, _, _ in candidates]
+
+
+def _max_rss_mb() -> Optional[float]:
+    """Peak resident memory of the process, None where it can't be read."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Kilobytes on Linux, bytes on macOS
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor, 1)
+
+
+# Keyword generators of Full Runs by name, all called like get_recommendations
+_SOURCES = {
+    'recommendations': get_recommendations,
+    'keyword_ideas': get_keyword_ideas,
+    'search_terms': get_search_terms,
+}
+
+
+def generate_keywords(client: 'GoogleAdsClient', accounts: List[str],
+                      sources: Sequence[str] = ('recommendations',),
+                      max_workers: Optional[int] = None,
+                      stats: Optional[RunStats] = None,
+                      use_async: bool = False,
+                      scores: Optional[Counter] = None) -> Tuple[List[str], Dict[str, int]]:
+    """Runs the keyword sources concurrently and merges their keywords.
+    Args:
+      sources: Names of the sources in _SOURCES, keywords keep the order
+        of the first source they come from.
+      scores: Optional Counter to count the (account, source) pairs
+        producing each KW in.
+      See get_recommendations for the others.
+    Returns:
+      The unique keywords, and a bitmask of the sources every keyword comes
+      from, bit i for sources[i].
+    """
+    stats = stats or RunStats()
+
+    def generate(name):
+        source_scores = Counter()
+        with stats.timer(f"generate.{name}"):
+            kws = _SOURCES[name](client, accounts, max_workers, stats, use_async, source_scores)
+        if name == 'recommendations':
+            stats.add_api_calls(len(accounts))
+        return kws, source_scores
+
+    with futures.ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        results = list(executor.map(generate, sources))
+    origins = {}
+    for bit, (name, (kws, source_scores)) in enumerate(zip(sources, results)):
+        for kw in kws:
+            origins[kw] = origins.get(kw, 0) | 1 << bit
+        if scores is not None:
+            scores.update(source_scores)
+        stats.sources.setdefault(name, {})["keywords"] = len(kws)
+    return list(origins), origins
+
+
+def remove_keywords(client: 'GoogleAdsClient', recommendations: Iterable[str], accoutns: List[str],
+                    max_workers: Optional[int] = None,
+                    stats: Optional[RunStats] = None,
+                    use_async: bool = False,
+                    index: Optional['AdGroupIndex'] = None,
+                    overlap: Optional['KeywordOverlap'] = None) -> List[str]:
+    """Get all KWs from the accounts and remove them from recommendations.
+    Collects the existing keywords of every given account into a set, then
+    consumes the recommendations once and keeps only the new ones. Both are
+    compared normalized, see utils.ingest.normalize_keyword.
     Args:
       client: Google Ads API client instance.
-      recommendations: A list with all the KW recommendations.
+      recommendations: An iterable with all the KW recommendations.
       accounts: A list with all the selected accounts.
+      max_workers: Size of the thread pool, defaults to the executor's default.
+        With use_async, the max number of streams in flight.
+      stats: Optional RunStats to record failed accounts in.
+      use_async: Whether to use the asyncio engine instead of threads.
+      index: Optional AdGroupIndex to add the accounts' keywords to, for
+        routing the new keywords to ad groups.
+      overlap: Optional KeywordOverlap to add the accounts' keywords to,
+        instead of the set. Only the keywords KeywordRemover.QUERY returns,
+        i.e. not negative or removed ones, count as run by an account. Then only the recommendations that every account
+        already runs are removed, the others are still new to some accounts.
+    Returns:
+      A list with the recommendations that don't exist in any account, or
+      with overlap, in some account.
     """
-    for account in accoutns:
+    from utils.ingest import normalize_keyword
+
+    if use_async:
+        from utils import async_ads
+        failed = {}
+        existing = async_ads.get_existing_keywords(
+            client, accoutns, max_workers or async_ads._DEFAULT_MAX_CONCURRENCY, failed, index,
+            overlap)
+        for account, e in failed.items():
+            if stats:
+                stats.account_failed(account, "dedup", e)
+        if overlap is not None:
+            return _not_in_all(recommendations, overlap)
+        return [kw for kw in recommendations if kw and normalize_keyword(kw) not in existing]
+
+    def get_keywords(account):
         try:
-            builder = KeywordRemover(client, account)
-            builder.build(recommendations)
+            return KeywordRemover(client, account).account_keywords()
         except Exception as e:
             logging.exception(e)
+            if stats:
+                stats.account_failed(account, "dedup", e)
+
+    existing = set()
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for account, account_kws in zip(accoutns, executor.map(get_keywords, accoutns)):
+            if account_kws is None:
+                continue
+            normalized = [normalize_keyword(kw) for kw in account_kws.keywords]
+            if overlap is not None:
+                overlap.add(account, normalized)
+            else:
+                existing.update(normalized)
+            if index is not None:
+                index.add(account, account_kws.criteria)
+    if overlap is not None:
+        return _not_in_all(recommendations, overlap)
+    return [kw for kw in recommendations if kw and normalize_keyword(kw) not in existing]
+
+
+def _not_in_all(recommendations: Iterable[str], overlap: 'KeywordOverlap') -> List[str]:
+    """Returns the recommendations that some account of overlap doesn't run."""
+    kws = [kw for kw in recommendations if kw]
+    return [kw for kw, coverage in zip(kws, keyword_coverage(overlap, kws))
+            if coverage < len(overlap)]
+
+
+def keyword_coverage(overlap: 'KeywordOverlap', kws: List[str]) -> List[int]:
+    """Returns the number of accounts of overlap running each keyword, normalized."""
+    from utils.ingest import normalize_keyword
+
+    return overlap.coverage([normalize_keyword(kw) for kw in kws]).tolist()
 
 
 def get_current_location() -> str:
     """ Retrieve the current location of Cloud Run service """
+    import requests
+
     metadata_url = "http://metadata.google.internal/computeMetadata/v1/instance/region"
     metadata_headers = {"Metadata-Flavor": "Google"}
     response = requests.get(metadata_url, headers=metadata_headers)
@@ -87,6 +474,9 @@ def get_function_uri(name, location=None, project_id=None) -> str:
         project_id: a function project, if None then the current project will be used
       Return: uri - a uri for calling the function
     """
+    from google.auth import default
+    from google.cloud import functions_v2
+
     functions_client = functions_v2.FunctionServiceClient()
     if not project_id:
         _, project_id = default()
@@ -101,51 +491,291 @@ def get_function_uri(name, location=None, project_id=None) -> str:
             return url
 
 
-def classify_keywords(row_num) -> Dict[str, Dict[str, str]]:
+def classify_keywords(row_num, sheet: Optional[str] = None) -> Dict[str, Dict[str, str]]:
     """ Classifys the list of keywords, using GCP NLP classification service.
     Args: row_num - number of rows to categorize from the spreadsheet
         List[str] of keywords to categorize
+        sheet - the run's output tab, the function's default tab if None
+    Raises: RuntimeError if the function answers anything but '200', it
+        reports failures in the body of an HTTP 200 response
     """
+    if row_num == 0:
+        logging.warning("Nothing to classify, the monthly NLP budget may be used up")
+        return
     cf_uri = os.getenv('cf_uri')
     if not cf_uri:
         cf_uri = get_function_uri(_CLASSIFIER_FUNCTION_NAME)
+    import google.auth.transport.requests
+    import google.oauth2.id_token
+
     req = urllib.request.Request(cf_uri, method="POST")
     auth_req = google.auth.transport.requests.Request()
     id_token = google.oauth2.id_token.fetch_id_token(auth_req, cf_uri)
     req.add_header("Authorization", f"Bearer {id_token}")
     req.add_header('Content-Type', 'application/json')
 
-    data = json.dumps({"row_num":str(row_num)})
+    payload = {"row_num": str(row_num)}
+    if sheet:
+        payload["sheet"] = sheet
+    data = json.dumps(payload)
     data = data.encode()
-    response = urllib.request.urlopen(req,data=data)
+    with urllib.request.urlopen(req, data=data) as response:
+        body = response.read().decode('utf-8', errors='replace').strip()
+    if body != '200':
+        raise RuntimeError(f"Classification failed, the classifier function returned {body!r}")
 
 
-def run(config: Config, accounts: List[str], run_type: str, uploaded_kws=[]):
-    client = config.get_ads_client()
-    sheets_service = config.get_sheets_service()
-    if not config.spreadsheet_url:
-        config.spreadsheet_url = create_new_spreadsheet(sheets_service)
-        config.save_to_file()
+def write_to_csv(path: str, kws: Iterable[str], columns: Optional[Dict[str, List]] = None):
+    """Writes keywords to a local or gs:// CSV file, one keyword per row.
+    Args:
+      path: Local or gs:// path of the file.
+      kws: The keywords.
+      columns: Optional extra columns by header, with a value per keyword,
+        e.g. the routed ad groups, so the file can be uploaded with
+        upload.py once reviewed.
+    """
+    import smart_open as smart_open
+
+    columns = columns or {}
+    with smart_open.open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Keyword"] + list(columns))
+        writer.writerows([kw] + [values[i] for values in columns.values()]
+                         for i, kw in enumerate(kws))
+
+
+def write_overlap_to_csv(path: str, rows: List[Tuple]) -> str:
+    """Writes the overlap summary next to the keywords' CSV file.
+    Args:
+      path: Local or gs:// path of the keywords' file.
+      rows: The summary rows, see KeywordOverlap.summary.
+    Returns:
+      The path of the summary, the keywords' one ending in .overlap.csv.
+    """
+    import smart_open as smart_open
+
+    path = (path[:-len('.csv')] if path.lower().endswith('.csv') else path) + '.overlap.csv'
+    with smart_open.open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(_OVERLAP_HEADER)
+        writer.writerows(rows)
+    return path
+
 
-    sheets_interactor = SheetsInteractor(sheets_service, config.spreadsheet_url)
+def get_negatives(client: 'GoogleAdsClient', accounts: List[str],
+                  max_workers: Optional[int] = None,
+                  stats: Optional[RunStats] = None) -> 'NegativeMatcher':
+    """Compiles the negative keywords of all accounts into one matcher, with
+    the campaigns and ad groups they apply to."""
+    from utils.negatives import NegativeMatcher
 
+    def build(account):
+        try:
+            return NegativeKeywordsBuilder(client, account).build()
+        except Exception as e:
+            logging.exception(e)
+            if stats:
+                stats.account_failed(account, "negatives", e)
+
+    matcher = NegativeMatcher()
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for account, negatives in zip(accounts, executor.map(build, accounts)):
+            if negatives is not None:
+                matcher.add(account, negatives.negatives, negatives.ad_groups,
+                            negatives.campaign_shared_sets)
+    return matcher
+
+
+def ensure_spreadsheet(config: Config, sheets_service) -> str:
+    """Creates the shared spreadsheet once, even if several sessions run at once."""
+    if config.spreadsheet_url:
+        return config.spreadsheet_url
+    with Lease('spreadsheet'):
+        # Another session may have created it while we waited for the lease
+        config_cache.invalidate(config.file_path)
+        latest = config.load_config_from_file(ok_if_not_exists=True) or {}
+        if latest.get('spreadsheet_url'):
+            config.spreadsheet_url = latest['spreadsheet_url']
+        else:
+            config.spreadsheet_url = create_new_spreadsheet(sheets_service)
+            config.save_to_file()
+    return config.spreadsheet_url
+
+
+def run(config: Config, accounts: List[str], run_type: str, uploaded_kws: Iterable[str] = (),
+        max_workers: Optional[int] = None, stats: Optional[RunStats] = None,
+        output_path: Optional[str] = None, use_async: bool = False, route: bool = False,
+        negatives: Optional[str] = None, sources: Sequence[str] = ('recommendations',),
+        overlap: bool = False):
+    """Generates or ingests keywords, dedups them and writes them to the sheet.
+    Args:
+      config: The app configuration.
+      accounts: A list with all the selected accounts.
+      run_type: Either "Full Run" or "Filter".
+      uploaded_kws: Keywords to filter, used on "Filter" runs. Can be any
+        iterable, e.g. a KeywordSpool, and is consumed only once.
+      max_workers: Size of the thread pools querying the accounts.
+      stats: Optional RunStats to collect run statistics in.
+      output_path: Optional local or gs:// CSV path to write the keywords to
+        instead of the spreadsheet. Otherwise a new tab is created for every
+        run, so concurrent runs don't overwrite each other, and kept in
+        stats.sheet.
+      use_async: Whether to query the accounts with the asyncio engine.
+      route: Whether to also write the best matching existing ad group of
+        every keyword, see utils.routing.
+      negatives: What to do with keywords blocked by the accounts' negative
+        keywords, see utils.negatives. 'flag' writes the blocking negative
+        next to them. 'drop' removes the ones blocked wherever they would
+        go, i.e. at their routed ad group, or unrouted, in every enabled ad
+        group of every account, before they're ranked and classified, and
+        flags the rest. Not checked if None.
+      sources: Names of the keyword sources of Full Runs, see _SOURCES.
+        With more than one, the sources of every keyword are written next
+        to it.
+      overlap: Whether to compute the accounts' keyword overlap, see
+        utils.overlap. Then only keywords every account already runs are
+        removed, the number of accounts running every keyword is written
+        next to it, and the account pairs sharing the most keywords are
+        written to the output tab's overlap tab, or next to the CSV file.
+    Returns:
+      The number of rows to classify, or None if the run failed. Keywords
+      are ranked by the number of accounts recommending them, and the top
+      ones that fit the remaining NLP budget are written first.
+    """
+    stats = stats or RunStats()
+    with stats.timer("queued"):
+        _run_slots.acquire()
+    try:
+        return _run(config, accounts, run_type, uploaded_kws, max_workers, stats,
+                    output_path, use_async, route, negatives, sources, overlap)
+    finally:
+        _run_slots.release()
+
+
+def _run(config, accounts, run_type, uploaded_kws, max_workers, stats,
+         output_path, use_async, route, negatives, sources, overlap):
+    stats.accounts = len(accounts)
+    ledger = QuotaLedger()
+    scores = Counter()
+    index = None
+    if route:
+        from utils.routing import AdGroupIndex
+        index = AdGroupIndex()
+    keyword_overlap = None
+    if overlap:
+        from utils.overlap import KeywordOverlap
+        keyword_overlap = KeywordOverlap()
+    client = config.get_ads_client()
+    if not output_path:
+        sheets_service = config.get_sheets_service()
+        ensure_spreadsheet(config, sheets_service)
+        sheets_interactor = SheetsInteractor(sheets_service, config.spreadsheet_url)
+
+    origins = {}
     if run_type == "Full Run":
-        kws = get_recommendations(client, accounts)
+        with stats.timer("generate"):
+            kws, origins = generate_keywords(client, accounts, sources, max_workers, stats,
+                                             use_async, scores)
+        stats.recommendations = len(kws)
     elif run_type == "Filter":
         kws = uploaded_kws
     
-    # Remove empty string if exists
-    try:
-        kws.remove('')
-    except ValueError:
-        pass
-    
     try:
-        # Dedup existing keywords
-        remove_keywords(client, kws, accounts)
-        # Write to spreadsheet
-        sheets_interactor.write_to_sheet(values=[[kw] for kw in kws])
-        return len(kws)
+        # Dedup existing keywords, empty strings are dropped on the way
+        with stats.timer("dedup"):
+            kws = remove_keywords(client, kws, accounts, max_workers, stats, use_async, index,
+                                  keyword_overlap)
+        stats.api_calls += len(accounts)
+        # Negatives apply where a keyword goes, so keywords are routed first
+        routes = {}
+        if index is not None:
+            with stats.timer("route"):
+                routes = dict(zip(kws, index.route(kws)))
+        conflicts = {}
+        if negatives:
+            with stats.timer("negatives"):
+                matcher = get_negatives(client, accounts, max_workers, stats)
+                kw_routes = [routes.get(kw) for kw in kws] if routes else None
+                conflicts = {kw: conflict for kw, conflict
+                             in zip(kws, matcher.conflicts(kws, kw_routes, accounts))
+                             if conflict is not None}
+            stats.api_calls += 5 * len(accounts)
+            stats.negative_conflicts = len(conflicts)
+            if negatives == 'drop':
+                kws = [kw for kw in kws if not (kw in conflicts and conflicts[kw][1])]
+                stats.negatives_dropped = stats.negative_conflicts - sum(
+                    1 for kw in kws if kw in conflicts)
+        stats.keywords = len(kws)
+        if origins:
+            for bit, name in enumerate(sources):
+                stats.sources[name]["new"] = sum(1 for kw in kws if origins[kw] >> bit & 1)
+        # Spend the classification budget on the most valuable keywords first
+        with stats.timer("select"):
+            budget = classification_budget(ledger)
+            kws = select_top_k(kws, scores, budget)
+        stats.classification_budget = budget
+        # Extra columns by header, following the classifier's ones in the sheet
+        columns = {}
+        if index is not None:
+            kw_routes = [routes.get(kw) for kw in kws]
+            stats.routed = sum(r is not None for r in kw_routes)
+            for i, header in enumerate(_ROUTING_HEADER):
+                columns[header] = [r[i] if r else '' for r in kw_routes]
+        if origins and len(sources) > 1:
+            columns[_SOURCE_HEADER] = [
+                ', '.join(name for bit, name in enumerate(sources) if origins[kw] >> bit & 1)
+                for kw in kws]
+        if negatives == 'flag' or (negatives and stats.negatives_dropped < len(conflicts)):
+            from utils.negatives import describe
+            columns[_NEGATIVES_HEADER] = [describe(conflicts[kw][0]) if kw in conflicts else ''
+                                          for kw in kws]
+        overlap_rows = None
+        if keyword_overlap is not None:
+            with stats.timer("overlap"):
+                columns[_COVERAGE_HEADER] = keyword_coverage(keyword_overlap, kws)
+                overlap_rows = keyword_overlap.summary()
+            stats.overlap = {
+                "accounts": len(keyword_overlap),
+                "criteria": keyword_overlap.criteria,
+                "keywords": keyword_overlap.keywords,
+                "shared_keywords": keyword_overlap.shared_keywords,
+                "top_pairs": [list(row) for row in overlap_rows[:_OVERLAP_STATS_PAIRS]],
+            }
+        # Write to spreadsheet or to the given file
+        with stats.timer("write"):
+            if output_path:
+                write_to_csv(output_path, kws, columns)
+                stats.output = output_path
+                if overlap_rows is not None:
+                    stats.overlap["output"] = write_overlap_to_csv(output_path, overlap_rows)
+            else:
+                header = _HEADER + list(columns)
+                padding = [''] * (len(_HEADER) - 1)
+                values = [[kw] + padding + [values[i] for values in columns.values()]
+                          if columns else [kw] for i, kw in enumerate(kws)]
+                # The classifier reads the first rows, in the selected order
+                sheet = run_sheet_name()
+                sheets_interactor.add_sheet(sheet)
+                sheets_interactor.write_to_sheet(values=values, sheet=sheet, header=header)
+                stats.output = config.spreadsheet_url
+                stats.sheet = sheet
+                if overlap_rows is not None:
+                    overlap_sheet = overlap_sheet_name(sheet)
+                    sheets_interactor.add_sheet(overlap_sheet)
+                    sheets_interactor.write_to_sheet(values=[list(row) for row in overlap_rows],
+                                                     sheet=overlap_sheet, header=_OVERLAP_HEADER)
+                    stats.overlap["output"] = overlap_sheet
+                try:
+                    with Lease('prune_run_sheets', timeout=5):
+                        sheets_interactor.prune_run_sheets()
+                except Exception as e:
+                    logging.warning(f"Could not prune old output tabs: {e}")
+        return min(len(kws), budget)
     except Exception as e:
         logging.exception(e)
-
+        stats.errors.append(str(e))
+    finally:
+        try:
+            ledger.record(ADS, stats.api_calls)
+        except Exception as e:
+            logging.warning(f"Could not record Ads API usage: {e}")
@@ -79,6 +79,9 @@ deploy_files() {
 
 deploy_cf() {
   echo -e "${COLOR}Creating Classifier Cloud function...${NC}"
+  MEMORY=$(git config -f $SETTING_FILE cloud-function.memory)
+  CPU=$(git config -f $SETTING_FILE cloud-function.cpu)
+  CONCURRENCY=$(git config -f $SETTING_FILE cloud-function.concurrency)
   gcloud functions deploy $CLASSIFIER_FUNCTION_NAME \
     --gen2 \
     --region=$REGION \
@@ -87,6 +90,9 @@ deploy_cf() {
     --entry-point=classify \
     --trigger-http \
     --timeout=3600s \
+    --memory=$MEMORY \
+    --cpu=$CPU \
+    --concurrency=$CONCURRENCY \
     --set-env-vars "config_path"="$CONFIG_PATH"
 }
 
@@ -0,0 +1,288 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Uploads accepted keywords to their ad groups through BatchJobService.
+
+Accepted keywords are rows of a CSV (local or gs://) with these columns,
+where Match Type is optional and defaults to BROAD:
+
+  Customer ID,Ad Group ID,Keyword,Match Type
+  1234567890,111222333,running shoes,PHRASE
+
+Rows become AdGroupCriterion create operations, grouped per account into
+batch jobs of up to _MAX_OPS_PER_JOB operations, added in chunks of
+_OPS_PER_REQUEST. All jobs are submitted first and then polled together,
+so accounts are processed by the API in parallel. Every operation's result
+is collected, failed operations don't fail the others.
+
+A dry run validates the operations with validate_only mutates and partial
+failure instead, nothing is committed.
+"""
+
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional
+import csv
+import io
+import logging
+import time
+import smart_open as smart_open
+
+_CUSTOMER_ID = 'Customer ID'
+_AD_GROUP_ID = 'Ad Group ID'
+_KEYWORD = 'Keyword'
+_MATCH_TYPE = 'Match Type'
+_DEFAULT_MATCH_TYPE = 'BROAD'
+_MATCH_TYPES = ('EXACT', 'PHRASE', 'BROAD')
+# API limits: operations per AddBatchJobOperations and Mutate request, and per batch job
+_OPS_PER_REQUEST = 10000
+_MAX_OPS_PER_JOB = 1000000
+_POLL_INTERVAL = 1.0
+_MAX_POLL_INTERVAL = 30.0
+_POLL_TIMEOUT = 3600
+_RESULTS_PAGE_SIZE = 1000
+
+
+def read_accepted_rows(path: str) -> List[Dict[str, str]]:
+    """Reads accepted keywords from a CSV, skipping rows without a keyword or
+    an ad group, e.g. keywords that routing couldn't match."""
+    with smart_open.open(path, 'rb') as f:
+        reader = csv.DictReader(io.TextIOWrapper(f, encoding='utf-8-sig', newline=''))
+        missing = {_CUSTOMER_ID, _AD_GROUP_ID, _KEYWORD} - set(reader.fieldnames or [])
+        if missing:
+            raise ValueError(f"{path} is missing the columns {sorted(missing)}")
+        rows = []
+        for line, row in enumerate(reader, start=2):
+            if not (row.get(_KEYWORD) or '').strip() or not (row.get(_AD_GROUP_ID) or '').strip():
+                continue
+            match_type = (row.get(_MATCH_TYPE) or _DEFAULT_MATCH_TYPE).strip().upper()
+            if match_type not in _MATCH_TYPES:
+                raise ValueError(f"{path}:{line}: unknown match type {match_type}")
+            rows.append({
+                'customer_id': row[_CUSTOMER_ID].replace('-', '').strip(),
+                'ad_group_id': row[_AD_GROUP_ID].strip(),
+                'keyword': row[_KEYWORD].strip(),
+                'match_type': match_type,
+            })
+    return rows
+
+
+class UploadStats:
+    """Results of an upload, per operation."""
+
+    def __init__(self):
+        self.operations = 0
+        self.succeeded = 0
+        self.jobs = 0
+        self.failures: List[Dict[str, str]] = []
+        self.timings: Dict[str, float] = {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "operations": self.operations,
+            "succeeded": self.succeeded,
+            "failed": len(self.failures),
+            "jobs": self.jobs,
+            "failures": self.failures,
+            "timings": {k: round(v, 3) for k, v in self.timings.items()},
+        }
+
+
+class _Job:
+    """A submitted batch job and the rows of its operations, by index."""
+
+    def __init__(self, customer_id: str, resource_name: str, rows: List[Dict[str, str]]):
+        self.customer_id = customer_id
+        self.resource_name = resource_name
+        self.rows = rows
+        self.operation = None
+
+
+class KeywordUploader:
+    """Creates ad group keywords in bulk.
+    Args:
+      client: Google Ads API client instance.
+      dry_run: Validate the operations without committing them.
+      poll_interval: Initial seconds between polls of the running jobs,
+        doubled up to _MAX_POLL_INTERVAL while nothing completes.
+      poll_timeout: Max seconds to wait for the jobs to complete.
+    """
+
+    def __init__(self, client, dry_run: bool = False,
+                 poll_interval: float = _POLL_INTERVAL, poll_timeout: float = _POLL_TIMEOUT):
+        self._client = client
+        self._ad_group_service = client.get_service("AdGroupService")
+        self.dry_run = dry_run
+        self.poll_interval = poll_interval
+        self.poll_timeout = poll_timeout
+
+    def upload(self, rows: Iterable[Dict[str, str]],
+               stats: Optional[UploadStats] = None) -> UploadStats:
+        """Uploads rows as returned by read_accepted_rows."""
+        stats = stats or UploadStats()
+        by_customer = defaultdict(list)
+        for row in rows:
+            by_customer[row['customer_id']].append(row)
+        stats.operations = sum(len(rows) for rows in by_customer.values())
+
+        start = time.perf_counter()
+        if self.dry_run:
+            for customer_id, customer_rows in by_customer.items():
+                self._validate(customer_id, customer_rows, stats)
+            stats.timings['validate'] = time.perf_counter() - start
+            return stats
+
+        jobs = []
+        for customer_id, customer_rows in by_customer.items():
+            for i in range(0, len(customer_rows), _MAX_OPS_PER_JOB):
+                job_rows = customer_rows[i:i + _MAX_OPS_PER_JOB]
+                try:
+                    jobs.append(self._submit(customer_id, job_rows))
+                except Exception as e:
+                    logging.exception(e)
+                    self._fail_all(job_rows, e, stats)
+        stats.jobs = len(jobs)
+        stats.timings['submit'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self._wait(jobs, stats)
+        stats.timings['run'] = time.perf_counter() - start
+        logging.info(f"Uploaded {stats.succeeded} of {stats.operations} keywords "
+                     f"in {stats.jobs} batch jobs, {len(stats.failures)} failed")
+        return stats
+
+    def _operation(self, row: Dict[str, str]):
+        client = self._client
+        mutate_operation = client.get_type("MutateOperation")
+        criterion = mutate_operation.ad_group_criterion_operation.create
+        criterion.ad_group = self._ad_group_service.ad_group_path(
+            row['customer_id'], row['ad_group_id'])
+        criterion.status = client.enums.AdGroupCriterionStatusEnum.ENABLED
+        criterion.keyword.text = row['keyword']
+        criterion.keyword.match_type = client.enums.KeywordMatchTypeEnum[row['match_type']]
+        return mutate_operation
+
+    def _submit(self, customer_id: str, rows: List[Dict[str, str]]) -> _Job:
+        """Creates a batch job, adds the rows' operations in chunks and runs it."""
+        client = self._client
+        service = client.get_service("BatchJobService")
+        batch_job_operation = client.get_type("BatchJobOperation")
+        batch_job_operation.create = client.get_type("BatchJob")
+        resource_name = service.mutate_batch_job(
+            customer_id=customer_id, operation=batch_job_operation).result.resource_name
+        job = _Job(customer_id, resource_name, rows)
+
+        sequence_token = None
+        for i in range(0, len(rows), _OPS_PER_REQUEST):
+            operations = [self._operation(row) for row in rows[i:i + _OPS_PER_REQUEST]]
+            response = service.add_batch_job_operations(
+                resource_name=resource_name, sequence_token=sequence_token,
+                mutate_operations=operations)
+            sequence_token = response.next_sequence_token
+        job.operation = service.run_batch_job(resource_name=resource_name)
+        logging.info(f"Submitted batch job {resource_name} with {len(rows)} operations")
+        return job
+
+    def _wait(self, jobs: List[_Job], stats: UploadStats):
+        """Polls all running jobs and collects the results of completed ones."""
+        pending = list(jobs)
+        interval = self.poll_interval
+        deadline = time.monotonic() + self.poll_timeout
+        while pending:
+            still_pending = []
+            for job in pending:
+                try:
+                    done = job.operation.done()
+                except Exception as e:
+                    logging.exception(e)
+                    self._fail_all(job.rows, e, stats)
+                    continue
+                if done:
+                    self._collect(job, stats)
+                else:
+                    still_pending.append(job)
+            if len(still_pending) < len(pending):
+                interval = self.poll_interval
+            else:
+                interval = min(interval * 2, _MAX_POLL_INTERVAL)
+            pending = still_pending
+            if pending and time.monotonic() >= deadline:
+                for job in pending:
+                    self._fail_all(job.rows, TimeoutError(f"{job.resource_name} didn't complete"),
+                                   stats)
+                return
+            if pending:
+                time.sleep(interval)
+
+    def _collect(self, job: _Job, stats: UploadStats):
+        """Reads a completed job's per-operation results."""
+        service = self._client.get_service("BatchJobService")
+        seen = set()
+        for result in service.list_batch_job_results(
+                resource_name=job.resource_name, page_size=_RESULTS_PAGE_SIZE):
+            seen.add(result.operation_index)
+            if result.status.code:
+                stats.failures.append(
+                    self._failure(job.rows[result.operation_index], result.status.message))
+            else:
+                stats.succeeded += 1
+        for index, row in enumerate(job.rows):
+            if index not in seen:
+                stats.failures.append(self._failure(row, "No result returned for operation"))
+
+    def _validate(self, customer_id: str, rows: List[Dict[str, str]], stats: UploadStats):
+        """Validates the rows' operations without committing them."""
+        service = self._client.get_service("GoogleAdsService")
+        for i in range(0, len(rows), _OPS_PER_REQUEST):
+            chunk = rows[i:i + _OPS_PER_REQUEST]
+            try:
+                response = service.mutate(
+                    customer_id=customer_id,
+                    mutate_operations=[self._operation(row) for row in chunk],
+                    partial_failure=True, validate_only=True)
+            except Exception as e:
+                logging.exception(e)
+                self._fail_all(chunk, e, stats)
+                continue
+            errors = self._partial_failures(response)
+            request_error = errors.pop(None, None)
+            if request_error is not None:
+                # Not tied to an operation, so no operation of the request is valid
+                for index, row in enumerate(chunk):
+                    stats.failures.append(self._failure(row, errors.get(index, request_error)))
+                continue
+            for index, message in errors.items():
+                stats.failures.append(self._failure(chunk[index], message))
+            stats.succeeded += len(chunk) - len(errors)
+
+    def _partial_failures(self, response) -> Dict[Optional[int], str]:
+        """Returns the error message per failed operation index of a mutate,
+        keyed None for errors of the whole request, which have no field path."""
+        errors = {}
+        details = getattr(response.partial_failure_error, 'details', None) or []
+        failure_type = type(self._client.get_type("GoogleAdsFailure"))
+        for detail in details:
+            failure = failure_type.deserialize(detail.value)
+            for error in failure.errors:
+                elements = error.location.field_path_elements
+                index = elements[0].index if elements else None
+                errors.setdefault(index, []).append(error.message)
+        return {index: '; '.join(messages) for index, messages in errors.items()}
+
+    @staticmethod
+    def _failure(row: Dict[str, str], message: str) -> Dict[str, str]:
+        return {'customer_id': row['customer_id'], 'ad_group_id': row['ad_group_id'],
+                'keyword': row['keyword'], 'error': str(message)}
+
+    def _fail_all(self, rows: List[Dict[str, str]], error: Exception, stats: UploadStats):
+        stats.failures.extend(self._failure(row, error) for row in rows)
@@ -12,21 +12,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List
+from utils.singleflight import ads_flight, client_identity
+from typing import FrozenSet, Iterator, List, Sequence, Tuple
 
 class Builder(object):
     def __init__(self, client, customer_id):
         self._service = client.get_service('GoogleAdsService')
         self._client = client
         self._customer_id = customer_id
+        # Requests this builder sent, not counting calls joined in _shared
+        self.calls = 0
 
     def _get_rows(self, query):
         search_request = self._client.get_type("SearchGoogleAdsStreamRequest")
         search_request.customer_id = self._customer_id
         search_request.query = query
         response = self._service.search_stream(request=search_request)
+        self.calls += 1
         return response
 
+    def _shared(self, query, build):
+        """Returns build(rows) of a query. Identical calls for the same account,
+        login customer and credentials that are already in flight, e.g. from
+        another session, are joined
+        instead of streaming the same rows again, so build's result is shared
+        and must not be modified."""
+        return ads_flight.do((client_identity(self._client), str(self._customer_id), query),
+                             lambda: build(self._get_rows(query)))
+
 
 class MccBuilder(Builder):
     """Gets all client accounts' IDs under the MCC."""
@@ -35,10 +48,7 @@ class MccBuilder(Builder):
         super().__init__(client, client.login_customer_id)
         self._client = client
 
-    def get_accounts(self, with_names=False):
-        """Used to get all client accounts using API"""
-        accounts = []
-        query = '''
+    ACCOUNTS_QUERY = '''
         SELECT
           customer_client.descriptive_name,
           customer_client.id
@@ -49,14 +59,24 @@ class MccBuilder(Builder):
         AND customer_client.status = 'ENABLED'
       '''
 
-        rows = self._get_rows(query)
+    @staticmethod
+    def parse_accounts(batch, with_names=False):
+        """Returns the account IDs in a single search_stream batch"""
+        accounts = []
+        for row in batch.results:
+            row = row._pb
+            account = str(row.customer_client.id)
+            if with_names:
+                account += ' - ' + str(row.customer_client.descriptive_name)
+            accounts.append(account)
+        return accounts
+
+    def get_accounts(self, with_names=False):
+        """Used to get all client accounts using API"""
+        accounts = []
+        rows = self._get_rows(self.ACCOUNTS_QUERY)
         for batch in rows:
-            for row in batch.results:
-                row = row._pb
-                account = str(row.customer_client.id)
-                if with_names:
-                    account += ' - ' + str(row.customer_client.descriptive_name)
-                accounts.append(account)
+            accounts += self.parse_accounts(batch, with_names)
 
         return accounts
     
@@ -125,38 +145,331 @@ class MccBuilder(Builder):
 
 class RecBuilder(Builder):
     """Gets Keywords recommendations from a single account."""
-
-    def build(self):
-        rows = self._get_rows("""
+    QUERY = """
         SELECT
           recommendation.keyword_recommendation
         FROM recommendation
-        """)
+        """
 
-        recommendations = []
+    @staticmethod
+    def parse(batch):
+        """Returns the recommended keywords in a single search_stream batch"""
+        return [row._pb.recommendation.keyword_recommendation.keyword.text
+                for row in batch.results]
 
-        for batch in rows:
-            for row in batch.results:
-                row = row._pb
-                recommendations.append(row.recommendation.keyword_recommendation.keyword.text)
-        return recommendations
+    def build(self):
+        recommendations = self._shared(
+            self.QUERY, lambda rows: [kw for batch in rows for kw in self.parse(batch)])
+        # The list may be shared with concurrent callers, hand out a copy
+        return list(recommendations)
     
 
+class KeywordIdeasBuilder(Builder):
+    """Gets KeywordPlanIdeaService ideas seeded with a single account's top
+    keywords, or its top landing pages if it has no keywords with clicks.
+    Args:
+      client: Google Ads API client instance.
+      customer_id: The account.
+      language: Language constant resource name of the ideas.
+      geo_targets: Geo target constant resource names of the ideas, all
+        locations if empty.
+    """
+    # API limits: keywords in a keyword seed, and a url seed is a single page
+    MAX_KEYWORDS_PER_SEED = 20
+    MAX_URL_SEEDS = 3
+    KEYWORDS_QUERY = """
+        SELECT
+            ad_group_criterion.keyword.text,
+            metrics.clicks
+        FROM keyword_view
+        WHERE
+            segments.date DURING LAST_30_DAYS
+            AND campaign.status = 'ENABLED'
+            AND ad_group.status = 'ENABLED'
+            AND ad_group_criterion.status = 'ENABLED'
+            AND metrics.clicks > 0
+        ORDER BY metrics.clicks DESC
+        LIMIT {limit}
+        """
+    LANDING_PAGES_QUERY = """
+        SELECT
+            landing_page_view.unexpanded_final_url,
+            metrics.clicks
+        FROM landing_page_view
+        WHERE
+            segments.date DURING LAST_30_DAYS
+            AND metrics.clicks > 0
+        ORDER BY metrics.clicks DESC
+        LIMIT {limit}
+        """
+
+    def __init__(self, client, customer_id, language: str, geo_targets: Sequence[str] = ()):
+        super().__init__(client, customer_id)
+        self._language = language
+        self._geo_targets = tuple(geo_targets)
+
+    @staticmethod
+    def parse_keywords(batch):
+        """Returns the keywords' text in a single search_stream batch"""
+        return [row.ad_group_criterion.keyword.text for row in batch.results]
+
+    @staticmethod
+    def parse_landing_pages(batch):
+        """Returns the landing pages' URLs in a single search_stream batch"""
+        return [row.landing_page_view.unexpanded_final_url for row in batch.results]
+
+    def seeds(self, max_keywords: int) -> List[Tuple[str, Tuple[str, ...]]]:
+        """Returns the account's seeds, one per GenerateKeywordIdeas request:
+        ('keywords', up to MAX_KEYWORDS_PER_SEED keywords) or ('url', (URL,))."""
+        keywords = self._shared(
+            self.KEYWORDS_QUERY.format(limit=int(max_keywords)),
+            lambda rows: list(dict.fromkeys(
+                kw for batch in rows for kw in self.parse_keywords(batch))))
+        if keywords:
+            return [('keywords', tuple(keywords[i:i + self.MAX_KEYWORDS_PER_SEED]))
+                    for i in range(0, len(keywords), self.MAX_KEYWORDS_PER_SEED)]
+        pages = self._shared(
+            self.LANDING_PAGES_QUERY.format(limit=self.MAX_URL_SEEDS),
+            lambda rows: [url for batch in rows for url in self.parse_landing_pages(batch)])
+        return [('url', (url,)) for url in pages]
+
+    def ideas(self, seed: Tuple[str, Tuple[str, ...]]) -> List[str]:
+        """Returns the ideas' text for a seed as returned by seeds, reading all
+        pages of the response. Shared like _shared results."""
+        return ads_flight.do(
+            (client_identity(self._client), str(self._customer_id), 'keyword ideas', seed,
+             self._language, self._geo_targets),
+            lambda: self._generate(seed))
+
+    def _generate(self, seed) -> List[str]:
+        client = self._client
+        request = client.get_type("GenerateKeywordIdeasRequest")
+        request.customer_id = str(self._customer_id)
+        request.language = self._language
+        request.geo_target_constants.extend(self._geo_targets)
+        request.include_adult_keywords = False
+        request.keyword_plan_network = client.enums.KeywordPlanNetworkEnum.GOOGLE_SEARCH
+        kind, values = seed
+        if kind == 'url':
+            request.url_seed.url = values[0]
+        else:
+            request.keyword_seed.keywords.extend(values)
+        service = client.get_service("KeywordPlanIdeaService")
+        # The pager requests the following pages while it's iterated
+        ideas = []
+        for page in service.generate_keyword_ideas(request=request).pages:
+            self.calls += 1
+            ideas.extend(idea.text for idea in page.results)
+        return ideas
+
+
+class SearchTermsBuilder(Builder):
+    """Streams the search terms of a single account that aren't keywords yet.
+    Rows are yielded as they arrive and not shared with concurrent callers,
+    so large accounts are never held in memory."""
+    QUERY = """
+        SELECT
+            search_term_view.search_term,
+            metrics.clicks,
+            metrics.conversions
+        FROM search_term_view
+        WHERE
+            segments.date DURING LAST_30_DAYS
+            AND search_term_view.status = 'NONE'
+            AND metrics.clicks > 0
+        """
+
+    @staticmethod
+    def parse(batch):
+        """Returns (search term, clicks, conversions) in a single search_stream batch"""
+        return [(row.search_term_view.search_term, row.metrics.clicks, row.metrics.conversions)
+                for row in batch.results]
+
+    def stream(self) -> Iterator[Tuple[str, int, float]]:
+        for batch in self._get_rows(self.QUERY):
+            yield from self.parse(batch)
+
+
+class AccountKeywords:
+    """An account's enabled keywords, with the ad group of each one.
+    Args:
+      criteria: (ad group ID, keyword text) pairs.
+    """
+
+    def __init__(self, criteria: List[Tuple[str, str]]):
+        self.criteria = criteria
+        self.keywords = frozenset(text for _, text in criteria)
+
+
 class KeywordRemover(Builder):
-    """Gets Keywords from a single account, removes from rec list"""
-    def build(self, kw_rec):
-        rows = self._get_rows('''
+    """Gets Keywords from a single account, removes from rec list.
+    Negative and removed keywords aren't the account's keywords, so they're
+    left out of dedup, routing and overlap."""
+    QUERY = '''
         SELECT 
+            ad_group.id,
             ad_group_criterion.keyword.text 
         FROM ad_group_criterion 
         WHERE 
             campaign.status = 'ENABLED' 
             AND ad_group.status = 'ENABLED' 
             AND ad_group_criterion.type = 'KEYWORD' 
-        ''')
+            AND ad_group_criterion.negative = FALSE
+            AND ad_group_criterion.status != 'REMOVED'
+        '''
+
+    @staticmethod
+    def parse(batch):
+        """Returns the keywords' text in a single search_stream batch"""
+        return [row.ad_group_criterion.keyword.text for row in batch.results]
+
+    @staticmethod
+    def parse_criteria(batch):
+        """Returns (ad group ID, keyword text) pairs in a single search_stream batch"""
+        return [(str(row.ad_group.id), row.ad_group_criterion.keyword.text)
+                for row in batch.results]
+
+    def get_keywords(self):
+        """Streams the text of all enabled keywords in the account."""
+        rows = self._get_rows(self.QUERY)
         for batch in rows:
-            for row in batch.results:
-                try:
-                    kw_rec.remove(row.ad_group_criterion.keyword.text)
-                except:
-                    pass
+            yield from self.parse(batch)
+
+    def account_keywords(self) -> AccountKeywords:
+        """Returns all enabled keywords in the account and their ad groups."""
+        return self._shared(self.QUERY, lambda rows: AccountKeywords(
+            [criterion for batch in rows for criterion in self.parse_criteria(batch)]))
+
+    def existing_keywords(self) -> FrozenSet[str]:
+        """Returns the text of all enabled keywords in the account."""
+        return self.account_keywords().keywords
+
+    def build(self, kw_rec):
+        existing = self.existing_keywords()
+        kw_rec[:] = [kw for kw in kw_rec if kw not in existing]
+
+
+class AccountNegatives:
+    """An account's negative keywords, with where they apply.
+    Args:
+      negatives: (scope, scope ID, text, match type) tuples.
+      ad_groups: (campaign ID, ad group ID) of the enabled ad groups.
+      campaign_shared_sets: (campaign ID, shared set ID) of the negative
+        keyword lists the campaigns use.
+    """
+
+    def __init__(self, negatives: List[Tuple[str, str, str, str]],
+                 ad_groups: List[Tuple[str, str]],
+                 campaign_shared_sets: List[Tuple[str, str]]):
+        self.negatives = negatives
+        self.ad_groups = ad_groups
+        self.campaign_shared_sets = campaign_shared_sets
+
+
+class NegativeKeywordsBuilder(Builder):
+    """Gets the negative keywords of a single account, one query per scope,
+    and the campaigns and ad groups they apply to."""
+    CAMPAIGN_QUERY = '''
+        SELECT
+            campaign.id,
+            campaign_criterion.keyword.text,
+            campaign_criterion.keyword.match_type
+        FROM campaign_criterion
+        WHERE
+            campaign.status = 'ENABLED'
+            AND campaign_criterion.negative = TRUE
+            AND campaign_criterion.type = 'KEYWORD'
+        '''
+    AD_GROUP_QUERY = '''
+        SELECT
+            ad_group.id,
+            ad_group_criterion.keyword.text,
+            ad_group_criterion.keyword.match_type
+        FROM ad_group_criterion
+        WHERE
+            campaign.status = 'ENABLED'
+            AND ad_group.status = 'ENABLED'
+            AND ad_group_criterion.negative = TRUE
+            AND ad_group_criterion.type = 'KEYWORD'
+        '''
+    SHARED_SET_QUERY = '''
+        SELECT
+            shared_set.id,
+            shared_criterion.keyword.text,
+            shared_criterion.keyword.match_type
+        FROM shared_criterion
+        WHERE
+            shared_set.type = 'NEGATIVE_KEYWORDS'
+            AND shared_set.status = 'ENABLED'
+            AND shared_criterion.type = 'KEYWORD'
+        '''
+    AD_GROUPS_QUERY = '''
+        SELECT
+            campaign.id,
+            ad_group.id
+        FROM ad_group
+        WHERE
+            campaign.status = 'ENABLED'
+            AND ad_group.status = 'ENABLED'
+        '''
+    CAMPAIGN_SHARED_SETS_QUERY = '''
+        SELECT
+            campaign.id,
+            shared_set.id
+        FROM campaign_shared_set
+        WHERE
+            campaign.status = 'ENABLED'
+            AND campaign_shared_set.status = 'ENABLED'
+            AND shared_set.type = 'NEGATIVE_KEYWORDS'
+            AND shared_set.status = 'ENABLED'
+        '''
+
+    @staticmethod
+    def _match_type(match_type) -> str:
+        return getattr(match_type, 'name', str(match_type))
+
+    @staticmethod
+    def parse_campaign(batch):
+        """Returns ('campaign', ID, text, match type) tuples in a single search_stream batch"""
+        return [('campaign', str(row.campaign.id), row.campaign_criterion.keyword.text,
+                 NegativeKeywordsBuilder._match_type(row.campaign_criterion.keyword.match_type))
+                for row in batch.results]
+
+    @staticmethod
+    def parse_ad_group(batch):
+        """Returns ('ad group', ID, text, match type) tuples in a single search_stream batch"""
+        return [('ad group', str(row.ad_group.id), row.ad_group_criterion.keyword.text,
+                 NegativeKeywordsBuilder._match_type(row.ad_group_criterion.keyword.match_type))
+                for row in batch.results]
+
+    @staticmethod
+    def parse_shared_set(batch):
+        """Returns ('shared set', ID, text, match type) tuples in a single search_stream batch"""
+        return [('shared set', str(row.shared_set.id), row.shared_criterion.keyword.text,
+                 NegativeKeywordsBuilder._match_type(row.shared_criterion.keyword.match_type))
+                for row in batch.results]
+
+    @staticmethod
+    def parse_ad_groups(batch):
+        """Returns (campaign ID, ad group ID) tuples in a single search_stream batch"""
+        return [(str(row.campaign.id), str(row.ad_group.id)) for row in batch.results]
+
+    @staticmethod
+    def parse_campaign_shared_sets(batch):
+        """Returns (campaign ID, shared set ID) tuples in a single search_stream batch"""
+        return [(str(row.campaign.id), str(row.shared_set.id)) for row in batch.results]
+
+    def _collect(self, query, parse) -> list:
+        return self._shared(
+            query, lambda rows: [item for batch in rows for item in parse(batch)])
+
+    def build(self) -> AccountNegatives:
+        """Returns the account's negatives and where they apply."""
+        negatives = []
+        for query, parse in ((self.CAMPAIGN_QUERY, self.parse_campaign),
+                             (self.AD_GROUP_QUERY, self.parse_ad_group),
+                             (self.SHARED_SET_QUERY, self.parse_shared_set)):
+            negatives += self._collect(query, parse)
+        return AccountNegatives(
+            negatives, self._collect(self.AD_GROUPS_QUERY, self.parse_ad_groups),
+            self._collect(self.CAMPAIGN_SHARED_SETS_QUERY, self.parse_campaign_shared_sets))
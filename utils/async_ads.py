@@ -0,0 +1,232 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""asyncio engine for Google Ads API search_stream calls.
+
+The google-ads client library only ships blocking clients, so this engine
+calls GoogleAdsService.SearchStream directly over an async gRPC channel,
+reusing the library's request/response types and the client's credentials.
+A semaphore bounds the number of streams in flight, so a single event loop
+can keep thousands of accounts in flight without a thread per account.
+
+Parsing is shared with the sync builders in ads_searcher, and the sync
+functions at the bottom of this module wrap the async ones for callers
+that don't run an event loop.
+"""
+
+from utils.ads_searcher import MccBuilder, RecBuilder, KeywordRemover, AccountKeywords
+from utils.config import _ADS_API_VERSION
+from utils.singleflight import ads_flight, client_identity
+from collections import Counter
+from typing import AsyncIterator, Iterable, List, Optional, Set, TYPE_CHECKING
+import asyncio
+import logging
+import grpc
+import google.auth.transport.grpc
+import google.auth.transport.requests
+
+if TYPE_CHECKING:
+    from utils.routing import AdGroupIndex
+    from utils.overlap import KeywordOverlap
+
+_ADS_ENDPOINT = 'googleads.googleapis.com:443'
+_DEFAULT_MAX_CONCURRENCY = 500
+_CHANNEL_OPTIONS = [
+    ('grpc.max_receive_message_length', -1),
+    ('grpc.max_send_message_length', -1),
+]
+
+
+class AsyncAdsEngine:
+    """Issues GAQL search_stream calls on an async gRPC channel.
+    Args:
+      client: A GoogleAdsClient, used for its credentials, developer token,
+        login customer ID and API version.
+      max_concurrency: Max number of streams in flight at the same time.
+      endpoint: Google Ads API endpoint.
+    """
+
+    def __init__(self, client, max_concurrency: int = _DEFAULT_MAX_CONCURRENCY,
+                 endpoint: str = _ADS_ENDPOINT):
+        self._client = client
+        self._endpoint = endpoint
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._channel = None
+        self._search_stream = None
+        request_type = type(client.get_type("SearchGoogleAdsStreamRequest"))
+        response_type = type(client.get_type("SearchGoogleAdsStreamResponse"))
+        self._serialize = request_type.serialize
+        self._deserialize = response_type.deserialize
+        self._request_type = request_type
+        version = getattr(client, 'version', None) or _ADS_API_VERSION
+        self._method = (f'/google.ads.googleads.{version}.services.'
+                        'GoogleAdsService/SearchStream')
+
+    def _open_channel(self):
+        auth_plugin = google.auth.transport.grpc.AuthMetadataPlugin(
+            self._client.credentials, google.auth.transport.requests.Request())
+        credentials = grpc.composite_channel_credentials(
+            grpc.ssl_channel_credentials(), grpc.metadata_call_credentials(auth_plugin))
+        self._channel = grpc.aio.secure_channel(
+            self._endpoint, credentials, options=_CHANNEL_OPTIONS)
+        self._search_stream = self._channel.unary_stream(
+            self._method,
+            request_serializer=self._serialize,
+            response_deserializer=self._deserialize)
+
+    def _metadata(self, customer_id: str):
+        metadata = [
+            ('developer-token', self._client.developer_token),
+            ('x-goog-request-params', f'customer_id={customer_id}'),
+        ]
+        if self._client.login_customer_id:
+            metadata.append(('login-customer-id', str(self._client.login_customer_id)))
+        return metadata
+
+    async def stream(self, customer_id: str, query: str) -> AsyncIterator:
+        """Yields the search_stream batches of a query as they arrive."""
+        if self._channel is None:
+            self._open_channel()
+        request = self._request_type(customer_id=str(customer_id), query=query)
+        async with self._semaphore:
+            call = self._search_stream(request, metadata=self._metadata(customer_id))
+            async for batch in call:
+                yield batch
+
+    async def close(self):
+        if self._channel is not None:
+            await self._channel.close()
+            self._channel = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+async def _collect(engine: AsyncAdsEngine, customer_id: str, query: str, parse,
+                   result_type=list):
+    """Returns the parsed rows of a query as result_type. Joins identical
+    calls in flight, sync or async, the same way the sync builders do, so
+    result_type must match theirs for the query."""
+    async def collect():
+        results = []
+        async for batch in engine.stream(customer_id, query):
+            results += parse(batch)
+        return result_type(results)
+    return await ads_flight.do_async(
+        (client_identity(engine._client), str(customer_id), query), collect)
+
+
+async def get_accounts_async(engine: AsyncAdsEngine, login_customer_id: str) -> List[str]:
+    """Gets all enabled, non manager client accounts under the MCC."""
+    return list(await _collect(engine, login_customer_id, MccBuilder.ACCOUNTS_QUERY,
+                               MccBuilder.parse_accounts))
+
+
+async def get_recommendations_async(engine: AsyncAdsEngine, accounts: Iterable[str],
+                                    failed: Optional[dict] = None,
+                                    scores: Optional[Counter] = None) -> List[str]:
+    """Gets KW recommendations from all accounts, deduplicated.
+    Args:
+      engine: The engine to issue calls with.
+      accounts: A list with all the selected accounts.
+      failed: Optional dict to record failed accounts and their errors in.
+      scores: Optional Counter to count the accounts recommending each KW in.
+    """
+    accounts = list(accounts)
+    results = await asyncio.gather(
+        *[_collect(engine, account, RecBuilder.QUERY, RecBuilder.parse)
+          for account in accounts],
+        return_exceptions=True)
+    kw_rec = {}
+    for account, res in zip(accounts, results):
+        if isinstance(res, BaseException):
+            logging.error(f"Failed getting recommendations for {account}: {res}")
+            if failed is not None:
+                failed[account] = res
+            continue
+        kw_rec.update(dict.fromkeys(res))
+        if scores is not None:
+            scores.update(set(res))
+    return list(kw_rec)
+
+
+async def get_existing_keywords_async(engine: AsyncAdsEngine, accounts: Iterable[str],
+                                      failed: Optional[dict] = None,
+                                      index: Optional['AdGroupIndex'] = None,
+                                      overlap: Optional['KeywordOverlap'] = None) -> Set[str]:
+    """Gets the text of all enabled keywords in all accounts.
+    Args:
+      engine: The engine to issue calls with.
+      accounts: A list with all the selected accounts.
+      failed: Optional dict to record failed accounts and their errors in.
+      index: Optional AdGroupIndex to add the accounts' keywords to.
+      overlap: Optional KeywordOverlap to add the accounts' keywords to,
+        instead of the returned set, which is then empty.
+    Keywords are normalized, see utils.ingest.normalize_keyword.
+    """
+    from utils.ingest import normalize_keyword
+
+    existing = set()
+
+    async def add_account(account):
+        try:
+            account_keywords = await _collect(engine, account, KeywordRemover.QUERY,
+                                              KeywordRemover.parse_criteria, AccountKeywords)
+            normalized = [normalize_keyword(kw) for kw in account_keywords.keywords]
+            if overlap is not None:
+                overlap.add(account, normalized)
+            else:
+                existing.update(normalized)
+            if index is not None:
+                index.add(account, account_keywords.criteria)
+        except Exception as e:
+            logging.error(f"Failed getting keywords for {account}: {e}")
+            if failed is not None:
+                failed[account] = e
+
+    await asyncio.gather(*[add_account(account) for account in accounts])
+    return existing
+
+
+def _run(client, max_concurrency, coro_fn, *args):
+    async def main():
+        async with AsyncAdsEngine(client, max_concurrency) as engine:
+            return await coro_fn(engine, *args)
+    return asyncio.run(main())
+
+
+def get_recommendations(client, accounts: Iterable[str],
+                        max_concurrency: int = _DEFAULT_MAX_CONCURRENCY,
+                        failed: Optional[dict] = None,
+                        scores: Optional[Counter] = None) -> List[str]:
+    """Sync wrapper of get_recommendations_async, must not be called from a running loop."""
+    return _run(client, max_concurrency, get_recommendations_async, accounts, failed, scores)
+
+
+def get_existing_keywords(client, accounts: Iterable[str],
+                          max_concurrency: int = _DEFAULT_MAX_CONCURRENCY,
+                          failed: Optional[dict] = None,
+                          index: Optional['AdGroupIndex'] = None,
+                          overlap: Optional['KeywordOverlap'] = None) -> Set[str]:
+    """Sync wrapper of get_existing_keywords_async, must not be called from a running loop."""
+    return _run(client, max_concurrency, get_existing_keywords_async, accounts, failed, index,
+                overlap)
+
+
+def get_accounts(client, max_concurrency: int = _DEFAULT_MAX_CONCURRENCY) -> List[str]:
+    """Sync wrapper of get_accounts_async, must not be called from a running loop."""
+    return _run(client, max_concurrency, get_accounts_async, client.login_customer_id)
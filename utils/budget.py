@@ -0,0 +1,76 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Quota ledger of the app's runs and value-ranked selection under its budget.
+
+The ledger itself is shared with the classifier function, see
+classifier/ledger.py for its format.
+"""
+
+from utils.config import _get_config_file_path, _get_storage_client
+from classifier.ledger import QuotaLedger as SharedQuotaLedger, ledger_path
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+import heapq
+import logging
+import os
+
+# The NLP API's monthly free tier, in classify_text calls
+_NLP_MONTHLY_BUDGET = int(os.getenv('nlp_monthly_budget') or 30000)
+# Same as the classifier function's per-run cap, given its 60 minutes timeout
+_MAX_KW_PER_RUN = 30000
+
+NLP = 'nlp'
+ADS = 'ads'
+
+
+class QuotaLedger(SharedQuotaLedger):
+    """The ledger next to the app's config file.
+    Args:
+      path: Local or gs:// path of the ledger file. Defaults to ledger.json
+        next to the config file.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        super().__init__(path or ledger_path(_get_config_file_path()),
+                         _get_storage_client)
+
+    def remaining(self, service: str, monthly_budget: int,
+                  when: Optional[datetime] = None) -> int:
+        used = self.usage(when).get(service, {}).get('month', 0)
+        return max(0, monthly_budget - used)
+
+
+def classification_budget(ledger: QuotaLedger) -> int:
+    """Number of keywords that can be classified in this run."""
+    try:
+        remaining = ledger.remaining(NLP, _NLP_MONTHLY_BUDGET)
+    except Exception as e:
+        logging.warning(f"Could not read quota ledger, assuming a full budget: {e}")
+        remaining = _NLP_MONTHLY_BUDGET
+    return min(remaining, _MAX_KW_PER_RUN)
+
+
+def select_top_k(kws: Iterable[str], scores: Dict[str, float], k: int) -> List[str]:
+    """Orders keywords so the k highest scored come first.
+
+    The top k are picked in one pass with a bounded heap, ties keep the
+    original order, and the remaining keywords follow in original order.
+    """
+    kws = list(kws)
+    if k <= 0:
+        return kws
+    top = heapq.nlargest(k, range(len(kws)), key=lambda i: scores.get(kws[i], 0))
+    selected = set(top)
+    return [kws[i] for i in top] + [kw for i, kw in enumerate(kws) if i not in selected]
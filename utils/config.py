@@ -14,25 +14,126 @@
 
 from yaml.loader import SafeLoader
 from copy import deepcopy
-from google.cloud import storage
-from google.ads.googleads.client import GoogleAdsClient
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from functools import lru_cache
 from typing import Dict
 import os
+import threading
+import time
 import yaml
 import smart_open as smart_open
 import logging
 
 _ADS_API_VERSION = 'v14'
 _CONFIG_PATH = 'gs://{project_id}-keyword_factory/config.yaml'
+# Seconds a cached config is trusted before checking the file's generation again
+_CONFIG_CACHE_TTL = float(os.getenv('config_cache_ttl') or 30)
 SHEETS_SERVICE_SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets',
     'https://www.googleapis.com/auth/drive.file', 
     'https://www.googleapis.com/auth/drive'
     ]
 
+
+@lru_cache(maxsize=None)
+def _get_storage_client():
+    from google.cloud import storage
+    return storage.Client()
+
+
+_config_file_path = None
+
+
+def _get_config_file_path() -> str:
+    """Resolves the config path once per process, creating a storage client is slow.
+    The local fallback isn't cached, so a transient storage or auth error
+    doesn't pin the process to the local file.
+    """
+    global _config_file_path
+    if _config_file_path is None:
+        try:
+            project_id = _get_storage_client().project
+        except Exception as e:
+            logging.warning(f"Could not resolve the config bucket, using config.yaml: {e}")
+            return 'config.yaml'
+        _config_file_path = _CONFIG_PATH.format(project_id=project_id)
+    return _config_file_path
+
+
+def _get_file_version(path: str):
+    """Returns the GCS generation or local mtime of a file, raises if it doesn't exist."""
+    if path.startswith('gs://'):
+        bucket_name, blob_name = path[len('gs://'):].split('/', 1)
+        blob = _get_storage_client().bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            raise FileNotFoundError(path)
+        return blob.generation
+    return os.stat(path).st_mtime_ns
+
+
+class ConfigCache:
+    """Process wide cache of config files' content.
+
+    Within the TTL the cached content is returned as is. After it, only the
+    file's generation (mtime for local files) is fetched, and the content is
+    read again only if it changed.
+    """
+
+    def __init__(self, ttl: float = _CONFIG_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'revalidations': 0, 'misses': 0, 'hit_seconds': 0.0}
+
+    def read(self, path: str) -> bytes:
+        start = time.perf_counter()
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry and time.monotonic() - entry['checked_at'] < self.ttl:
+            return self._hit(entry, start)
+
+        version = _get_file_version(path)
+        if entry and entry['version'] == version:
+            with self._lock:
+                entry['checked_at'] = time.monotonic()
+                self.stats['revalidations'] += 1
+            return self._hit(entry, start)
+
+        with smart_open.open(path, "rb") as f:
+            content = f.read()
+        with self._lock:
+            self._entries[path] = {'content': content, 'version': version,
+                                   'checked_at': time.monotonic()}
+            self.stats['misses'] += 1
+        logging.info(f"Config cache miss for {path}, "
+                     f"read in {time.perf_counter() - start:.3f}s")
+        return content
+
+    def _hit(self, entry, start) -> bytes:
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.stats['hits'] += 1
+            self.stats['hit_seconds'] += elapsed
+        logging.debug(f"Config cache hit in {elapsed * 1000:.2f}ms")
+        return entry['content']
+
+    def invalidate(self, path: str = None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self.stats)
+        stats['avg_hit_ms'] = (stats['hit_seconds'] / stats['hits'] * 1000
+                               if stats['hits'] else 0.0)
+        return stats
+
+
+config_cache = ConfigCache()
+
+
 class Config:
     def __init__(self, ok_if_not_exists = False) -> None:
 
@@ -51,14 +152,7 @@ class Config:
         self.check_valid_config()
 
     def _config_file_path_set(self):
-        file_path = ''
-        try:
-            client = storage.Client()
-            project_id = client.project
-            file_path = _CONFIG_PATH.format(project_id=project_id)
-        except:
-            file_path = 'config.yaml'
-        return file_path
+        return _get_config_file_path()
     
     def check_valid_config(self):
         if self.client_id and self.client_secret and self.refresh_token and self.developer_token and self.login_customer_id:
@@ -70,8 +164,7 @@ class Config:
     def load_config_from_file(self, ok_if_not_exists = False) -> dict:
         config_file_path = self.file_path
         try:
-            with smart_open.open(config_file_path, "rb") as f:
-                content = f.read()
+            content = config_cache.read(config_file_path)
         except BaseException as e:
             logging.error(f"Config file {config_file_path} was not found: {str(e)}")
             if ok_if_not_exists:
@@ -91,6 +184,7 @@ class Config:
         try:
             with smart_open.open(self.file_path, 'w') as f:
                 yaml.dump(self.to_dict(), f)
+            config_cache.invalidate(self.file_path)
             logging.info(f"Configurations updated in {self.file_path}")
         except Exception as e:
             logging.error(f"Could not write configurations to {self.file_path} file: {str(e)}")
@@ -109,7 +203,18 @@ class Config:
         }
 
 
+    def for_mcc(self, login_customer_id: str, spreadsheet_url: str = '') -> 'Config':
+        """ Return a copy of the config sharing credentials, for another MCC"""
+        config = deepcopy(self)
+        config.login_customer_id = str(login_customer_id)
+        config.spreadsheet_url = spreadsheet_url
+        config.check_valid_config()
+        return config
+
+
     def get_ads_client(self):
+        from google.ads.googleads.client import GoogleAdsClient
+
         return GoogleAdsClient.load_from_dict({
             'client_id': self.client_id,
             'client_secret': self.client_secret,
@@ -121,6 +226,10 @@ class Config:
 
 
     def get_sheets_service(self):
+        from google.oauth2.credentials import Credentials
+        from google.auth.transport.requests import Request
+        from googleapiclient.discovery import build
+
         user_info = {
             "client_id": self.client_id,
             "refresh_token": self.refresh_token,
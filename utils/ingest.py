@@ -0,0 +1,142 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import IO, Iterator, Optional
+import csv
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import time
+import uuid
+import smart_open as smart_open
+
+_SPOOL_PREFIX = 'keyword_factory_upload_'
+
+
+def normalize_keyword(kw: str, lowercase: bool = True) -> str:
+    """Strips and collapses whitespace so equal keywords compare equal."""
+    kw = ' '.join(kw.split())
+    if lowercase:
+        kw = kw.lower()
+    return kw
+
+
+class KeywordSpool:
+    """A deduplicated keyword list spooled to a local or GCS file.
+
+    Keeps only the spool path and the keyword count in memory, so it is
+    cheap to hold in the Streamlit session state. Iterating reads the
+    keywords back one by one.
+    """
+
+    def __init__(self, path: str, count: int = 0, stats: Optional[dict] = None):
+        self.path = path
+        self.count = count
+        self.stats = stats or {}
+
+    def __iter__(self) -> Iterator[str]:
+        with smart_open.open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                kw = line.rstrip('\n')
+                if kw:
+                    yield kw
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __bool__(self) -> bool:
+        return self.count > 0
+
+    def delete(self):
+        """Removes the local spool file. GCS spools are left to bucket lifecycle rules."""
+        if not self.path.startswith('gs://') and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class CsvIngestor:
+    """Streams keywords out of an uploaded CSV file.
+
+    The file is decoded incrementally and every keyword is normalized and
+    deduplicated on the fly before being spooled, so the whole upload is
+    never held in memory as text or as a list.
+
+    Args:
+      column: Zero based index of the column holding the keywords.
+      has_header: Whether the first row is a header and should be skipped.
+      lowercase: Whether to lowercase keywords while normalizing.
+      spool_dir: Local directory or gs:// prefix to spool keywords to.
+        Defaults to the system temp directory.
+      encoding: Encoding of the uploaded file.
+    """
+
+    def __init__(self, column: int = 0, has_header: bool = False,
+                 lowercase: bool = True, spool_dir: Optional[str] = None,
+                 encoding: str = 'utf-8-sig'):
+        self.column = column
+        self.has_header = has_header
+        self.lowercase = lowercase
+        self.spool_dir = spool_dir or tempfile.gettempdir()
+        self.encoding = encoding
+
+    def _spool_path(self) -> str:
+        name = f'{_SPOOL_PREFIX}{uuid.uuid4().hex}.txt'
+        if self.spool_dir.startswith('gs://'):
+            return self.spool_dir.rstrip('/') + '/' + name
+        return os.path.join(self.spool_dir, name)
+
+    def iter_keywords(self, binary_file: IO[bytes]) -> Iterator[str]:
+        """Yields normalized, deduplicated keywords from a binary file object."""
+        text = io.TextIOWrapper(binary_file, encoding=self.encoding,
+                                errors='replace', newline='')
+        # Only fixed size digests are kept to dedup, not the keywords themselves
+        seen = set()
+        try:
+            reader = csv.reader(text)
+            if self.has_header:
+                next(reader, None)
+            for row in reader:
+                if len(row) <= self.column:
+                    continue
+                kw = normalize_keyword(row[self.column], self.lowercase)
+                if not kw:
+                    continue
+                digest = hashlib.blake2b(kw.encode('utf-8'), digest_size=8).digest()
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                yield kw
+        finally:
+            # Don't let the wrapper close the caller's file
+            text.detach()
+
+    def ingest(self, binary_file: IO[bytes]) -> KeywordSpool:
+        """Spools all keywords of the file and reports the ingest rate."""
+        path = self._spool_path()
+        start = time.perf_counter()
+        count = 0
+        with smart_open.open(path, 'w', encoding='utf-8') as out:
+            for kw in self.iter_keywords(binary_file):
+                out.write(kw + '\n')
+                count += 1
+        elapsed = time.perf_counter() - start
+        stats = {
+            'keywords': count,
+            'seconds': elapsed,
+            'keywords_per_second': count / elapsed if elapsed else float(count),
+        }
+        logging.info(f"Ingested {count} unique keywords to {path} in {elapsed:.2f}s "
+                     f"({stats['keywords_per_second']:.0f} kw/s)")
+        return KeywordSpool(path, count, stats)
@@ -0,0 +1,143 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lightweight leases on resources shared between sessions and instances.
+
+A lease is an object in the config bucket (or a file in the temp dir when
+running locally) created with a does-not-exist precondition, so only one holder
+can create it. Leases expire after their TTL, so a crashed holder never
+blocks the others for long.
+"""
+
+from utils.config import _get_config_file_path, _get_storage_client
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+_LEASES_DIR = 'leases'
+# Local leases are shared by the processes of a machine, not of a working dir
+_LOCAL_LEASES_DIR = os.path.join(tempfile.gettempdir(), 'keyword_factory_leases')
+_DEFAULT_TTL = 60
+_POLL_INTERVAL = 0.5
+
+
+class LeaseTimeout(Exception):
+    pass
+
+
+class Lease:
+    """A named lease, usable as a context manager.
+    Args:
+      name: Name of the shared resource.
+      ttl: Seconds after which the lease is considered abandoned.
+      timeout: Max seconds to wait for the lease when entering the context.
+    """
+
+    def __init__(self, name: str, ttl: float = _DEFAULT_TTL, timeout: float = _DEFAULT_TTL):
+        self.name = name
+        self.ttl = ttl
+        self.timeout = timeout
+        self.owner = uuid.uuid4().hex
+        base = os.path.dirname(_get_config_file_path())
+        if base.startswith('gs://'):
+            self.path = f'{base}/{_LEASES_DIR}/{name}'
+        else:
+            self.path = os.path.join(_LOCAL_LEASES_DIR, name)
+        self._generation = None
+
+    def _content(self) -> str:
+        return json.dumps({'owner': self.owner, 'expires': time.time() + self.ttl})
+
+    @staticmethod
+    def _expired(content) -> bool:
+        try:
+            return json.loads(content)['expires'] < time.time()
+        except (ValueError, KeyError, TypeError):
+            return True
+
+    def _try_acquire_gcs(self) -> bool:
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+
+        bucket_name, blob_name = self.path[len('gs://'):].split('/', 1)
+        blob = _get_storage_client().bucket(bucket_name).blob(blob_name)
+        try:
+            blob.upload_from_string(self._content(), if_generation_match=0)
+            self._generation = blob.generation
+            return True
+        except PreconditionFailed:
+            pass
+        try:
+            current = _get_storage_client().bucket(bucket_name).get_blob(blob_name)
+            if current is not None and self._expired(current.download_as_bytes()):
+                logging.warning(f"Breaking expired lease {self.path}")
+                current.delete(if_generation_match=current.generation)
+        except (NotFound, PreconditionFailed):
+            pass
+        return False
+
+    def _try_acquire_local(self) -> bool:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(self.path) as f:
+                    if self._expired(f.read()):
+                        logging.warning(f"Breaking expired lease {self.path}")
+                        os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self._content())
+        return True
+
+    def acquire(self, timeout: float = None) -> bool:
+        """Waits up to timeout seconds for the lease, returns whether it was acquired."""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        try_acquire = (self._try_acquire_gcs if self.path.startswith('gs://')
+                       else self._try_acquire_local)
+        while True:
+            if try_acquire():
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(_POLL_INTERVAL)
+
+    def release(self):
+        try:
+            if self.path.startswith('gs://'):
+                bucket_name, blob_name = self.path[len('gs://'):].split('/', 1)
+                _get_storage_client().bucket(bucket_name).blob(blob_name).delete(
+                    if_generation_match=self._generation)
+            else:
+                with open(self.path) as f:
+                    if json.loads(f.read()).get('owner') != self.owner:
+                        raise RuntimeError("lease is held by another owner")
+                os.remove(self.path)
+        except Exception as e:
+            # Expired and taken over by someone else, nothing to release
+            logging.warning(f"Could not release lease {self.path}: {e}")
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LeaseTimeout(f"Timed out waiting for lease {self.path}")
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
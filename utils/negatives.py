@@ -0,0 +1,239 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Detection of keywords blocked by existing negative keywords.
+
+Negative keywords of campaigns, ad groups and shared negative lists are
+compiled into one matcher over interned tokens, with Google Ads negative
+match semantics (no close variants):
+  * exact - the keyword's tokens equal the negative's, in order
+  * phrase - the negative's tokens appear in the keyword, contiguous and
+    in order. Phrase negatives are a token trie walked from every token
+    of the keyword, i.e. an Aho-Corasick automaton without failure links,
+    which keywords are too short to need.
+  * broad - all of the negative's tokens appear in the keyword, in any
+    order. Broad negatives are a trie of their sorted unique token ids,
+    walked with the ascending subsequences of the keyword's token ids.
+
+Matching only follows trie paths made of the keyword's own tokens, so its
+cost depends on the keyword's length and not on the number of negatives.
+
+A negative only blocks a keyword where it applies: in its campaign, in its
+ad group, or for shared lists in the campaigns using them (lists no
+campaign uses block nothing). So a keyword is blocked at the ad group it's
+routed to, or, unrouted, may be blocked in some of the accounts' enabled
+ad groups or in all of them.
+"""
+
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+EXACT = 'EXACT'
+PHRASE = 'PHRASE'
+BROAD = 'BROAD'
+
+# Keys of the end-of-phrase entries in trie nodes, can't collide with token ids
+_END = -1
+
+
+def _tokens(text: str) -> List[str]:
+    # Negatives ignore the brackets and quotes of their match type notation
+    return text.lower().replace('[', ' ').replace(']', ' ').replace('"', ' ').split()
+
+
+def describe(negative: Tuple[str, str, str, str, str]) -> str:
+    """Formats a negative as returned by matches, e.g. 'campaign 123 in 456: "red shoes"'."""
+    customer_id, scope, scope_id, text, match_type = negative
+    notation = {EXACT: '[{}]', PHRASE: '"{}"'}.get(match_type, '{}')
+    return f"{scope} {scope_id} in {customer_id}: {notation.format(text)}"
+
+
+class NegativeMatcher:
+    """Compiled negative keywords of one or more accounts, with the ad groups
+    and campaigns they apply to. Add every account with add, then call
+    conflicts.
+    """
+
+    def __init__(self):
+        self._token_ids: Dict[str, int] = {}
+        self._negatives: List[Tuple[str, str, str, str, str]] = []
+        # Campaigns and ad groups every negative applies to, as (customer ID, ID)
+        self._campaigns: List[Tuple[Tuple[str, str], ...]] = []
+        self._ad_groups: List[Tuple[Tuple[str, str], ...]] = []
+        # Enabled ad groups of every account, by ID, with their campaign
+        self._account_ad_groups: Dict[str, Dict[str, str]] = {}
+        self._campaign_sizes: Dict[str, Counter] = {}
+        self._exact: Dict[Tuple[int, ...], List[int]] = {}
+        self._trie: dict = {}
+        self._broad_trie: dict = {}
+
+    def __len__(self):
+        return len(self._negatives)
+
+    @property
+    def accounts(self) -> List[str]:
+        return list(self._account_ad_groups)
+
+    def add(self, customer_id: str, negatives: Iterable[Tuple[str, str, str, str]],
+            ad_groups: Iterable[Tuple[str, str]] = (),
+            campaign_shared_sets: Iterable[Tuple[str, str]] = ()):
+        """Adds an account.
+        Args:
+          customer_id: The account.
+          negatives: (scope, scope ID, text, match type) tuples, scope is one
+            of 'campaign', 'ad group' and 'shared set'. The first negative
+            added is reported when several block a keyword.
+          ad_groups: (campaign ID, ad group ID) of the account's enabled ad
+            groups, where keywords can go.
+          campaign_shared_sets: (campaign ID, shared set ID) of the shared
+            negative lists used by the account's campaigns.
+        """
+        customer_id = str(customer_id)
+        account_ad_groups = self._account_ad_groups.setdefault(customer_id, {})
+        for campaign_id, ad_group_id in ad_groups:
+            account_ad_groups[str(ad_group_id)] = str(campaign_id)
+        self._campaign_sizes[customer_id] = Counter(account_ad_groups.values())
+        set_campaigns = {}
+        for campaign_id, shared_set_id in campaign_shared_sets:
+            set_campaigns.setdefault(str(shared_set_id), []).append((customer_id, str(campaign_id)))
+
+        for scope, scope_id, text, match_type in negatives:
+            scope_id = str(scope_id)
+            scope_campaigns, scope_ad_groups = (), ()
+            if scope == 'campaign':
+                scope_campaigns = ((customer_id, scope_id),)
+            elif scope == 'ad group':
+                scope_ad_groups = ((customer_id, scope_id),)
+            else:
+                scope_campaigns = tuple(set_campaigns.get(scope_id, ()))
+            tokens = _tokens(text)
+            if not tokens or not (scope_campaigns or scope_ad_groups):
+                continue
+            ids = tuple(self._token_ids.setdefault(token, len(self._token_ids))
+                        for token in tokens)
+            negative = len(self._negatives)
+            self._negatives.append((customer_id, scope, scope_id, text, match_type))
+            self._campaigns.append(scope_campaigns)
+            self._ad_groups.append(scope_ad_groups)
+            if match_type == EXACT:
+                self._exact.setdefault(ids, []).append(negative)
+                continue
+            if match_type == PHRASE:
+                node = self._trie
+            else:
+                node = self._broad_trie
+                ids = sorted(set(ids))
+            for token_id in ids:
+                node = node.setdefault(token_id, {})
+            node.setdefault(_END, []).append(negative)
+
+    def _match_ids(self, kw: str) -> List[int]:
+        """Returns the ids of all negatives whose text blocks the keyword, in order added."""
+        token_ids = self._token_ids
+        ids = []
+        for token in kw.lower().split():
+            token_id = token_ids.get(token)
+            # Unknown tokens are kept as gaps, they break phrases and exact matches
+            ids.append(-2 if token_id is None else token_id)
+        if not ids:
+            return []
+
+        found = list(self._exact.get(tuple(ids), ()))
+        trie = self._trie
+        if trie:
+            for start in range(len(ids)):
+                node = trie
+                for token_id in ids[start:]:
+                    node = node.get(token_id)
+                    if node is None:
+                        break
+                    found += node.get(_END, ())
+        if self._broad_trie:
+            present = sorted(set(ids))
+            stack = [(self._broad_trie, 0)]
+            while stack:
+                node, start = stack.pop()
+                for i in range(start, len(present)):
+                    child = node.get(present[i])
+                    if child is None:
+                        continue
+                    found += child.get(_END, ())
+                    stack.append((child, i + 1))
+        return sorted(set(found))
+
+    def matches(self, kw: str) -> List[Tuple[str, str, str, str, str]]:
+        """Returns all negatives whose text blocks the keyword wherever they
+        apply, as (customer ID, scope, scope ID, text, match type)."""
+        return [self._negatives[i] for i in self._match_ids(kw)]
+
+    def conflict(self, kw: str, route: Optional[Tuple[str, str]] = None,
+                 accounts: Optional[Sequence[str]] = None
+                 ) -> Optional[Tuple[Tuple[str, str, str, str, str], bool]]:
+        """Returns the first negative blocking the keyword and whether it's
+        blocked wherever it would go, or None if it's blocked nowhere.
+        Args:
+          kw: The keyword.
+          route: Optional (customer ID, ad group ID) the keyword goes to,
+            then only negatives applying there count.
+          accounts: The accounts an unrouted keyword can go to, all added
+            accounts by default. Accounts that weren't added block nothing.
+        """
+        found = self._match_ids(kw)
+        if not found:
+            return None
+        if route is not None:
+            customer_id, ad_group_id = str(route[0]), str(route[1])
+            campaign = (customer_id, self._account_ad_groups.get(customer_id, {}).get(ad_group_id))
+            ad_group = (customer_id, ad_group_id)
+            for negative in found:
+                if campaign in self._campaigns[negative] or ad_group in self._ad_groups[negative]:
+                    return self._negatives[negative], True
+            return None
+        campaigns = {campaign for negative in found for campaign in self._campaigns[negative]}
+        ad_groups = {ad_group for negative in found for ad_group in self._ad_groups[negative]}
+        accounts = self.accounts if accounts is None else [str(a) for a in accounts]
+        return self._negatives[found[0]], self._blocks_all(campaigns, ad_groups, accounts)
+
+    def _blocks_all(self, campaigns: Set[Tuple[str, str]], ad_groups: Set[Tuple[str, str]],
+                    accounts: List[str]) -> bool:
+        """Whether every enabled ad group of every account is in one of the
+        blocked campaigns or ad groups."""
+        if not accounts:
+            return False
+        blocked_customers = {customer_id for customer_id, _ in campaigns}
+        blocked_customers.update(customer_id for customer_id, _ in ad_groups)
+        # Cheap rejection, most keywords are blocked in a few accounts at most
+        if any(account not in blocked_customers for account in accounts):
+            return False
+        for account in accounts:
+            account_ad_groups = self._account_ad_groups.get(account)
+            if not account_ad_groups:
+                return False
+            # Ad groups blocked one by one, per campaign not blocked as a whole
+            partial = Counter(account_ad_groups.get(ad_group_id)
+                              for customer_id, ad_group_id in ad_groups
+                              if customer_id == account)
+            for campaign_id, size in self._campaign_sizes[account].items():
+                if (account, campaign_id) not in campaigns and partial[campaign_id] < size:
+                    return False
+        return True
+
+    def conflicts(self, kws: Iterable[str],
+                  routes: Optional[Iterable[Optional[Tuple[str, str]]]] = None,
+                  accounts: Optional[Sequence[str]] = None
+                  ) -> List[Optional[Tuple[Tuple[str, str, str, str, str], bool]]]:
+        """Returns conflict of every keyword, with its route if routes are given."""
+        if routes is None:
+            return [self.conflict(kw, accounts=accounts) for kw in kws]
+        return [self.conflict(kw, route, accounts) for kw, route in zip(kws, routes)]
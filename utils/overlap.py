@@ -0,0 +1,202 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cross-account keyword overlap, from an account x keyword incidence matrix.
+
+A is the sparse 0/1 matrix with a row per account and a column per distinct
+keyword, kept in CSR (by account) and CSC (by keyword) arrays. Keywords are
+interned to column ids by their 64-bit hash, so the strings of tens of
+millions of criteria are never held. Then:
+  * coverage, the number of accounts running each keyword, is the column
+    sums of A (A^T 1)
+  * overlap, the number of keywords every two accounts share, is A A^T.
+    Columns of keywords few accounts run are multiplied sparsely, by
+    expanding each row entry into its column's accounts, in batches of
+    bounded size. Columns of keywords run by many accounts would expand
+    quadratically, so they're multiplied as dense blocks instead.
+"""
+
+from array import array
+from typing import Iterable, List, Tuple
+import logging
+import time
+import numpy as np
+
+# Max (account, account) pairs expanded per sparse batch, and cells of the
+# overlap rows accumulated per batch, bound memory use
+_MAX_PAIRS = 4000000
+_MAX_BLOCK_CELLS = 4000000
+# Keywords run by more than this share of the accounts are multiplied densely
+_DENSE_COVERAGE_SHARE = 1 / 8
+# Columns per dense block
+_DENSE_BLOCK_COLUMNS = 1024
+_OVERLAP_ROWS = 10000
+
+
+class KeywordOverlap:
+    """Incidence matrix of the accounts' existing keywords.
+    Add every account's keywords with add, then call coverage, overlap or
+    summary.
+    """
+
+    def __init__(self):
+        self._accounts: List[str] = []
+        # Keyword hashes of every account, one block per account, compact until finalized
+        self._entry_hashes = array('q')
+        self._sizes = array('q')
+        self._hashes = None
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def add(self, customer_id: str, keywords: Iterable[str]):
+        """Adds an account's keywords, once per account. Duplicates, e.g. the
+        same keyword in several ad groups, count once."""
+        hashes = np.unique(np.fromiter(map(hash, keywords), dtype=np.int64))
+        self._accounts.append(str(customer_id))
+        self._entry_hashes.frombytes(hashes.tobytes())
+        self._sizes.append(len(hashes))
+        self._hashes = None
+
+    def _finalize(self):
+        """Interns the keywords and builds the CSR and CSC arrays."""
+        start = time.perf_counter()
+        n_accounts = len(self._accounts)
+        self._hashes, keywords = np.unique(
+            np.frombuffer(self._entry_hashes, dtype=np.int64), return_inverse=True)
+        # Ids and account numbers fit 32 bits, halving the arrays kept
+        self._rows = np.repeat(np.arange(n_accounts, dtype=np.int32),
+                               np.frombuffer(self._sizes, dtype=np.int64))
+        # CSR: keyword ids of every account's row, the accounts in order
+        self._indices = keywords.reshape(-1).astype(np.int32)
+        del keywords
+        self._indptr = np.concatenate([[0], np.cumsum(self._sizes)])
+        # CSC: accounts of every keyword's column
+        self._coverage = np.bincount(self._indices, minlength=len(self._hashes))
+        self._col_indptr = np.concatenate([[0], np.cumsum(self._coverage)])
+        self._col_accounts = self._rows[np.argsort(self._indices, kind='stable')]
+        logging.info(f"Built the {n_accounts} x {len(self._hashes)} keyword incidence matrix "
+                     f"with {len(self._indices)} entries in {time.perf_counter() - start:.2f}s")
+
+    @property
+    def criteria(self) -> int:
+        """Number of distinct (account, keyword) entries."""
+        if self._hashes is None:
+            self._finalize()
+        return len(self._indices)
+
+    @property
+    def shared_keywords(self) -> int:
+        """Number of keywords more than one account runs."""
+        if self._hashes is None:
+            self._finalize()
+        return int(np.count_nonzero(self._coverage > 1))
+
+    @property
+    def keywords(self) -> int:
+        """Number of distinct keywords."""
+        if self._hashes is None:
+            self._finalize()
+        return len(self._hashes)
+
+    def coverage(self, kws: List[str]) -> np.ndarray:
+        """Returns the number of accounts running each keyword."""
+        if self._hashes is None:
+            self._finalize()
+        hashes = np.fromiter(map(hash, kws), dtype=np.int64, count=len(kws))
+        if not len(self._hashes):
+            return np.zeros(len(kws), dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._hashes, hashes), len(self._hashes) - 1)
+        return np.where(self._hashes[positions] == hashes, self._coverage[positions], 0)
+
+    def overlap(self) -> np.ndarray:
+        """Returns the accounts x accounts matrix A A^T of shared keywords,
+        with every account's number of keywords on the diagonal. Rows and
+        columns follow the order the accounts were added in."""
+        if self._hashes is None:
+            self._finalize()
+        n = len(self._accounts)
+        # Accounts have fewer than 2^31 keywords, halving the dense result
+        result = np.zeros((n, n), dtype=np.int32)
+        if not n or not len(self._indices):
+            return result
+        dense = self._coverage > max(1, n * _DENSE_COVERAGE_SHARE)
+        self._sparse_product(result, ~dense[self._indices])
+        self._dense_product(result, np.flatnonzero(dense))
+        return result
+
+    def _sparse_product(self, result: np.ndarray, light: np.ndarray):
+        """Adds the products of the light entries' columns, block of rows by block of rows."""
+        n = len(self._accounts)
+        rows_per_block = max(1, _MAX_BLOCK_CELLS // n)
+        for row_start in range(0, n, rows_per_block):
+            row_end = min(n, row_start + rows_per_block)
+            entries = np.arange(self._indptr[row_start], self._indptr[row_end])
+            entries = entries[light[entries]]
+            lengths = self._coverage[self._indices[entries]]
+            cumulative = np.cumsum(lengths)
+            if not len(cumulative):
+                continue
+            boundaries = np.searchsorted(cumulative, np.arange(
+                _MAX_PAIRS, cumulative[-1] + _MAX_PAIRS, _MAX_PAIRS), side='right')
+            counts = np.zeros((row_end - row_start) * n, dtype=np.int64)
+            for batch in np.split(entries, np.unique(boundaries)):
+                if not len(batch):
+                    continue
+                keywords = self._indices[batch]
+                lengths = self._coverage[keywords]
+                total = int(lengths.sum())
+                positions = (np.repeat(self._col_indptr[keywords], lengths) + np.arange(total)
+                             - np.repeat(np.cumsum(lengths) - lengths, lengths))
+                cells = (np.repeat(self._rows[batch] - row_start, lengths) * n
+                         + self._col_accounts[positions])
+                counts += np.bincount(cells, minlength=len(counts))
+            result[row_start:row_end] += counts.reshape(-1, n)
+
+    def _dense_product(self, result: np.ndarray, keywords: np.ndarray):
+        """Adds the products of the given columns, as dense blocks."""
+        n = len(self._accounts)
+        for start in range(0, len(keywords), _DENSE_BLOCK_COLUMNS):
+            block = keywords[start:start + _DENSE_BLOCK_COLUMNS]
+            lengths = self._coverage[block]
+            total = int(lengths.sum())
+            positions = (np.repeat(self._col_indptr[block], lengths) + np.arange(total)
+                         - np.repeat(np.cumsum(lengths) - lengths, lengths))
+            matrix = np.zeros((n, len(block)), dtype=np.float32)
+            matrix[self._col_accounts[positions], np.repeat(np.arange(len(block)), lengths)] = 1
+            # Counts up to the block's width are exact in float32
+            result += np.rint(matrix @ matrix.T).astype(np.int32)
+
+    def summary(self, overlap: np.ndarray = None,
+                rows: int = _OVERLAP_ROWS) -> List[Tuple[str, str, int, float, float, float]]:
+        """Returns the account pairs sharing the most keywords, as (account,
+        other account, shared keywords, Jaccard similarity, share of the
+        account's keywords, share of the other's)."""
+        overlap = self.overlap() if overlap is None else overlap
+        n = len(self._accounts)
+        sizes = np.diag(overlap)
+        shared = np.triu(overlap, 1).ravel()
+        count = min(rows, int(np.count_nonzero(shared)))
+        if not count:
+            return []
+        top = np.argpartition(-shared, count - 1)[:count]
+        top = top[np.argsort(-shared[top], kind='stable')]
+        pairs = []
+        for cell in top:
+            i, j = divmod(int(cell), n)
+            both = int(shared[cell])
+            pairs.append((self._accounts[i], self._accounts[j], both,
+                          round(both / int(sizes[i] + sizes[j] - both), 4),
+                          round(both / int(sizes[i]), 4), round(both / int(sizes[j]), 4)))
+        return pairs
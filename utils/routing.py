@@ -0,0 +1,225 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Routing of new keywords to the best matching existing ad group.
+
+Every ad group is a document made of its keywords' tokens. The index maps
+each token to the ad groups using it (a posting list), weighted by TF-IDF
+and L2 normalized per ad group, so a new keyword's score for an ad group is
+the cosine similarity of their token vectors.
+
+Scoring is vectorized over chunks of keywords and exact, but avoids
+expanding the long posting lists of common tokens (MaxScore pruning):
+candidates come from the postings of every keyword's rarest token and are
+scored with lookups of all its tokens. An ad group without that token can
+score at most the sum of the other tokens' max weights, so keywords whose
+best candidate beats that bound are done. The rest try again with their
+two rarest tokens, and so on.
+"""
+
+from array import array
+from typing import Iterable, List, Optional, Tuple
+import logging
+import time
+import numpy as np
+
+# Keywords tokenized and scored per chunk
+_ROUTE_CHUNK_SIZE = 50000
+# Max (candidate, token) lookups per numpy batch, bounds memory use
+_MAX_LOOKUPS = 4000000
+
+
+def tokenize(text: str) -> List[str]:
+    return text.lower().split()
+
+
+class AdGroupIndex:
+    """Token to ad group inverted index with TF-IDF weights.
+    Add the keywords of every account with add, then call route. Ad groups
+    are identified by (customer ID, ad group ID).
+    """
+
+    def __init__(self):
+        self._token_ids = {}
+        self._ad_group_ids = {}
+        self._ad_groups: List[Tuple[str, str]] = []
+        # One (token, ad group) entry per token of every keyword, compact until finalized
+        self._entry_tokens = array('q')
+        self._entry_ad_groups = array('q')
+        self._indptr = None
+        self._pair_keys = None
+        self._weights = None
+        self._max_weights = None
+        self._idf = None
+
+    def add(self, customer_id: str, criteria: Iterable[Tuple[str, str]]):
+        """Adds an account's keywords, as (ad group ID, keyword text) pairs."""
+        customer_id = str(customer_id)
+        token_ids = self._token_ids
+        ad_group_ids = self._ad_group_ids
+        for ad_group_id, text in criteria:
+            key = (customer_id, str(ad_group_id))
+            ad_group = ad_group_ids.get(key)
+            if ad_group is None:
+                ad_group = ad_group_ids[key] = len(self._ad_groups)
+                self._ad_groups.append(key)
+            for token in tokenize(text):
+                token_id = token_ids.setdefault(token, len(token_ids))
+                self._entry_tokens.append(token_id)
+                self._entry_ad_groups.append(ad_group)
+        self._indptr = None
+
+    def __len__(self):
+        return len(self._ad_groups)
+
+    def _finalize(self):
+        """Builds the posting lists, sorted by token, from the added entries."""
+        n_ad_groups = max(1, len(self._ad_groups))
+        tokens = np.frombuffer(self._entry_tokens, dtype=np.int64)
+        ad_groups = np.frombuffer(self._entry_ad_groups, dtype=np.int64)
+        pairs, tf = np.unique(tokens * n_ad_groups + ad_groups, return_counts=True)
+        pair_tokens = pairs // n_ad_groups
+        pair_ad_groups = pairs % n_ad_groups
+
+        df = np.bincount(pair_tokens, minlength=len(self._token_ids))
+        self._idf = np.log((1 + n_ad_groups) / (1 + df)) + 1
+        weights = (1 + np.log(tf)) * self._idf[pair_tokens]
+        norms = np.sqrt(np.bincount(pair_ad_groups, weights=weights ** 2, minlength=n_ad_groups))
+        # Postings are the (token, ad group) keys, sorted by token and then ad group
+        self._pair_keys = pairs
+        self._weights = weights / norms[pair_ad_groups]
+        self._indptr = np.concatenate([[0], np.cumsum(df)])
+        self._max_weights = (np.maximum.reduceat(self._weights, self._indptr[:-1])
+                             if len(pairs) else np.zeros(0))
+        self._max_idf = np.log(1 + n_ad_groups) + 1
+
+    def route(self, kws: List[str]) -> List[Optional[Tuple[str, str, float]]]:
+        """Returns the best (customer ID, ad group ID, score) per keyword, or
+        None for keywords sharing no token with any ad group. Scores are
+        cosine similarities between 0 and 1."""
+        if self._indptr is None:
+            self._finalize()
+        start = time.perf_counter()
+        routes = []
+        for chunk_start in range(0, len(kws), _ROUTE_CHUNK_SIZE):
+            routes += self._route_chunk(kws[chunk_start:chunk_start + _ROUTE_CHUNK_SIZE])
+        elapsed = time.perf_counter() - start
+        logging.info(f"Routed {len(kws)} keywords to {len(self._ad_groups)} ad groups "
+                     f"in {elapsed:.2f}s, {sum(r is not None for r in routes)} matched")
+        return routes
+
+    def _route_chunk(self, kws: List[str]) -> List[Optional[Tuple[str, str, float]]]:
+        token_ids = self._token_ids
+        queries = []
+        tokens = []
+        query_norms = np.zeros(len(kws))
+        for i, kw in enumerate(kws):
+            norm = 0.0
+            for token in set(tokenize(kw)):
+                token_id = token_ids.get(token)
+                if token_id is None:
+                    # Unseen words make a keyword a worse match for every ad group
+                    norm += self._max_idf ** 2
+                    continue
+                norm += self._idf[token_id] ** 2
+                queries.append(i)
+                tokens.append(token_id)
+            query_norms[i] = np.sqrt(norm)
+
+        routes = [None] * len(kws)
+        if not tokens:
+            return routes
+        best_ad_groups, best_scores = self._score(
+            len(kws), np.array(queries, dtype=np.int64), np.array(tokens, dtype=np.int64))
+        for query in np.flatnonzero(best_ad_groups >= 0):
+            customer_id, ad_group_id = self._ad_groups[best_ad_groups[query]]
+            routes[query] = (customer_id, ad_group_id,
+                             round(float(best_scores[query] / query_norms[query]), 4))
+        return routes
+
+    def _score(self, n_queries: int, queries: np.ndarray, tokens: np.ndarray):
+        """Returns the best ad group per query (-1 if none) and its unnormalized score.
+        Args:
+          n_queries: Number of queries.
+          queries: Query of every (query, known token) entry, ascending.
+          tokens: Token of every entry.
+        """
+        df = self._indptr[tokens + 1] - self._indptr[tokens]
+        # Rank every query's tokens from the rarest
+        order = np.lexsort((df, queries))
+        queries, tokens, df = queries[order], tokens[order], df[order]
+        query_weights = self._idf[tokens]
+        counts = np.bincount(queries, minlength=n_queries)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        ranks = np.arange(len(queries)) - starts[queries]
+        upper_bounds = query_weights * self._max_weights[tokens]
+
+        best_ad_groups = np.full(n_queries, -1, dtype=np.int64)
+        best_scores = np.zeros(n_queries)
+        pending = counts > 0
+        rarest = 1
+        while pending.any():
+            essential = pending[queries] & (ranks < rarest)
+            for batch in self._batches(np.flatnonzero(pending), queries, essential, df, counts):
+                in_batch = np.zeros(n_queries, dtype=bool)
+                in_batch[batch] = True
+                entries = np.flatnonzero(essential & in_batch[queries])
+                candidate_queries, candidate_ad_groups = self._candidates(
+                    queries[entries], tokens[entries])
+                scores = self._exact_scores(candidate_queries, candidate_ad_groups,
+                                            starts, counts, tokens, query_weights)
+                order = np.lexsort((-scores, candidate_queries))
+                best = order[np.unique(candidate_queries[order], return_index=True)[1]]
+                best_ad_groups[candidate_queries[best]] = candidate_ad_groups[best]
+                best_scores[candidate_queries[best]] = scores[best]
+            # Ad groups without any essential token can't score more than this
+            rest = pending[queries] & (ranks >= rarest)
+            bounds = np.bincount(queries[rest], weights=upper_bounds[rest], minlength=n_queries)
+            pending &= best_scores < bounds
+            rarest += 1
+        return best_ad_groups, best_scores
+
+    def _batches(self, pending: np.ndarray, queries, essential, df, counts):
+        """Splits pending queries into batches of about _MAX_LOOKUPS lookups."""
+        candidates = np.bincount(queries[essential], weights=df[essential],
+                                 minlength=len(counts))
+        cumulative = np.cumsum(candidates[pending] * counts[pending])
+        boundaries = np.searchsorted(cumulative, np.arange(
+            _MAX_LOOKUPS, cumulative[-1] + _MAX_LOOKUPS, _MAX_LOOKUPS), side='right')
+        return [batch for batch in np.split(pending, np.unique(boundaries)) if len(batch)]
+
+    def _candidates(self, queries: np.ndarray, tokens: np.ndarray):
+        """Returns the unique (query, ad group) pairs in the given tokens' postings."""
+        lengths = self._indptr[tokens + 1] - self._indptr[tokens]
+        total = int(lengths.sum())
+        entry = np.repeat(np.arange(len(tokens)), lengths)
+        positions = (np.repeat(self._indptr[tokens], lengths) + np.arange(total)
+                     - np.repeat(np.cumsum(lengths) - lengths, lengths))
+        n_ad_groups = len(self._ad_groups)
+        pairs = np.unique(queries[entry] * n_ad_groups + self._pair_keys[positions] % n_ad_groups)
+        return pairs // n_ad_groups, pairs % n_ad_groups
+
+    def _exact_scores(self, candidate_queries, candidate_ad_groups, starts, counts,
+                      tokens, query_weights) -> np.ndarray:
+        """Scores candidates with all their query's tokens, by postings lookups."""
+        lookups = counts[candidate_queries]
+        total = int(lookups.sum())
+        candidate = np.repeat(np.arange(len(candidate_queries)), lookups)
+        entries = (np.repeat(starts[candidate_queries], lookups) + np.arange(total)
+                   - np.repeat(np.cumsum(lookups) - lookups, lookups))
+        keys = tokens[entries] * len(self._ad_groups) + candidate_ad_groups[candidate]
+        positions = np.minimum(np.searchsorted(self._pair_keys, keys), len(self._pair_keys) - 1)
+        hits = self._pair_keys[positions] == keys
+        contributions = np.where(hits, self._weights[positions] * query_weights[entries], 0)
+        return np.bincount(candidate, weights=contributions, minlength=len(candidate_queries))
@@ -0,0 +1,103 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bounded memory aggregation of search terms streamed from search_term_view.
+
+search_term_view has a row per search term and ad group, so large accounts
+stream millions of rows. The aggregator sums clicks and conversions per
+term as rows arrive and never keeps the rows. It holds at most twice its
+capacity in terms: once full, it keeps the capacity most clicked terms and
+drops the rest (a heavy hitters summary). A dropped term that shows up
+again starts over, so sums are exact unless the capacity was exceeded, and
+then are short by at most error clicks, the sum of the largest dropped sum
+of every compaction.
+"""
+
+from typing import Dict, List, Tuple
+
+
+class SearchTermAggregator:
+    """Sums of clicks and conversions, and number of accounts, per term.
+    Args:
+      capacity: Number of terms kept when compacting.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        # term -> [clicks, conversions, accounts]
+        self._terms: Dict[str, list] = {}
+        self.rows = 0
+        self.error = 0
+        self.peak_terms = 0
+
+    def __len__(self):
+        return len(self._terms)
+
+    def add(self, term: str, clicks: int, conversions: float):
+        """Adds a search_term_view row of a single account."""
+        self.rows += 1
+        entry = self._terms.get(term)
+        if entry is None:
+            self._terms[term] = [clicks, conversions, 1]
+            if len(self._terms) > 2 * self.capacity:
+                self._compact()
+        else:
+            entry[0] += clicks
+            entry[1] += conversions
+
+    def merge(self, other: 'SearchTermAggregator'):
+        """Adds the sums of another account's aggregator, e.g. one per thread."""
+        self.rows += other.rows
+        self.error += other.error
+        self.peak_terms = max(self.peak_terms, other.peak_terms)
+        terms = self._terms
+        for term, (clicks, conversions, accounts) in other._terms.items():
+            entry = terms.get(term)
+            if entry is None:
+                terms[term] = [clicks, conversions, accounts]
+            else:
+                entry[0] += clicks
+                entry[1] += conversions
+                entry[2] += accounts
+        if len(terms) > 2 * self.capacity:
+            self._compact()
+        self.peak_terms = max(self.peak_terms, len(terms))
+
+    def _compact(self):
+        """Keeps the capacity most clicked terms, the oldest ones on ties."""
+        terms = self._terms
+        self.peak_terms = max(self.peak_terms, len(terms))
+        # Sorting the sums alone is much faster than selecting the entries
+        threshold = sorted((entry[0] for entry in terms.values()), reverse=True)[self.capacity]
+        ties = self.capacity - sum(1 for entry in terms.values() if entry[0] > threshold)
+        kept = {}
+        for term, entry in terms.items():
+            if entry[0] > threshold:
+                kept[term] = entry
+            elif entry[0] == threshold and ties > 0:
+                kept[term] = entry
+                ties -= 1
+        # No dropped term had more clicks than the threshold
+        self.error += threshold
+        self._terms = kept
+
+    def candidates(self, min_clicks: int = 0,
+                   min_conversions: float = 0) -> List[Tuple[str, int, float, int]]:
+        """Returns (term, clicks, conversions, accounts) of the terms with at
+        least min_clicks and min_conversions, the most clicked first."""
+        candidates = [(term, clicks, conversions, accounts)
+                      for term, (clicks, conversions, accounts) in self._terms.items()
+                      if term and clicks >= min_clicks and conversions >= min_conversions]
+        candidates.sort(key=lambda candidate: (-candidate[1], -candidate[2]))
+        return candidates
@@ -12,17 +12,39 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import re
+import hashlib
 import logging
-from typing import List, Any, Dict
-from datetime import datetime
-from googleapiclient.errors import HttpError
+import uuid
+from typing import List, Any, Dict, Optional
+from datetime import datetime, timedelta
 
 _HEADER = ['Keyword', 'Full Category Path', 'Top Level', 'Bottom Level', 'Confidence']
 _RUN_DATETIME = datetime.now()
 _RUN_METADATA = f'Last run was completed on {_RUN_DATETIME}'
+# Written after _HEADER when keywords are routed to ad groups
+_ROUTING_HEADER = ['Customer ID', 'Ad Group ID', 'Route Score']
+# Written after _HEADER when keywords blocked by negative keywords are flagged
+_NEGATIVES_HEADER = 'Blocked By Negative'
+# Written after _HEADER when keywords come from more than one source
+_SOURCE_HEADER = 'Source'
+# Written after _HEADER when the accounts' keyword overlap is computed
+_COVERAGE_HEADER = 'Accounts Running'
+# Account pairs sharing the most keywords, written to the output tab's overlap tab
+_OVERLAP_HEADER = ['Customer ID', 'Other Customer ID', 'Shared Keywords', 'Jaccard',
+                   'Share Of Customer', 'Share Of Other']
+_OVERLAP_SUFFIX = '_overlap'
 _OUTPUT_SHEET = 'Output'
 _SS_NAME = 'Keyword Factory'
+# Older per-run output tabs are removed once there are more than these
+_MAX_RUN_SHEETS = 20
+# Younger tabs may still be being classified, the classifier function's timeout
+_PRUNE_MIN_AGE_SECONDS = int(os.getenv('prune_min_age_seconds') or 3600)
+_RUN_SHEET_TIME_FORMAT = '%Y%m%d_%H%M%S'
+# Rows per updateCells/appendCells request and requests per batchUpdate call
+_DIFF_ROWS_PER_REQUEST = 5000
+_DIFF_REQUESTS_PER_BATCH = 200
 
 class SheetsInteractor:
     def __init__(self, service, spreadsheet_url):
@@ -46,9 +68,15 @@ class SheetsInteractor:
         return spreadsheet_id
 
 
-    def write_to_sheet(self, values, sheet=_OUTPUT_SHEET):
+    def write_to_sheet(self, values, sheet=_OUTPUT_SHEET, diff=False, header=_HEADER):
+        """Writes rows under the header, replacing the sheet's content.
+        With diff, only rows that were inserted, removed or changed since
+        the last write are touched, see write_diff.
+        """
+        if diff:
+            return self.write_diff([header] + values, sheet)
         self._clear_sheet(sheet)
-        values.insert(0, _HEADER)
+        values.insert(0, header)
         range = sheet + '!A1:' + chr(len(values[0]) + 65) + str(len(values))
         body = {
             'values': values
@@ -66,6 +94,81 @@ class SheetsInteractor:
         values = results.get('values', [])
         return values
 
+    def write_diff(self, values, sheet=_OUTPUT_SHEET, remove_missing=True) -> Dict[str, int]:
+        """Makes the sheet hold `values` (header first), keyed by the first column.
+        Reads the sheet once and applies only the inserted, removed and
+        changed rows in as few batchUpdate calls as possible. Rows that
+        didn't change are left in place, new rows are appended at the end.
+        Args:
+          values: The rows to write, header first.
+          sheet: Name of the tab to write to.
+          remove_missing: Whether to delete rows whose key isn't in values.
+        Returns:
+          The number of rows per kind of change.
+        """
+        current = self.service.values().get(
+            spreadsheetId=self.spreadsheet_id, range=sheet + '!A:Z',
+            valueRenderOption='UNFORMATTED_VALUE').execute().get('values', [])
+        changed, removed, inserted = diff_rows(current, values)
+        if not remove_missing:
+            removed = []
+        sheet_id = self._get_sheet_id(sheet)
+        if sheet_id is None:
+            raise Exception(f"Sheet {sheet} not found")
+        requests = _diff_requests(sheet_id, changed, removed, inserted)
+        for i in range(0, len(requests), _DIFF_REQUESTS_PER_BATCH):
+            self.service.batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={'requests': requests[i:i + _DIFF_REQUESTS_PER_BATCH]}).execute()
+        stats = {'changed': len(changed), 'removed': len(removed),
+                 'inserted': len(inserted), 'unchanged': len(values) - len(changed) - len(inserted)}
+        logging.info(f"Diff write to {sheet}: {stats}, {len(requests)} requests")
+        return stats
+
+    def _get_sheet_id(self, sheet_name) -> Optional[int]:
+        spreadsheet = self.service.get(spreadsheetId=self.spreadsheet_id,
+                                       fields='sheets.properties').execute()
+        for properties in (sheet['properties'] for sheet in spreadsheet.get('sheets', [])):
+            if properties['title'] == sheet_name:
+                return properties['sheetId']
+        return None
+
+    def has_sheet(self, sheet_name) -> bool:
+        return self._get_sheet_id(sheet_name) is not None
+
+    def add_sheet(self, sheet_name):
+        """Adds a new tab to the spreadsheet."""
+        body = {'requests': [{'addSheet': {'properties': {'title': sheet_name}}}]}
+        self.service.batchUpdate(spreadsheetId=self.spreadsheet_id, body=body).execute()
+
+    def prune_run_sheets(self, keep=_MAX_RUN_SHEETS, min_age=_PRUNE_MIN_AGE_SECONDS):
+        """Deletes the oldest per-run output tabs, keeping the last `keep` ones
+        and any created less than min_age seconds ago, which a burst of runs
+        could otherwise delete while they're classified. Their overlap tabs
+        go with them."""
+        spreadsheet = self.service.get(spreadsheetId=self.spreadsheet_id,
+                                       fields='sheets.properties').execute()
+        run_sheets = sorted(
+            (sheet['properties'] for sheet in spreadsheet.get('sheets', [])
+             if sheet['properties']['title'].startswith(_OUTPUT_SHEET + '_')),
+            key=lambda properties: properties['title'])
+        overlap_sheets = {properties['title']: properties for properties in run_sheets
+                          if properties['title'].endswith(_OVERLAP_SUFFIX)}
+        run_sheets = [properties for properties in run_sheets
+                      if properties['title'] not in overlap_sheets]
+        to_delete = run_sheets[:-keep] if keep else run_sheets
+        cutoff = datetime.now() - timedelta(seconds=min_age)
+        to_delete = [properties for properties in to_delete
+                     if not _created_after(properties['title'], cutoff)]
+        to_delete += [overlap_sheets[properties['title'] + _OVERLAP_SUFFIX]
+                      for properties in to_delete
+                      if properties['title'] + _OVERLAP_SUFFIX in overlap_sheets]
+        if not to_delete:
+            return
+        body = {'requests': [{'deleteSheet': {'sheetId': properties['sheetId']}}
+                             for properties in to_delete]}
+        self.service.batchUpdate(spreadsheetId=self.spreadsheet_id, body=body).execute()
+
     def _clear_sheet(self, sheet_name):
         """Helper function to clear output sheet before writing to it."""
         range_name = sheet_name + '!A:Z'
@@ -73,6 +176,124 @@ class SheetsInteractor:
             spreadsheetId=self.spreadsheet_id, range=range_name, body={}).execute()
 
 
+def _normalize_row(row) -> List[str]:
+    """Sheets drops trailing empty cells and returns numbers as numbers."""
+    row = ['' if value is None else str(value) for value in row]
+    while row and row[-1] == '':
+        row.pop()
+    return row
+
+
+def _row_hash(row) -> bytes:
+    return hashlib.blake2b('\x1f'.join(_normalize_row(row)).encode('utf-8'),
+                           digest_size=8).digest()
+
+
+def diff_rows(current, desired):
+    """Compares a sheet's rows to the desired rows, keyed by the first column.
+    Both lists start with a header row, which is compared by position. A row
+    is compared only over the desired row's cells, so writing just keywords
+    keeps the categories of keywords that are already in the sheet.
+    Returns:
+      changed: (row index, desired row) of existing keys whose row changed.
+      removed: Sorted row indices of keys no longer wanted, or duplicates.
+      inserted: Desired rows with keys not in the sheet, in order.
+    """
+    index = {}
+    removed = []
+    for i, row in enumerate(current[1:], start=1):
+        key = str(row[0]) if row else ''
+        if key in index:
+            removed.append(i)
+        else:
+            index[key] = i
+
+    changed = []
+    inserted = []
+    if desired and (not current or _row_hash(current[0]) != _row_hash(desired[0])):
+        changed.append((0, desired[0]))
+    seen = set()
+    for row in desired[1:]:
+        key = '' if row[0] is None else str(row[0])
+        if key in index and key not in seen:
+            i = index[key]
+            if _row_hash(current[i][:len(row)]) != _row_hash(row):
+                changed.append((i, row))
+        else:
+            inserted.append(row)
+        seen.add(key)
+    removed += [i for key, i in index.items() if key not in seen]
+    return changed, sorted(removed), inserted
+
+
+def _cell(value):
+    if value is None or value == '':
+        return {}
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+
+def _row_data(row):
+    # Pad to the header's width, so cells emptied since the last write get cleared
+    row = list(row) + [''] * (len(_HEADER) - len(row))
+    return {'values': [_cell(value) for value in row]}
+
+
+def _runs(indices):
+    """Groups sorted indices into (start, end) runs of consecutive indices."""
+    runs = []
+    for i in indices:
+        if runs and runs[-1][1] == i:
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1])
+    return runs
+
+
+def _diff_requests(sheet_id, changed, removed, inserted) -> List[Dict[str, Any]]:
+    """Builds batchUpdate requests for a diff. Requests apply in order, so
+    updates use the current indices, deletes go bottom up and appends last."""
+    requests = []
+    rows_by_index = dict(changed)
+    for start, end in _runs(sorted(rows_by_index)):
+        for chunk in range(start, end, _DIFF_ROWS_PER_REQUEST):
+            chunk_end = min(chunk + _DIFF_ROWS_PER_REQUEST, end)
+            requests.append({'updateCells': {
+                'start': {'sheetId': sheet_id, 'rowIndex': chunk, 'columnIndex': 0},
+                'rows': [_row_data(rows_by_index[i]) for i in range(chunk, chunk_end)],
+                'fields': 'userEnteredValue'}})
+    for start, end in reversed(_runs(removed)):
+        requests.append({'deleteDimension': {'range': {
+            'sheetId': sheet_id, 'dimension': 'ROWS', 'startIndex': start, 'endIndex': end}}})
+    for chunk in range(0, len(inserted), _DIFF_ROWS_PER_REQUEST):
+        requests.append({'appendCells': {
+            'sheetId': sheet_id,
+            'rows': [_row_data(row) for row in inserted[chunk:chunk + _DIFF_ROWS_PER_REQUEST]],
+            'fields': 'userEnteredValue'}})
+    return requests
+
+
+def overlap_sheet_name(sheet: str) -> str:
+    """Returns the name of an output tab's overlap tab."""
+    return sheet + _OVERLAP_SUFFIX
+
+
+def run_sheet_name() -> str:
+    """Returns a unique, chronologically sortable output tab name for a single run."""
+    return (f"{_OUTPUT_SHEET}_{datetime.now().strftime(_RUN_SHEET_TIME_FORMAT)}"
+            f"_{uuid.uuid4().hex[:6]}")
+
+
+def _created_after(title: str, cutoff: datetime) -> bool:
+    """Whether a run tab's name has a creation time after cutoff, False for other names."""
+    stamp = title[len(_OUTPUT_SHEET) + 1:len(_OUTPUT_SHEET) + 16]
+    try:
+        return datetime.strptime(stamp, _RUN_SHEET_TIME_FORMAT) > cutoff
+    except ValueError:
+        return False
+
+
 def create_new_spreadsheet(sheet_service):
     spreadsheet_title = _SS_NAME
     sheets = []
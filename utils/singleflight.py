@@ -0,0 +1,112 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalescing of identical concurrent calls.
+
+Sessions and scheduled jobs often run over overlapping accounts at the same
+time. A SingleFlight lets the first caller of a key do the work while any
+caller arriving before it finishes waits and shares the same result (or
+exception). Nothing is cached once the call completes, so later callers
+always get fresh data.
+
+Works across threads and event loops: async callers await the same
+concurrent.futures.Future sync callers block on.
+"""
+
+from concurrent import futures
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+import asyncio
+import hashlib
+import threading
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time, sharing its result.
+    Args:
+      name: Name used in logs and stats.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, futures.Future] = {}
+        self.calls = 0
+        self.shared = 0
+
+    def _join(self, key: Hashable) -> Tuple[futures.Future, bool]:
+        """Returns the key's in-flight future, and whether the caller leads it."""
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.shared += 1
+                return future, False
+            future = self._in_flight[key] = futures.Future()
+            return future, True
+
+    def _finish(self, key: Hashable, future: futures.Future, result=None, error=None):
+        with self._lock:
+            del self._in_flight[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Calls fn, unless a call for key is in flight, then waits for its result."""
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def do_async(self, key: Hashable, coro_fn: Callable[[], Awaitable]) -> Any:
+        """Awaits coro_fn(), unless a call for key is in flight, then awaits its result."""
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await coro_fn()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        """Calls made, calls that did the work and calls absorbed by another one."""
+        with self._lock:
+            return {'calls': self.calls, 'executed': self.calls - self.shared,
+                    'shared': self.shared}
+
+
+def client_identity(client) -> Tuple[str, str]:
+    """Returns the login customer ID of a Google Ads client and a digest of
+    its credentials. Calls are only shared between clients with the same
+    identity, so nobody gets results, or errors, of another user or MCC."""
+    credentials = getattr(client, 'credentials', None)
+    token = getattr(credentials, 'refresh_token', None)
+    secret = (f"{getattr(credentials, 'client_id', '')}:{token}:"
+              f"{getattr(client, 'developer_token', '')}" if token else f"id:{id(credentials)}")
+    digest = hashlib.blake2b(secret.encode('utf-8'), digest_size=8).hexdigest()
+    return str(getattr(client, 'login_customer_id', '') or ''), digest
+
+
+# Google Ads search_stream results, keyed by (client_identity, customer_id, query)
+ads_flight = SingleFlight('ads')